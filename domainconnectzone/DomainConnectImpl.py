@@ -1,9 +1,17 @@
+import asyncio
+import collections
 import json
 import os
 import copy
+import functools
+import threading
 import uuid
 
-from domainconnectzone.sigutil import get_publickey, verify_sig
+from concurrent.futures import ProcessPoolExecutor
+
+from domainconnectzone.bundleutil import open_bundle
+from domainconnectzone.poolutil import submit_chunks
+from domainconnectzone.sigutil import verify_sig, publickey_cache
 from domainconnectzone.validate import *
 
 try:
@@ -130,42 +138,32 @@ def resolve_variables(input_, domain, host, params, recordKey):
     :raises: MissingParameter if a required parameter is missing
     """
 
-    ci = 0
-    originalinput = input_
-    while input_.find('%', ci) != -1:
+    segments, unpaired = _tokenise_variables(input_)
+    if len(segments) > 1 or unpaired:
+        input_ = _substitute_variables(segments, unpaired, _Binding(domain, host, params),
+                                       recordKey, input_)
 
-        # Find the next variable to process
-        start = input_.find('%', ci) + 1
-        end = input_.find('%', start)
-        if -1 == end:
-            raise InvalidTemplate("Unpaired variable delimiter in {}: {}".format(recordKey, originalinput))
+    return _resolve_name_rules(input_, domain, host, recordKey)
 
-        # Grab the variable name
-        name = input_[start:end]
 
-        # Calculate the value
-        value = None
-        if name == 'fqdn':
-            if host:
-                value = host + '.' + domain
-            else:
-                value = domain
-        elif name == 'domain':
-            value = domain
-        elif name == 'host':
-            value = host
-        elif name in params:
-            value = params[name]
+def _resolve_name_rules(input_, domain, host, recordKey):
+    """
+    Applies the @ and host/name rules to a field after variable substitution.
 
-        if value is None:
-            raise MissingParameter("No value for parameter '" + name + "'")
+    :param input_: Field value with all variables substituted
+    :type input_: str
+    :param domain: Domain/host the template is being applied to
+    :type domain: str
+    :param host: Host of the template record
+    :type host: str
+    :param recordKey: Key of the field being processed (e.g. 'name', 'host', etc.)
+    :type recordKey: str
 
-        # Place the value into the input string
-        input_ = input_.replace('%' + name + '%', value)
+    :return: The value of the field after host/name resolution
+    :rtype: str
 
-        # Advance past this, as the value might have had a %.
-        # start is the index after the opening %, so the token starts at start-1.
-        ci = (start - 1) + len(value)
+    :raises: InvalidData if a wildcard host is not followed by a valid label
+    """
 
     # Empty or @ has special meaning for some fields. This processing shall take place after the variables are processed.
     if not input_ or input_ == '' or input_ == '@':
@@ -231,6 +229,124 @@ def resolve_variables(input_, domain, host, params, recordKey):
 
     return input_
 
+
+# Number of distinct template fields whose tokens are kept by _tokenise_variables
+_TOKEN_CACHE_SIZE = 4096
+
+
+@functools.lru_cache(maxsize=_TOKEN_CACHE_SIZE)
+def _tokenise_variables(input_):
+    """
+    Splits a template field into literal segments and variable names.
+
+    The result alternates literal segments and variable names, starting and
+    ending with a (possibly empty) literal: 'a%x%b' becomes ('a', 'x', 'b').
+    An unpaired variable delimiter does not raise here; the text from it on is
+    kept in the last literal and the flag is returned so the error is raised
+    when the field is resolved, after any missing parameter before it.
+
+    Results are cached by the raw field, so a field is parsed once no matter
+    how often it is resolved.
+
+    :param input_: Input string from a template
+    :type input_: str
+
+    :return: The segments and whether the input has an unpaired delimiter
+    :rtype: tuple(tuple(str), bool)
+    """
+    segments = []
+    ci = 0
+    while True:
+        start = input_.find('%', ci)
+        if start == -1:
+            segments.append(input_[ci:])
+            return tuple(segments), False
+        end = input_.find('%', start + 1)
+        if end == -1:
+            segments.append(input_[ci:])
+            return tuple(segments), True
+        segments.append(input_[ci:start])
+        segments.append(input_[start + 1:end])
+        ci = end + 1
+
+
+def _substitute_variables(segments, unpaired, binding, recordKey, originalinput):
+    """
+    Joins the segments of a tokenised field with the values of its variables.
+
+    Values are inserted as they are and never scanned for variables, so a
+    value may contain a %.
+
+    :param segments: Literal segments and variable names from _tokenise_variables
+    :type segments: tuple(str)
+    :param unpaired: Whether the field has an unpaired variable delimiter
+    :type unpaired: bool
+    :param binding: The domain, host and params being applied
+    :type binding: _Binding
+    :param recordKey: Key of the field being processed (e.g. 'name', 'host', etc.)
+    :type recordKey: str
+    :param originalinput: The field before substitution, for error messages
+    :type originalinput: str
+
+    :return: The field with all variables substituted
+    :rtype: str
+
+    :raises: InvalidTemplate if there is an unpaired variable delimiter in the field
+    :raises: MissingParameter if a required parameter is missing
+    """
+    parts = [segments[0]]
+    for i in range(1, len(segments), 2):
+        parts.append(binding.lookup(segments[i]))
+        parts.append(segments[i + 1])
+
+    if unpaired:
+        raise InvalidTemplate("Unpaired variable delimiter in {}: {}".format(recordKey, originalinput))
+
+    return ''.join(parts)
+
+
+class _Binding(object):
+    """
+    The domain, host and params a compiled template is applied with.
+
+    :param domain: Domain the template is being applied to
+    :type domain: str
+    :param host: Host the template is being applied to
+    :type host: str
+    :param params: Dictionary containing key/values
+    :type params: dict(str, str)
+    """
+
+    __slots__ = ('domain', 'host', 'params', 'fqdn')
+
+    def __init__(self, domain, host, params):
+        self.domain = domain
+        self.host = host
+        self.params = params
+        if host:
+            self.fqdn = host + '.' + domain
+        else:
+            self.fqdn = domain
+
+    def lookup(self, name):
+        """
+        Returns the value of a variable.
+
+        :raises: MissingParameter if there is no value for the variable
+        """
+        if name == 'fqdn':
+            value = self.fqdn
+        elif name == 'domain':
+            value = self.domain
+        elif name == 'host':
+            value = self.host
+        else:
+            value = self.params.get(name)
+
+        if value is None:
+            raise MissingParameter("No value for parameter '" + name + "'")
+        return value
+
 import re as _re
 _INT_FIELD_RE = _re.compile(r'^%[^%]+%$')
 
@@ -243,6 +359,265 @@ def _is_int_field(value):
         return bool(_INT_FIELD_RE.match(value))
 
 
+class _NameTrieNode(object):
+    """A node of the label-reversed name trie kept by _ZoneIndex."""
+
+    __slots__ = ('children', 'records')
+
+    def __init__(self):
+        self.children = {}
+        self.records = []
+
+
+class _ZoneIndex(object):
+    """
+    The zone records of a process_records run, indexed by (name, type).
+
+    Names are lowercased and types uppercased for the key, so conflict
+    detection in the record processors is a dictionary lookup instead of a
+    scan over the whole zone. Iterating the index yields the records in their
+    original order.
+
+    The names are also kept in a trie keyed by the labels in reverse order
+    (bar -> foo -> www for www.foo.bar). Records at or below a name are a
+    subtree of the trie and records at or above a name lie on the path from
+    the root, which is what the NS delegation rules need.
+
+    :param zone_records: The records in the zone.
+    :type zone_records: list
+        - elements: dict
+    """
+
+    def __init__(self, zone_records):
+        self.records = zone_records
+        self._by_name_type = {}
+        self._names = _NameTrieNode()
+        self._provenance = None
+        self._fingerprints = None
+        for zone_record in zone_records:
+            name = zone_record.get('name', '').lower()
+            key = (name, zone_record['type'].upper())
+            self._by_name_type.setdefault(key, []).append(zone_record)
+
+            node = self._names
+            for label in reversed(name.split('.')):
+                child = node.children.get(label)
+                if child is None:
+                    child = node.children[label] = _NameTrieNode()
+                node = child
+            node.records.append(zone_record)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def find(self, name, types):
+        """
+        Return the zone records with the given name and one of the given types.
+
+        :param name: Lowercased record name
+        :type name: str
+        :param types: Uppercased record types
+        :type types: list(str)
+
+        :return: The matching records, in zone order within each type
+        :rtype: list(dict)
+        """
+        found = []
+        for record_type in types:
+            found.extend(self._by_name_type.get((name, record_type), ()))
+        return found
+
+    def subtree(self, name):
+        """
+        Return the zone records at the given name or any name below it.
+
+        For bar this is bar, foo.bar and www.foo.bar, but not xbar.
+
+        :param name: Lowercased record name
+        :type name: str
+
+        :return: The matching records
+        :rtype: list(dict)
+        """
+        node = self._names
+        for label in reversed(name.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                return []
+
+        found = []
+        pending = [node]
+        while pending:
+            node = pending.pop()
+            found.extend(node.records)
+            pending.extend(node.children.values())
+        return found
+
+    def ancestors(self, name, types):
+        """
+        Return the zone records of the given types at the given name or any
+        name above it.
+
+        For www.foo.bar this is www.foo.bar, foo.bar and bar, but not xbar.
+
+        :param name: Record name, compared against the lowercased zone names
+        :type name: str
+        :param types: Uppercased record types
+        :type types: list(str)
+
+        :return: The matching records
+        :rtype: list(dict)
+        """
+        found = []
+        node = self._names
+        for label in reversed(name.split('.')):
+            node = node.children.get(label)
+            if node is None:
+                break
+            for zone_record in node.records:
+                if zone_record['type'].upper() in types:
+                    found.append(zone_record)
+        return found
+
+
+    def provenance(self):
+        """
+        Return the records grouped by their template instance, built on first use.
+
+        :rtype: _ProvenanceIndex
+        """
+        if self._provenance is None:
+            self._provenance = _ProvenanceIndex(self.records)
+        return self._provenance
+
+
+    def identical(self, new_record):
+        """
+        Return the first record identical to new_record that is not marked
+        '_delete' or '_replace', or None.
+
+        The records are indexed by _record_fingerprint on first use. Marks are
+        checked on lookup, so the index stays valid while records are marked.
+
+        :param new_record: Normalised record
+        :type new_record: dict
+
+        :rtype: dict or None
+        """
+        if self._fingerprints is None:
+            self._fingerprints = {}
+            for zone_record in self.records:
+                self._fingerprints.setdefault(_record_fingerprint(zone_record), []).append(zone_record)
+
+        for zone_record in self._fingerprints.get(_record_fingerprint(new_record), ()):
+            if '_delete' not in zone_record and '_replace' not in zone_record:
+                return zone_record
+        return None
+
+
+class _ProvenanceIndex(object):
+    """
+    The zone records of a process_records run that carry '_dc' provenance,
+    grouped by the providerId, serviceId and host of the template instance
+    that added them.
+
+    Marking the records of the previous instance of a template and cascading
+    the delete of an essential record to its instance are then a lookup
+    instead of scans over the whole zone. If any '_dc' is not a dict with
+    hashable providerId, serviceId and host, the scans are used instead.
+
+    :param zone_records: The records in the zone.
+    :type zone_records: list
+        - elements: dict
+    """
+
+    def __init__(self, zone_records):
+        self.records = zone_records
+        self.groups = {}
+        self.irregular = False
+        for zone_record in zone_records:
+            if '_dc' not in zone_record:
+                continue
+            dc = zone_record['_dc']
+            if type(dc) is not dict or 'providerId' not in dc or 'serviceId' not in dc or 'host' not in dc:
+                self.irregular = True
+                continue
+            try:
+                self.groups.setdefault((dc['providerId'], dc['serviceId'], dc['host']), []).append(zone_record)
+            except TypeError:
+                # unhashable values are only compared by the scans
+                self.irregular = True
+
+    def mark_replaced(self, provider_id, service_id, host):
+        """Mark the records of the previous instance of a template with '_replace'."""
+        if not (provider_id and service_id and host):
+            return
+        try:
+            group = None if self.irregular else self.groups.get((provider_id, service_id, host), ())
+        except TypeError:
+            group = None
+        if group is not None:
+            for zone_record in group:
+                zone_record['_replace'] = True
+            return
+
+        for zone_record in self.records:
+
+            if '_dc' in zone_record:
+
+                if (provider_id and 'providerId' in zone_record['_dc'] and
+                    service_id and 'serviceId' in zone_record['_dc'] and
+                    host and 'host' in zone_record['_dc'] and
+                    provider_id == zone_record['_dc']['providerId'] and
+                    service_id == zone_record['_dc']['serviceId'] and
+                    host == zone_record['_dc']['host']):
+
+                    zone_record['_replace'] = True
+
+    def cascade_deletes(self):
+        """
+        Mark all records of a template instance with '_delete' if an essential
+        ('Always') record of it is marked.
+        """
+        if not self.irregular:
+            for group in self.groups.values():
+                for zone_record in group:
+                    if ('_delete' in zone_record and
+                        'essential' in zone_record['_dc'] and
+                        zone_record['_dc']['essential'] == 'Always'):
+                        for zone_record2 in group:
+                            zone_record2['_delete'] = 1
+                        break
+            return
+
+        for zone_record in self.records:
+
+            # If the record is marked for deletion and is essential to
+            # the service, we cascade
+            if ('_delete' in zone_record and
+                '_dc' in zone_record and
+                'essential' in zone_record['_dc'] and
+                zone_record['_dc']['essential'] == 'Always'):
+
+                for zone_record2 in self.records:
+                    if ('_dc' in zone_record2 and
+                        zone_record['_dc']['providerId'] == zone_record2['_dc']['providerId'] and
+                        zone_record['_dc']['serviceId'] == zone_record2['_dc']['serviceId'] and \
+                        zone_record['_dc']['host'] == zone_record2['_dc']['host']):
+
+                        zone_record2['_delete'] = 1
+
+
+def _as_zone_index(zone_records):
+    """Return zone_records as a _ZoneIndex, building one for a plain list."""
+    if isinstance(zone_records, _ZoneIndex):
+        return zone_records
+    return _ZoneIndex(zone_records)
+
+
 def process_txt_record(template_record, zone_records):
     """
     Will process a txt record from a template.
@@ -261,7 +636,7 @@ def process_txt_record(template_record, zone_records):
         - keys: 'type', 'host', 'data', 'txtConflictMatchingMode', 'txtConflictMatchingPrefix'
 
     :param zone_records: A list of all records in the current zone.
-    :type zone_records: list
+    :type zone_records: list | _ZoneIndex
         - elements: dict
         - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
 
@@ -278,14 +653,12 @@ def process_txt_record(template_record, zone_records):
                   'ttl': int(template_record['ttl'])}
 
     # Handle any conflicting deletes
-    for zone_record in zone_records:
+    # We conflict against TXT or CNAME with the same host
+    zone_index = _as_zone_index(zone_records)
+    for zone_record in zone_index.find(template_record['host'].lower(), ['TXT', 'CNAME']):
         zone_record_type = zone_record['type'].upper()
 
-        # We conflict against TXT or CNAME with the same host
-
-        if (zone_record_type not in ['TXT', 'CNAME'] or
-            zone_record['name'].lower() != template_record['host'].lower() or
-            '_replace' in zone_record):
+        if '_replace' in zone_record:
             continue
 
         # Delete the CNAME
@@ -323,7 +696,7 @@ def process_redir_record(template_record, zone_records):
         - keys: 'type', 'host', 'target'
 
     :param zone_records: A list of all records in the current zone.
-    :type zone_records: list
+    :type zone_records: list | _ZoneIndex
         - elements: dict
         - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
 
@@ -340,14 +713,11 @@ def process_redir_record(template_record, zone_records):
                   'data': template_record['target']}
 
     # Handle any conflicting deletes
-    for zone_record in zone_records:
-        zone_record_type = zone_record['type'].upper()
-
-        # We conflict against REDIR301/302 or CNAME with the same host
-
-        if (zone_record_type not in ['CNAME', 'REDIR301', 'REDIR302'] or
-            zone_record['name'].lower() != template_record['host'].lower() or
-            '_replace' in zone_record):
+    # We conflict against REDIR301/302 or CNAME with the same host
+    zone_index = _as_zone_index(zone_records)
+    for zone_record in zone_index.find(template_record['host'].lower(),
+                                       ['CNAME', 'REDIR301', 'REDIR302']):
+        if '_replace' in zone_record:
             continue
 
         zone_record['_delete'] = 1
@@ -370,7 +740,7 @@ def process_spfm_record(template_record, zone_records):
         - keys: 'host', 'spfRules' (required), '_delete' (optional)
 
     :param zone_records: A list of all records in the current zone.
-    :type zone_records: list
+    :type zone_records: list | _ZoneIndex
         - elements: dict
         - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
 
@@ -385,12 +755,11 @@ def process_spfm_record(template_record, zone_records):
     found_spf = False
     new_record = None
 
-    for zone_record in zone_records:
+    zone_index = _as_zone_index(zone_records)
+    for zone_record in zone_index.find(template_record['host'].lower(), ['TXT']):
 
         # See if we have an spf record
-        if (zone_record['type'].upper() == 'TXT' and
-            zone_record['name'].lower() == template_record['host'].lower() and
-            zone_record['data'].startswith('v=spf1 ')):
+        if zone_record['data'].startswith('v=spf1 '):
 
             # If our rule is not already in the spf rules, merge it in
             if (zone_record['data'].find(template_record['spfRules']) == -1 and
@@ -438,7 +807,7 @@ def process_srv_record(template_record, zone_records):
         - keys: 'name', 'target', 'ttl', 'protocol', 'service', 'priority', 'weight', 'port'
 
     :param zone_records: A list of all records in the current zone.
-    :type zone_records: list
+    :type zone_records: list | _ZoneIndex
         - elements: dict
         - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
 
@@ -461,10 +830,9 @@ def process_srv_record(template_record, zone_records):
                   'weight': int(template_record['weight']),
                   'port': int(template_record['port'])}
 
-    for zone_record in zone_records:
-        if (zone_record['type'].upper() == 'SRV' and
-            zone_record['name'].lower() == template_record['name'].lower() and
-                '_replace' not in zone_record):
+    zone_index = _as_zone_index(zone_records)
+    for zone_record in zone_index.find(template_record['name'].lower(), ['SRV']):
+        if '_replace' not in zone_record:
             zone_record['_delete'] = 1
 
     return new_record
@@ -482,7 +850,7 @@ def process_ns(template_record, zone_records):
             - keys: 'type', 'host', 'pointsTo', 'ttl'
 
         :param zone_records: A list of all records in the current zone.
-        :type zone_records: list
+        :type zone_records: list | _ZoneIndex
             - elements: dict
             - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
 
@@ -504,12 +872,9 @@ def process_ns(template_record, zone_records):
     # xbar
     template_record_name = template_record['host'].lower()
 
-    for zone_record in zone_records:
-        zone_record_name = zone_record['name'].lower()
-
-        if ((zone_record_name == template_record_name or
-             zone_record_name.endswith('.' + template_record_name)) and
-            '_replace' not in zone_record):
+    zone_index = _as_zone_index(zone_records)
+    for zone_record in zone_index.subtree(template_record_name):
+        if '_replace' not in zone_record:
             zone_record['_delete'] = 1
 
     return new_record
@@ -571,7 +936,7 @@ def process_other_record(template_record, zone_records):
         - keys: 'type', 'host', 'pointsTo' (or 'data'), 'ttl', 'priority' (optional for MX)
 
     :param zone_records: A list of all records in the current zone.
-    :type zone_records: list
+    :type zone_records: list | _ZoneIndex
         - elements: dict
         - keys: 'type', 'name', '_delete' (optional), 'data', 'ttl' (optional), 'priority' (optional for MX)
 
@@ -594,12 +959,10 @@ def process_other_record(template_record, zone_records):
         new_record['priority'] = int(template_record['priority'])
 
     # Mark records in the zone for deletion
-    for zone_record in zone_records:
-        zone_record_type = zone_record['type'].upper()
-        
-        if zone_record_type in _delete_map[record_type] and \
-            zone_record['name'].lower() == template_record['host'].lower() and \
-            '_replace' not in zone_record:
+    zone_index = _as_zone_index(zone_records)
+    for zone_record in zone_index.find(template_record['host'].lower(),
+                                       _delete_map[record_type]):
+        if '_replace' not in zone_record:
             zone_record['_delete'] = 1
 
     return new_record
@@ -615,7 +978,7 @@ def process_apexcname_record(template_record, zone_records):
         - keys: 'type', 'pointsTo', 'ttl'; optional 'host' (must be '@' if present)
 
     :param zone_records: A list of all records in the current zone.
-    :type zone_records: list
+    :type zone_records: list | _ZoneIndex
 
     :return: The new APEXCNAME record.
     :rtype: dict
@@ -625,18 +988,90 @@ def process_apexcname_record(template_record, zone_records):
                   'data': template_record['pointsTo'],
                   'ttl': int(template_record['ttl'])}
 
-    for zone_record in zone_records:
-        zone_record_type = zone_record['type'].upper()
-        if zone_record_type in _delete_map['APEXCNAME'] and \
-                zone_record['name'] == '@' and \
-                '_replace' not in zone_record:
+    zone_index = _as_zone_index(zone_records)
+    for zone_record in zone_index.find('@', _delete_map['APEXCNAME']):
+        if '_replace' not in zone_record:
             zone_record['_delete'] = 1
 
     return new_record
 
 
+def _dot_suffixes(name):
+    """Return the names name ends with after a '.': b.c and c for a.b.c."""
+    suffixes = []
+    dot = name.find('.')
+    while dot != -1:
+        suffixes.append(name[dot + 1:])
+        dot = name.find('.', dot + 1)
+    return suffixes
+
+
+class _SelfConflictIndex(object):
+    """
+    The new records of a process_records run, indexed for check_conflict_with_self.
+
+    Every index maps a name to the position of the first new record it
+    applies to, so a check looks up the name of the record and the names it
+    ends with instead of comparing it with every new record. The conflict
+    reported is the first in the order the records were added, as for a list.
+    """
+
+    def __init__(self):
+        self.records = []
+        # name -> first record at the name
+        self._by_name = {}
+        # name -> first CNAME or APEXCNAME record at the name
+        self._cname_by_name = {}
+        # name -> first non-NS record at or below the name
+        self._non_ns_below = {}
+        # name -> first NS record at the name
+        self._ns_by_name = {}
+
+    def add(self, record):
+        position = len(self.records)
+        self.records.append(record)
+        name = record['name']
+        self._by_name.setdefault(name, position)
+        if record['type'] in ('CNAME', 'APEXCNAME'):
+            self._cname_by_name.setdefault(name, position)
+        if record['type'] == 'NS':
+            self._ns_by_name.setdefault(name, position)
+        else:
+            self._non_ns_below.setdefault(name, position)
+            for suffix in _dot_suffixes(name):
+                self._non_ns_below.setdefault(suffix, position)
+
+    def first_conflict(self, new_record):
+        """Return the first record new_record conflicts with, or None."""
+        name = new_record['name']
+        positions = []
+
+        if new_record['type'] in ('CNAME', 'APEXCNAME'):
+            positions.append(self._by_name.get(name))
+        else:
+            positions.append(self._cname_by_name.get(name))
+
+        if new_record['type'] == 'NS':
+            positions.append(self._non_ns_below.get(name))
+        else:
+            positions.append(self._ns_by_name.get(name))
+            for suffix in _dot_suffixes(name):
+                positions.append(self._ns_by_name.get(suffix))
+
+        positions = [position for position in positions if position is not None]
+        if not positions:
+            return None
+        return self.records[min(positions)]
+
+
 def check_conflict_with_self(new_record, new_records):
     # Mark records that conflict with self (affects only CNAME, APEXCNAME and NS)
+    if isinstance(new_records, _SelfConflictIndex):
+        zone_record = new_records.first_conflict(new_record)
+        if zone_record is not None:
+            raise InvalidData(f"Template record {new_record['type']} {new_record['name']} conflicts with other tempate record {zone_record['type']} {zone_record['name']}")
+        return
+
     for zone_record in new_records:
         zone_record_type = zone_record['type'].upper()
 
@@ -681,6 +1116,28 @@ _NORMALISE_CASE_PRESERVE = {
 }
 
 
+def _case_preserve_fields(rtype, is_custom):
+    """Return the fields of an RR type whose values keep their case."""
+    preserve = set(['type', '_dc'])
+    for pattern, fields in _NORMALISE_CASE_PRESERVE.items():
+        if pattern == '*':
+            preserve.update(fields)
+        elif pattern == '?' and is_custom:
+            preserve.update(fields)
+        elif pattern == rtype:
+            preserve.update(fields)
+    return frozenset(preserve)
+
+
+# RR type -> fields that keep their case, for the core types and every type
+# named in _NORMALISE_CASE_PRESERVE. Any other type is a custom type.
+_NORMALISE_PRESERVE_BY_TYPE = {
+    rtype: _case_preserve_fields(rtype, rtype not in _CORE_TYPES)
+    for rtype in _CORE_TYPES | (set(_NORMALISE_CASE_PRESERVE) - {'*', '?'})
+}
+_NORMALISE_PRESERVE_CUSTOM = _case_preserve_fields(None, True)
+
+
 def _normalise_record(record):
     """Return a normalised copy of record.
 
@@ -695,29 +1152,90 @@ def _normalise_record(record):
     duplicate-skip check, so that case differences between zone and template
     inputs do not produce spurious duplicates.
     """
-    rtype = str(record.get('type', '')).upper()
-    is_custom = rtype not in _CORE_TYPES
+    rtype = record['type'].upper()
+    record['type'] = rtype
+    preserve = _NORMALISE_PRESERVE_BY_TYPE.get(rtype, _NORMALISE_PRESERVE_CUSTOM)
 
-    preserve = set(['type', '_dc'])
-    for pattern, fields in _NORMALISE_CASE_PRESERVE.items():
-        if pattern == '*':
-            preserve.update(fields)
-        elif pattern == '?' and is_custom:
-            preserve.update(fields)
-        elif pattern == rtype:
-            preserve.update(fields)
+    return {k: v.lower() if isinstance(v, str) and k not in preserve else v
+            for k, v in record.items()}
+
+
+class NormalisedZone(object):
+    """
+    The records of a zone normalised once for repeated application.
+
+    process_records normalises every zone record into a working copy and
+    indexes them before any template record is processed. Passing a
+    NormalisedZone as zone_records to process_records, CompiledTemplate.apply
+    or DomainConnect.apply_template skips that work, so it is paid once per
+    zone instead of once per application.
+
+    An application marks the records of the zone and clears the marks again
+    when it is done, so applications to one NormalisedZone run one after the
+    other. The deleted records returned are copies; the final records are the
+    records of the zone and must not be modified.
+
+    :param zone_records: The records in the zone. They are not modified,
+        except that their 'type' is uppercased as by process_records.
+    :type zone_records: iterable
+        - elements: dict
+        - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
+    """
+
+    def __init__(self, zone_records):
+        self._init([_normalise_record(zr) for zr in zone_records])
+
+    def _init(self, records):
+        self.records = records
+        self.index = _ZoneIndex(records)
+        # position -> flags set by the caller, restored after every application
+        self._preset = {}
+        for position, zone_record in enumerate(records):
+            flags = {k: zone_record[k] for k in ('_delete', '_replace') if k in zone_record}
+            if flags:
+                self._preset[position] = flags
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        return self.records
+
+    def __setstate__(self, records):
+        self._init(records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+    def _reset(self):
+        """Clears the marks of an application, keeping those of the caller."""
+        for zone_record in self.records:
+            if '_delete' in zone_record or '_replace' in zone_record:
+                zone_record.pop('_delete', None)
+                zone_record.pop('_replace', None)
+        for position, flags in self._preset.items():
+            self.records[position].update(flags)
 
-    result = {}
-    record['type'] = record['type'].upper()
-    for k, v in record.items():
-        if isinstance(v, str) and k not in preserve:
-            result[k] = v.lower()
-        else:
-            result[k] = v
-    return result
 
 _RECORD_COMPARE_SKIP = {'_delete', '_replace', 'ttl', "_dc"}
 
+def _record_fingerprint(record):
+    """Return a hashable key that is equal for records _find_identical_zone_record matches.
+
+    A missing field compares equal to any value whose string is empty, so
+    only the fields outside _RECORD_COMPARE_SKIP with a non-empty string are
+    part of the key.
+    """
+    fields = []
+    for k, v in record.items():
+        if k not in _RECORD_COMPARE_SKIP:
+            v = str(v)
+            if v:
+                fields.append((k, v))
+    return frozenset(fields)
+
+
 def _find_identical_zone_record(new_record, zone_records):
     """Return the zone record identical to new_record, or None.
 
@@ -735,8 +1253,12 @@ def _find_identical_zone_record(new_record, zone_records):
 
     Comparison builds the superset of keys present in either record, excludes
     the fields in _RECORD_COMPARE_SKIP (internal flags and ttl), then compares
-    all remaining values as strings.
+    all remaining values as strings. For a _ZoneIndex this is a lookup by
+    _record_fingerprint.
     """
+    if isinstance(zone_records, _ZoneIndex):
+        return zone_records.identical(new_record)
+
     for zr in zone_records:
         if '_delete' in zr or '_replace' in zr:
             continue
@@ -747,402 +1269,746 @@ def _find_identical_zone_record(new_record, zone_records):
     return None
 
 
-def process_records(template_records, zone_records, domain, host, params,
-                    group_ids, multi_aware=False, multi_instance=False,
-                    provider_id=None, service_id=None, unique_id=None,
-                    redirect_records=None):
+class _CompiledField(object):
     """
-    Process template records and generate new records and deletion rules for a zone.
+    A template field pre-split into literal segments and variable slots.
 
-    :param template_records: A list of template records to process.
-    :type template_records: list
-        - elements: dict
-        - keys: 'type', 'host', 'data', 'txtConflictMatchingMode', 'txtConflictMatchingPrefix'
+    :param raw: The field value from the template
+    :type raw: str
+    """
 
-    :param zone_records: A list of all records in the current zone.
-        Records are normalised (string field values lowercased, 'type' uppercased,
-        with the exception of 'data' for TXT and custom RR types) into a working
-        copy before processing begins; the caller's list is not mutated.
-    :type zone_records: list
-        - elements: dict
-        - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
+    __slots__ = ('raw', 'segments', 'unpaired')
 
-    :param domain: The domain for which to process the template records.
-    :type domain: str
+    def __init__(self, raw):
+        self.raw = raw
+        if isinstance(raw, str):
+            self.segments, self.unpaired = _tokenise_variables(raw)
+        else:
+            # Left to resolve_variables, which raises for it as before
+            self.segments, self.unpaired = None, False
 
-    :param host: The host for which to process the template records.
-    :type host: str
+    def resolve(self, binding, recordKey):
+        """
+        Resolves the field like resolve_variables does for the raw value.
 
-    :param params: Additional parameters for processing the template records.
-    :type params: dict
-        - keys: 'param1', 'param2', ...
+        :param binding: The domain, host and params being applied
+        :type binding: _Binding
+        :param recordKey: Key of the field being processed (e.g. 'name', 'host', etc.)
+        :type recordKey: str
 
-    :param group_ids: A list of group IDs to apply.
-    :type group_ids: list
+        :return: The value of the field after variable substitution and host/name resolution
+        :rtype: str
 
-    :param multi_aware: Whether to process the template records in a multi-aware manner.
-    :type multi_aware: bool
-        - default: False
+        :raises: InvalidTemplate if there is an unpaired variable delimiter in the field
+        :raises: MissingParameter if a required parameter is missing
+        """
+        segments = self.segments
+        if segments is None:
+            return resolve_variables(self.raw, binding.domain, binding.host,
+                                     binding.params, recordKey)
 
-    :param multi_instance: Whether to process the template records in a multi-instance manner.
-    :type multi_instance: bool
-        - default: False
+        if len(segments) == 1 and not self.unpaired:
+            value = segments[0]
+        else:
+            value = _substitute_variables(segments, self.unpaired, binding,
+                                          recordKey, self.raw)
 
-    :param provider_id: The ID of the provider for which to process the template records.
-    :type provider_id: str | int | None
+        return _resolve_name_rules(value, binding.domain, binding.host, recordKey)
 
-    :param service_id: The ID of the service for which to process the template records.
-    :type service_id: str | int | None
 
-    :param unique_id: The unique ID of the template instance (for multi-aware application).
-    :type unique_id: str | int | None
+# Fields of a template record that are resolved against the params
+_COMPILED_FIELDS = ('host', 'name', 'pointsTo', 'target', 'protocol', 'service',
+                    'data', 'spfRules')
 
-    :param redirect_records: A list of redirection records related to the template records.
-    :type redirect_records: list
-        - elements: dict
-        - keys: 'type', 'name', 'data'
+# Integer fields of a template record; these may hold a single %variable%
+_COMPILED_INT_FIELDS = ('ttl', 'priority', 'weight', 'port')
 
-    :return: A tuple containing the new records, deleted records, and final records.
-    :rtype: tuple
+_HOST_VALIDATORS = {
+    'A': is_valid_host_other,
+    'AAAA': is_valid_host_other,
+    'MX': is_valid_host_other,
+    'NS': is_valid_host_other,
+    'REDIR301': is_valid_host_other,
+    'REDIR302': is_valid_host_other,
+    'SPFM': is_valid_host_other,
+    'TXT': is_valid_host_other,
+    'CNAME': is_valid_host_cname_or_ns,
+}
 
-    :raises: Exception if any of the input parameters are invalid
-    """
 
-    # first resolve REDIR301/REDIR302 records to their corresponding equivalents
-    template_records_org = list(template_records)
-    template_records = []
-    redirects = []
-    for template_record in template_records_org:
-        if template_record['type'] in ['REDIR301', 'REDIR302']:
-            if redirect_records is None:
-                raise InvalidTemplate('REDIR301/REDIR302 record types not implemented by the client. redirect_records parameter missing.')
-            repl_records = copy.deepcopy(redirect_records)
-            record_attributes = template_record.copy()
-            del record_attributes['type']
-            for attr in ['data', 'target', 'pointsTo']:
-                if attr in record_attributes:
-                    del record_attributes[attr]
-            for r in repl_records:
-                r.update(record_attributes)
-
-            template_records += repl_records
-        template_records += [template_record]
+def _valid_pointsTo_ip4(value):
+    return is_valid_pointsTo_ip(value, 4)
 
-    """
-    Will process the template records to the zone using the domain/host/params
-    """
 
-    # Work on a normalised copy of zone_records so the caller's list is not mutated.
-    zone_records = [_normalise_record(zr) for zr in zone_records]
+def _valid_pointsTo_ip6(value):
+    return is_valid_pointsTo_ip(value, 6)
 
-    # If we are multi aware, we should remove the previous instances of the
-    # template
-    if multi_aware and not multi_instance:
 
-        for zone_record in zone_records:
+_POINTSTO_VALIDATORS = {
+    'A': _valid_pointsTo_ip4,
+    'AAAA': _valid_pointsTo_ip6,
+    'MX': is_valid_pointsTo_host,
+    'CNAME': is_valid_pointsTo_host,
+    'APEXCNAME': is_valid_pointsTo_host,
+    'NS': is_valid_pointsTo_host,
+}
 
-            if '_dc' in zone_record:
-                
-                if (provider_id and 'providerId' in zone_record['_dc'] and
-                    service_id and 'serviceId' in zone_record['_dc'] and
-                    host and 'host' in zone_record['_dc'] and 
-                    provider_id == zone_record['_dc']['providerId'] and
-                    service_id == zone_record['_dc']['serviceId'] and
-                    host == zone_record['_dc']['host']):
 
-                    zone_record['_replace'] = True
+class _CompiledRecord(object):
+    """
+    A template record prepared for repeated application.
 
+    Holds the record type, group, processor and validators together with
+    the pre-tokenised fields. Problems that can be seen in the template
+    alone are found here but only raised from resolve(), at the point where
+    process_records used to raise them, so a record skipped by its group
+    never fails and the first error of a template is still the same one.
 
-    # This will contain the new records
-    new_records = []
+    :param template_record: The record from the template; it is not modified.
+    :type template_record: dict
+    :param supported: The core record types that can be applied
+    :type supported: list(str)
+    """
 
-    # Process each record in the template
-    for template_record in template_records:
+    def __init__(self, template_record, supported):
+        self.record = template_record
+        self.type = template_record['type'].upper()
+        self.has_group = 'groupId' in template_record
+        self.group_id = template_record.get('groupId')
+        self.is_custom = self.type not in supported and is_custom_record_type(self.type)
+        self.is_supported = self.type in supported or self.is_custom
+
+        self.fields = {}
+        for key in _COMPILED_FIELDS:
+            if key in template_record:
+                self.fields[key] = _CompiledField(template_record[key])
+        self.int_fields = {}
+        for key in _COMPILED_INT_FIELDS:
+            if key in template_record:
+                raw = str(template_record[key])
+                self.fields[key] = _CompiledField(raw)
+                self.int_fields[key] = _is_int_field(raw)
+
+        if self.is_custom:
+            self.host_validator = is_valid_host_other
+        else:
+            self.host_validator = _HOST_VALIDATORS.get(self.type)
+        self.pointsTo_validator = _POINTSTO_VALIDATORS.get(self.type)
+
+        if self.type == 'SPFM':
+            self.processor = process_spfm_record
+        elif self.type == 'TXT':
+            self.processor = process_txt_record
+        elif self.type == 'SRV':
+            self.processor = process_srv_record
+        elif self.type in ['REDIR301', 'REDIR302']:
+            self.processor = process_redir_record
+        elif self.type == 'APEXCNAME':
+            self.processor = process_apexcname_record
+        elif self.is_custom:
+            self.processor = process_custom_record
+        elif self.type == 'NS':
+            self.processor = process_ns
+        else:
+            self.processor = process_other_record
 
-        # If we passed in a group, only apply records from the group
-        if (group_ids and
-            'groupId' in template_record and
-            template_record['groupId'] not in group_ids):
-            continue
+    def _resolve_int(self, resolved, key, binding):
+        """Resolves an integer field, which may be a single %variable%."""
+        if not self.int_fields[key]:
+            raise InvalidData(
+                'Invalid {} value (must be an integer or a single %variable%): {}'.format(
+                    key, self.fields[key].raw))
+        resolved[key] = self.fields[key].resolve(binding, key)
 
-        # Get the record type
-        template_record_type = template_record['type'].upper()
+    def resolve(self, binding):
+        """
+        Resolves and validates the record for one application.
 
-        # We can only handle certain record types
-        supported = ['A', 'AAAA', 'MX', 'CNAME', 'APEXCNAME', 'TXT', 'SRV', 'SPFM', 'NS']
-        if redirect_records is not None:
-            supported += ['REDIR301', 'REDIR302']
-        is_custom = not template_record_type in supported and is_custom_record_type(template_record_type) 
-        if not template_record_type in supported and not is_custom:
-            raise TypeError('Unknown record type (' + template_record_type +
+        :param binding: The domain, host and params being applied
+        :type binding: _Binding
+
+        :return: A copy of the template record with all fields resolved
+        :rtype: dict
+
+        :raises: TypeError if the record type is unknown
+        :raises: InvalidData if a resolved field is not valid for the record type
+        :raises: InvalidTemplate if there is an unpaired variable delimiter in a field
+        :raises: MissingParameter if a required parameter is missing
+        """
+        record_type = self.type
+        fields = self.fields
+
+        if not self.is_supported:
+            raise TypeError('Unknown record type (' + record_type +
                             ') in template')
 
-        # Deal with the variables and validation 
+        resolved = dict(self.record)
 
         # Deal with the host/name
-        if template_record_type == 'SRV':
-            template_record['name'] = resolve_variables(
-                template_record['name'], domain, host, params, 'name')
+        if record_type == 'SRV':
+            resolved['name'] = fields['name'].resolve(binding, 'name')
 
-            if not is_valid_name_srv(template_record['name']):
+            if not is_valid_name_srv(resolved['name']):
                 raise InvalidData('Invalid data for SRV name: ' +
-                                  template_record['name'])
-            srvhost = "_{}.{}".format(template_record['protocol'].lower(), template_record['name'])
+                                  resolved['name'])
+            srvhost = "_{}.{}".format(self.record['protocol'].lower(), resolved['name'])
             if not is_valid_host_srv(srvhost):
                 raise InvalidData('Invalid data for SRV host: ' +
                                   srvhost)
 
-        elif template_record_type == 'APEXCNAME':
+        elif record_type == 'APEXCNAME':
             # host is optional for APEXCNAME; if present it must be '@'
-            apex_host = template_record.get('host', '@')
+            apex_host = self.record.get('host', '@')
             if apex_host != '@':
                 raise InvalidData('Invalid data for APEXCNAME host: ' +
                                   apex_host + ' (must be @ or omitted)')
-            template_record['host'] = '@'
+            resolved['host'] = '@'
 
         else:
-            orig_host = template_record['host']
-            template_record['host'] = resolve_variables(
-                template_record['host'], domain, host, params, 'host')
-
-            err_msg = ('Invalid data for ' + template_record_type +
-                       ' host: ' + template_record['host'] +
-                       ' (from ' + orig_host + ')')
-            if template_record_type in ['A', 'AAAA', 'MX', 'NS', 'REDIR301', 'REDIR302']:
-                if not is_valid_host_other(template_record['host']):
-                    raise InvalidData(err_msg)
-            elif template_record_type in ['SPFM']:
-                if not is_valid_host_other(template_record['host']):
-                    raise InvalidData(err_msg)
-
-            elif template_record_type in ['TXT']:
-                if not is_valid_host_other(template_record['host']):
-                    raise InvalidData(err_msg)
-
-            elif template_record_type in ['CNAME', 'NS']:
-                if not is_valid_host_cname_or_ns(template_record['host']):
-                    raise InvalidData(err_msg)
-
-            elif is_custom:
-                if not is_valid_host_other(template_record['host']):
-                    raise InvalidData(err_msg)
+            orig_host = fields['host'].raw
+            resolved['host'] = fields['host'].resolve(binding, 'host')
+
+            if self.host_validator is not None and not self.host_validator(resolved['host']):
+                raise InvalidData('Invalid data for ' + record_type +
+                                  ' host: ' + resolved['host'] +
+                                  ' (from ' + orig_host + ')')
 
         # Points To / Target
-        if template_record_type in ['A', 'AAAA', 'MX', 'CNAME', 'APEXCNAME', 'NS']:
-            orig_pointsto = template_record['pointsTo']
-            if template_record_type == 'NS' and orig_pointsto == '@':
+        if self.pointsTo_validator is not None:
+            orig_pointsto = fields['pointsTo'].raw
+            if record_type == 'NS' and orig_pointsto == '@':
                 raise InvalidData('Invalid data for NS pointsTo: @ would create a circular delegation')
-            template_record['pointsTo'] = resolve_variables(
-                template_record['pointsTo'], domain, host, params, 'pointsTo')
-
-            if template_record_type in ['MX', 'CNAME', 'APEXCNAME', 'NS']:
-                if not is_valid_pointsTo_host(
-                        template_record['pointsTo']):
-                    raise InvalidData('Invalid data for ' +
-                                      template_record_type + ' pointsTo: ' +
-                                      template_record['pointsTo'] +
-                                      ' (from ' + orig_pointsto + ')')
-            elif template_record_type == 'A':
-                if not is_valid_pointsTo_ip(
-                        template_record['pointsTo'], 4):
-                    raise InvalidData('Invalid data for A pointsTo: ' +
-                                      template_record['pointsTo'] +
-                                      ' (from ' + orig_pointsto + ')')
-            elif template_record_type == 'AAAA':
-                if not is_valid_pointsTo_ip(
-                        template_record['pointsTo'], 6):
-                    raise InvalidData('Invalid data for AAAA pointsTo: ' +
-                                      template_record['pointsTo'] +
-                                      ' (from ' + orig_pointsto + ')')
-
-        if template_record_type == 'MX':
-            raw_priority = str(template_record['priority'])
-            if not _is_int_field(raw_priority):
-                raise InvalidData(
-                    'Invalid priority value (must be an integer or a single %variable%): ' +
-                    raw_priority)
-            template_record['priority'] = resolve_variables(
-                raw_priority, domain, host, params, 'priority')
-
-        elif template_record_type == 'SRV':
-            orig_target = template_record['target']
-            template_record['target'] = resolve_variables(
-                template_record['target'], domain, host, params, 'target')
-
-            if not is_valid_pointsTo_host(template_record['target']):
+            resolved['pointsTo'] = fields['pointsTo'].resolve(binding, 'pointsTo')
+
+            if not self.pointsTo_validator(resolved['pointsTo']):
+                raise InvalidData('Invalid data for ' +
+                                  record_type + ' pointsTo: ' +
+                                  resolved['pointsTo'] +
+                                  ' (from ' + orig_pointsto + ')')
+
+        if record_type == 'MX':
+            self._resolve_int(resolved, 'priority', binding)
+
+        elif record_type == 'SRV':
+            orig_target = fields['target'].raw
+            resolved['target'] = fields['target'].resolve(binding, 'target')
+
+            if not is_valid_pointsTo_host(resolved['target']):
                 raise InvalidData('Invalid data for SRV target: ' +
-                                  template_record['target'] +
+                                  resolved['target'] +
                                       ' (from ' + orig_target + ')')
-        elif template_record_type in ['REDIR301', 'REDIR302']:
-            orig_target = template_record['target']
-            template_record['target'] = resolve_variables(
-                template_record['target'], domain, host, params, 'target')
-            if not is_valid_target_redir(template_record['target']):
+        elif record_type in ['REDIR301', 'REDIR302']:
+            orig_target = fields['target'].raw
+            resolved['target'] = fields['target'].resolve(binding, 'target')
+            if not is_valid_target_redir(resolved['target']):
                 raise InvalidData('Invalid data for {} '
                                   'target: {} '
-                                  '(from {})'.format(template_record_type, template_record["target"], orig_target))
-
+                                  '(from {})'.format(record_type, resolved["target"], orig_target))
 
         # Resolve ttl variable substitution for all record types that have ttl
-        if 'ttl' in template_record:
-            raw_ttl = str(template_record['ttl'])
-            if not _is_int_field(raw_ttl):
-                raise InvalidData(
-                    'Invalid ttl value (must be an integer or a single %variable%): ' +
-                    raw_ttl)
-            template_record['ttl'] = resolve_variables(raw_ttl, domain, host, params, 'ttl')
+        if 'ttl' in fields:
+            self._resolve_int(resolved, 'ttl', binding)
 
         # SRV has a few more records that need to be processed and validated
-        if template_record_type == 'SRV':
-            orig_protocol = template_record['protocol']
-            template_record['protocol'] = resolve_variables(
-                template_record['protocol'], domain, host, params, 'protocol')
+        if record_type == 'SRV':
+            orig_protocol = fields['protocol'].raw
+            resolved['protocol'] = fields['protocol'].resolve(binding, 'protocol')
 
-            protocol = template_record['protocol'].lower()
+            protocol = resolved['protocol'].lower()
             if protocol[0] == '_':
                 protocol = protocol[1:]
             if protocol not in ['tcp', 'udp', 'tls']:
                 raise InvalidData('Invalid data for SRV protocol: ' +
-                                  template_record['protocol'] +
+                                  resolved['protocol'] +
                                   ' (from ' + orig_protocol + ')')
 
-            orig_service = template_record['service']
-            template_record['service'] = resolve_variables(
-                template_record['service'], domain, host, params, 'service')
-            if not is_valid_pointsTo_host(template_record['service']):
+            orig_service = fields['service'].raw
+            resolved['service'] = fields['service'].resolve(binding, 'service')
+            if not is_valid_pointsTo_host(resolved['service']):
                 raise InvalidData('Invalid data for SRV service: ' +
-                                  template_record['service'] +
+                                  resolved['service'] +
                                   ' (from ' + orig_service + ')')
 
             for _field in ('priority', 'weight', 'port'):
-                raw = str(template_record[_field])
-                if not _is_int_field(raw):
-                    raise InvalidData(
-                        'Invalid {} value (must be an integer or a single %variable%): {}'.format(
-                            _field, raw))
-                template_record[_field] = resolve_variables(
-                    raw, domain, host, params, _field)
+                self._resolve_int(resolved, _field, binding)
 
         # Handle variables in a TXT and SPFM record
-        if template_record_type == 'TXT':
-            template_record['data'] = resolve_variables(
-                template_record['data'], domain, host, params, 'data')
-
-        if template_record_type == 'SPFM':
-            template_record['spfRules'] = resolve_variables(
-                template_record['spfRules'], domain, host, params, 'spfRules')
-
-        if is_custom:
-            template_record['data'] = resolve_variables(
-                template_record['data'], domain, host, params, 'data')
-            if not template_record['data'] or template_record['data'] == '':
-                raise InvalidData(f'Empty data for custom RR type {template_record_type}')
-            if template_record['data'] == '@':
-                raise InvalidData(f'Invalid data "@" for custom RR type {template_record_type}')
-
-        # Handle the proper processing for each template record type
-        if template_record_type in ['SPFM']:
-            new_record = process_spfm_record(template_record, zone_records)
-        elif template_record_type in ['TXT']:
-            new_record = process_txt_record(template_record, zone_records)
-        elif template_record_type in ['SRV']:
-            new_record = process_srv_record(template_record, zone_records)
-        elif template_record_type in ['REDIR301', 'REDIR302']:
-            new_record = process_redir_record(template_record, zone_records)
-        elif template_record_type == 'APEXCNAME':
-            new_record = process_apexcname_record(template_record, zone_records)
-        elif is_custom:
-            new_record = process_custom_record(template_record, zone_records)
-        else:
-            if template_record_type in ['NS']:
-                new_record = process_ns(template_record, zone_records)
-            else:
-                new_record = process_other_record(template_record, zone_records)
-
-        if new_record:
-            check_conflict_with_self(new_record, new_records)
-
-        if new_record is not None:
-            # Setting any record type that isn't an NS record has an extra delete
-            # rule.
-            #
-            # We should delete any NS records at the same host.
-            #
-            # So if we set bar, foo.bar, www.foo.bar it should delete NS records
-            # of bar. But not xbar.
-            if (template_record_type != 'NS' and
-                new_record['name'] != '@'):
-
-                # Delete any records 
-                for zone_record in zone_records:
-                    if zone_record['type'].upper() == 'NS':
-                        zone_record_name = zone_record['name'].lower()
-
-                        if ((new_record['name'] == zone_record_name or
-                            new_record['name'].endswith('.' + zone_record_name)) and
-                            '_replace' not in zone_record):
+        if record_type == 'TXT':
+            resolved['data'] = fields['data'].resolve(binding, 'data')
+
+        if record_type == 'SPFM':
+            resolved['spfRules'] = fields['spfRules'].resolve(binding, 'spfRules')
+
+        if self.is_custom:
+            resolved['data'] = fields['data'].resolve(binding, 'data')
+            if not resolved['data'] or resolved['data'] == '':
+                raise InvalidData(f'Empty data for custom RR type {record_type}')
+            if resolved['data'] == '@':
+                raise InvalidData(f'Invalid data "@" for custom RR type {record_type}')
+
+        return resolved
+
+
+class ChangeSet(collections.namedtuple('ChangeSet', ['new_records', 'deleted_records'])):
+    """
+    The changes of applying a template, without the final records of the zone.
+
+    Returned instead of the (new_records, deleted_records, final_records)
+    tuple when a template is applied with diff_only.
+    """
+
+    __slots__ = ()
+
+    @property
+    def new_count(self):
+        """ The number of records to add """
+        return len(self.new_records)
+
+    @property
+    def deleted_count(self):
+        """ The number of records to delete """
+        return len(self.deleted_records)
+
+
+class CompiledTemplate(object):
+    """
+    The records of a template prepared once for repeated application.
+
+    Compiling expands REDIR301/REDIR302 records into their redirect records,
+    tokenises every field into literal segments and variable slots and
+    selects the processor and validators of every record. Applying it binds
+    the domain, host and params and evaluates the records without copying
+    or re-parsing the template, so one instance should be kept per template
+    and reused.
+
+    The template records are not modified and must not be modified while
+    the compiled template is in use.
+
+    :param template_records: A list of template records to process.
+    :type template_records: list
+        - elements: dict
+        - keys: 'type', 'host', 'data', 'txtConflictMatchingMode', 'txtConflictMatchingPrefix'
+
+    :param redirect_records: A list of redirection records related to the template records.
+    :type redirect_records: list
+        - elements: dict
+        - keys: 'type', 'name', 'data'
+
+    :raises: InvalidTemplate if the template has REDIR301/REDIR302 records and redirect_records is None
+    """
+
+    def __init__(self, template_records, redirect_records=None):
+        # We can only handle certain record types
+        supported = ['A', 'AAAA', 'MX', 'CNAME', 'APEXCNAME', 'TXT', 'SRV', 'SPFM', 'NS']
+        if redirect_records is not None:
+            supported += ['REDIR301', 'REDIR302']
+
+        # first resolve REDIR301/REDIR302 records to their corresponding equivalents
+        expanded = []
+        for template_record in template_records:
+            if template_record['type'] in ['REDIR301', 'REDIR302']:
+                if redirect_records is None:
+                    raise InvalidTemplate('REDIR301/REDIR302 record types not implemented by the client. redirect_records parameter missing.')
+                repl_records = copy.deepcopy(redirect_records)
+                record_attributes = template_record.copy()
+                del record_attributes['type']
+                for attr in ['data', 'target', 'pointsTo']:
+                    if attr in record_attributes:
+                        del record_attributes[attr]
+                for r in repl_records:
+                    r.update(record_attributes)
+
+                expanded += repl_records
+            expanded += [template_record]
+
+        self.records = [_CompiledRecord(template_record, supported)
+                        for template_record in expanded]
+
+        self.group_ids = []
+        for compiled_record in self.records:
+            if compiled_record.has_group and compiled_record.group_id not in self.group_ids:
+                self.group_ids.append(compiled_record.group_id)
+
+    def apply(self, zone_records, domain, host, params, group_ids=None,
+              multi_aware=False, multi_instance=False, provider_id=None,
+              service_id=None, unique_id=None, diff_only=False):
+        """
+        Apply the template to a zone.
+
+        The parameters and the return value are those of process_records.
+
+        :return: A tuple containing the new records, deleted records, and final records,
+            or the ChangeSet with diff_only.
+        :rtype: tuple | ChangeSet
+        """
+
+        binding = _Binding(domain, host, params)
+
+        if isinstance(zone_records, NormalisedZone):
+            with zone_records._lock:
+                try:
+                    result = self._apply(zone_records.records, zone_records.index, binding,
+                                         self._resolve(binding, group_ids), multi_aware,
+                                         multi_instance, provider_id, service_id, unique_id,
+                                         True, not diff_only)
+                finally:
+                    zone_records._reset()
+            return ChangeSet(*result[:2]) if diff_only else result
+
+        # Work on a normalised copy of zone_records so the caller's list is not mutated.
+        zone_records = [_normalise_record(zr) for zr in zone_records]
+
+        # Index the zone by name and type so conflict detection is a lookup
+        zone_index = _ZoneIndex(zone_records)
+
+        result = self._apply(zone_records, zone_index, binding,
+                             self._resolve(binding, group_ids), multi_aware,
+                             multi_instance, provider_id, service_id, unique_id, False,
+                             not diff_only)
+        return ChangeSet(*result[:2]) if diff_only else result
+
+    def apply_stream(self, zone_records, domain, host, params, group_ids=None,
+                     multi_aware=False, multi_instance=False, provider_id=None,
+                     service_id=None, unique_id=None, final_records=True):
+        """
+        Apply the template to a zone read as a stream.
+
+        The records of the template are resolved first, so the names they
+        touch are known. The zone is then read once and only the records the
+        template can conflict with are kept: records at those names, NS
+        records above them, records below an NS record of the template,
+        records with '_dc' provenance if multi_aware, and records already
+        marked '_delete' or '_replace'. The new and deleted records are those
+        of process_records.
+
+        :param zone_records: The records in the zone. With final_records, an
+            iterable that can be iterated again and yields the same records in
+            the same order, e.g. a list or a query that is run again.
+            Otherwise any iterable, e.g. a generator over a database cursor.
+        :type zone_records: iterable
+            - elements: dict
+        :param final_records: Whether to return the final records.
+        :type final_records: bool
+
+        The other parameters are those of process_records.
+
+        :return: A tuple containing the new records, deleted records, and
+            final records. The final records are an iterator that reads the
+            zone again as it is consumed, or None without final_records.
+        :rtype: tuple(list, list, iterator or None)
+
+        :raises: ValueError if final_records is set and zone_records is an iterator
+        """
+        if final_records and iter(zone_records) is zone_records:
+            raise ValueError('zone_records must be iterable more than once to stream the final records')
+
+        binding = _Binding(domain, host, params)
+
+        # Resolve ahead, raising any error only where apply would raise it
+        resolved = []
+        error = None
+        try:
+            for item in self._resolve(binding, group_ids):
+                resolved.append(item)
+        except Exception as e:
+            error = e
+
+        relevant = _RelevantNames(resolved)
+        kept = []
+        positions = []
+        for position, zone_record in enumerate(zone_records):
+            if relevant.keep(zone_record, multi_aware):
+                kept.append(_normalise_record(zone_record))
+                positions.append(position)
+
+        new_records, deleted_records, _ = self._apply(
+            kept, _ZoneIndex(kept), binding, _replay(resolved, error), multi_aware,
+            multi_instance, provider_id, service_id, unique_id, False, False)
+
+        if not final_records:
+            return new_records, deleted_records, None
+        return new_records, deleted_records, _stream_final_records(
+            new_records, zone_records, dict(zip(positions, kept)))
+
+    def _resolve(self, binding, group_ids):
+        """Yield the records of the groups applied with their variables resolved."""
+        for compiled_record in self.records:
+
+            # If we passed in a group, only apply records from the group
+            if (group_ids and
+                compiled_record.has_group and
+                compiled_record.group_id not in group_ids):
+                continue
+
+            # Deal with the variables and validation
+            yield compiled_record, compiled_record.resolve(binding)
+
+    def _apply(self, zone_records, zone_index, binding, resolved, multi_aware,
+               multi_instance, provider_id, service_id, unique_id, shared, final=True):
+        """
+        Apply the resolved template records to normalised zone records.
+
+        If the records are shared with later applications, the deleted
+        records are returned as copies, as the marks are cleared afterwards.
+        Without final, None is returned for the final records.
+        """
+        host = binding.host
+
+        # If we are multi aware, we should remove the previous instances of the
+        # template
+        if multi_aware and not multi_instance:
+            zone_index.provenance().mark_replaced(provider_id, service_id, host)
+
+        # This will contain the new records
+        new_records = []
+        # The new records indexed for check_conflict_with_self
+        conflict_index = _SelfConflictIndex()
+
+        # Process each record in the template
+        for compiled_record, template_record in resolved:
+            template_record_type = compiled_record.type
+
+            # Handle the proper processing for each template record type
+            new_record = compiled_record.processor(template_record, zone_index)
+
+            if new_record:
+                check_conflict_with_self(new_record, conflict_index)
+
+            if new_record is not None:
+                # Setting any record type that isn't an NS record has an extra delete
+                # rule.
+                #
+                # We should delete any NS records at the same host.
+                #
+                # So if we set bar, foo.bar, www.foo.bar it should delete NS records
+                # of bar. But not xbar.
+                if (template_record_type != 'NS' and
+                    new_record['name'] != '@'):
+
+                    # Delete any records 
+                    for zone_record in zone_index.ancestors(new_record['name'], ['NS']):
+                        if '_replace' not in zone_record:
                             zone_record['_delete'] = 1
-                
 
-            # If we are muti aware, store the information about the template
-            #used
-            if multi_aware:
-                if 'essential' in template_record:
-                    essential = template_record['essential']
+                # If we are muti aware, store the information about the template
+                #used
+                if multi_aware:
+                    if 'essential' in template_record:
+                        essential = template_record['essential']
+                    else:
+                        essential = 'Always'
+
+                    new_record['_dc'] = {'id': unique_id,
+                                        'providerId': provider_id,
+                                        'serviceId': service_id,
+                                        'host': host,
+                                        'essential': essential}
+
+                new_record = _normalise_record(new_record)
+                if not multi_aware and _find_identical_zone_record(new_record, zone_index):
+                    # The record already exists unchanged and is not being removed —
+                    # skip the add.
+                    pass
                 else:
-                    essential = 'Always'
-
-                new_record['_dc'] = {'id': unique_id,
-                                    'providerId': provider_id,
-                                    'serviceId': service_id,
-                                    'host': host,
-                                    'essential': essential}
-
-            new_record = _normalise_record(new_record)
-            if not multi_aware and _find_identical_zone_record(new_record, zone_records):
-                # The record already exists unchanged and is not being removed —
-                # skip the add.
-                pass
-            else:
-                new_records.append(new_record)
+                    new_records.append(new_record)
+                    conflict_index.add(new_record)
+
+        # If we are multi aware, we need to cascade deletes
+        if multi_aware:
+            zone_index.provenance().cascade_deletes()
 
-    # If we are multi aware, we need to cascade deletes
-    if multi_aware:
+        # Now compute the final list of records in the zone, and the records to be
+        # deleted
+        deleted_records = []
+        final_records = list(new_records) if final else None
 
         for zone_record in zone_records:
+            if '_replace' in zone_record or '_delete' in zone_record:
+                deleted_records.append(dict(zone_record) if shared else zone_record)
+            elif final:
+                final_records.append(zone_record)
 
-            # If the record is marked for deletion and is essential to
-            # the service, we cascade
-            if ('_delete' in zone_record and
-                '_dc' in zone_record and
-                'essential' in zone_record['_dc'] and
-                zone_record['_dc']['essential'] == 'Always'):
-                
-                for zone_record2 in zone_records:
-                    if ('_dc' in zone_record2 and 
-                        zone_record['_dc']['providerId'] == zone_record2['_dc']['providerId'] and
-                        zone_record['_dc']['serviceId'] == zone_record2['_dc']['serviceId'] and \
-                        zone_record['_dc']['host'] == zone_record2['_dc']['host']):
-                        
-                        zone_record2['_delete'] = 1
+        return new_records, deleted_records, final_records
+
+
+def _replay(resolved, error):
+    """Yield records resolved ahead, then raise the error that stopped the resolution."""
+    for item in resolved:
+        yield item
+    if error is not None:
+        raise error
 
-    # Now compute the final list of records in the zone, and the records to be
-    # deleted
-    deleted_records = []
-    final_records = []
 
+def _stream_final_records(new_records, zone_records, kept):
+    """
+    Yield the new records, then the zone records read again, normalised, leaving out
+    the deleted ones. kept maps the position of a record kept by apply_stream to it.
+    """
     for new_record in new_records:
-        final_records.append(new_record)
+        yield new_record
+    for position, zone_record in enumerate(zone_records):
+        kept_record = kept.get(position)
+        if kept_record is None:
+            yield _normalise_record(zone_record)
+        elif '_replace' not in kept_record and '_delete' not in kept_record:
+            yield kept_record
 
-    for zone_record in zone_records:
-        if  '_replace' in zone_record:
-           deleted_records.append(zone_record)
-        elif '_delete' in zone_record:
-            deleted_records.append(zone_record)
-        else:
-            final_records.append(zone_record)
-            
-    return new_records, deleted_records, final_records
+
+class _RelevantNames(object):
+    """
+    The zone names the resolved records of a template can conflict with.
+
+    A zone record is relevant if it is at the name of a template record, if it
+    is an NS record at a name above one, or if it is at or below the name of
+    an NS template record.
+
+    :param resolved: The template records with their variables resolved
+    :type resolved: list(tuple(_CompiledRecord, dict))
+    """
+
+    def __init__(self, resolved):
+        self.names = set()
+        self.ns_names = set()
+        for compiled_record, template_record in resolved:
+            if compiled_record.type == 'APEXCNAME':
+                self.names.add('@')
+            for key in ('host', 'name'):
+                value = template_record.get(key)
+                if isinstance(value, str):
+                    self.names.add(value.lower())
+                    if compiled_record.type == 'NS':
+                        self.ns_names.add(value.lower())
+        self.ancestors = set()
+        for name in self.names:
+            self.ancestors.update(_dot_suffixes(name))
+
+    def keep(self, zone_record, multi_aware):
+        """Return whether apply_stream must keep a zone record."""
+        if '_delete' in zone_record or '_replace' in zone_record:
+            return True
+        if multi_aware and '_dc' in zone_record:
+            return True
+        name = zone_record.get('name', '').lower()
+        if name in self.names:
+            return True
+        if zone_record['type'].upper() == 'NS' and name in self.ancestors:
+            return True
+        if self.ns_names:
+            if name in self.ns_names:
+                return True
+            for suffix in _dot_suffixes(name):
+                if suffix in self.ns_names:
+                    return True
+        return False
+
+
+def process_records(template_records, zone_records, domain, host, params,
+                    group_ids, multi_aware=False, multi_instance=False,
+                    provider_id=None, service_id=None, unique_id=None,
+                    redirect_records=None, diff_only=False):
+    """
+    Process template records and generate new records and deletion rules for a zone.
+
+    :param template_records: A list of template records to process.
+    :type template_records: list
+        - elements: dict
+        - keys: 'type', 'host', 'data', 'txtConflictMatchingMode', 'txtConflictMatchingPrefix'
+
+    :param zone_records: A list of all records in the current zone.
+        Records are normalised (string field values lowercased, 'type' uppercased,
+        with the exception of 'data' for TXT and custom RR types) into a working
+        copy before processing begins; the caller's list is not mutated.
+        Pass a NormalisedZone to normalise a zone once for many applications.
+    :type zone_records: list | NormalisedZone
+        - elements: dict
+        - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
+
+    :param domain: The domain for which to process the template records.
+    :type domain: str
+
+    :param host: The host for which to process the template records.
+    :type host: str
+
+    :param params: Additional parameters for processing the template records.
+    :type params: dict
+        - keys: 'param1', 'param2', ...
+
+    :param group_ids: A list of group IDs to apply.
+    :type group_ids: list
+
+    :param multi_aware: Whether to process the template records in a multi-aware manner.
+    :type multi_aware: bool
+        - default: False
+
+    :param multi_instance: Whether to process the template records in a multi-instance manner.
+    :type multi_instance: bool
+        - default: False
+
+    :param provider_id: The ID of the provider for which to process the template records.
+    :type provider_id: str | int | None
+
+    :param service_id: The ID of the service for which to process the template records.
+    :type service_id: str | int | None
+
+    :param unique_id: The unique ID of the template instance (for multi-aware application).
+    :type unique_id: str | int | None
+
+    :param redirect_records: A list of redirection records related to the template records.
+    :type redirect_records: list
+        - elements: dict
+        - keys: 'type', 'name', 'data'
+
+    :param diff_only: Whether to return only the changes as a ChangeSet,
+        without building the final records.
+    :type diff_only: bool
+        - default: False
+
+    :return: A tuple containing the new records, deleted records, and final records,
+        or the ChangeSet with diff_only.
+    :rtype: tuple | ChangeSet
+
+    :raises: Exception if any of the input parameters are invalid
+
+    The template records are not modified. To apply the same records many
+    times build a CompiledTemplate once and call its apply method instead.
+    """
+
+    return CompiledTemplate(template_records, redirect_records).apply(
+        zone_records, domain, host, params, group_ids, multi_aware,
+        multi_instance, provider_id, service_id, unique_id, diff_only)
+
+
+def process_records_stream(template_records, zone_records, domain, host, params,
+                           group_ids, multi_aware=False, multi_instance=False,
+                           provider_id=None, service_id=None, unique_id=None,
+                           redirect_records=None, final_records=True):
+    """
+    Process template records against a zone read as a stream.
+
+    Only the zone records the template can conflict with are held in memory,
+    see CompiledTemplate.apply_stream.
+
+    :param zone_records: The records in the zone. With final_records, an
+        iterable that yields the same records each time it is iterated;
+        otherwise any iterable.
+    :type zone_records: iterable
+        - elements: dict
+    :param final_records: Whether to return the final records, as an
+        iterator that reads zone_records again.
+    :type final_records: bool
+
+    The other parameters are those of process_records.
+
+    :return: A tuple containing the new records, deleted records, and final
+        records (an iterator, or None without final_records).
+    :rtype: tuple
+
+    :raises: ValueError if final_records is set and zone_records is an iterator
+    """
+
+    return CompiledTemplate(template_records, redirect_records).apply_stream(
+        zone_records, domain, host, params, group_ids, multi_aware,
+        multi_instance, provider_id, service_id, unique_id, final_records)
 
 
 #--------------------------------------------------
@@ -1256,6 +2122,149 @@ def get_records_variables(template_records, group=None):
     return params
 
 
+def _file_signature(path):
+    """ Returns what identifies a version of a file: its mtime, size and inode """
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size, st.st_ino
+
+
+def _redir_key(redir_template_records):
+    """ Returns a hashable key for a list of redirect template records """
+    if redir_template_records is None:
+        return None
+    return json.dumps(redir_template_records, sort_keys=True, default=str)
+
+
+class _TemplateCacheEntry(object):
+    """ A template file in a TemplateCache: its signature, template and compiled templates """
+
+    def __init__(self, signature, data):
+        self.signature = signature
+        self.data = data
+        # _redir_key(redir_template_records) -> CompiledTemplate
+        self.compiled = {}
+
+    def compiled_template(self, redir_template_records):
+        """ Gets the template compiled with the redirect records, compiling it on first use """
+        key = _redir_key(redir_template_records)
+        compiled = self.compiled.get(key)
+        if compiled is None:
+            # setdefault so threads compiling at once end up sharing one
+            compiled = self.compiled.setdefault(
+                key, CompiledTemplate(self.data['records'], redir_template_records))
+        return compiled
+
+
+class TemplateCache(object):
+    """
+    A cache of parsed and compiled template files, keyed by file path.
+
+    A file is read again when its modification time, size or inode changed.
+    Templates of a bundle are kept by bundle path and file name, and taken
+    again when the bundle file was replaced.
+    When the cache holds max_size templates the least recently used one is
+    dropped. The cached template dicts are shared by every DomainConnect
+    reading the file and must not be modified. So is the CompiledTemplate of
+    a file, built once for each list of redirect template records. The cache
+    can be shared between threads.
+
+    :param max_size: Maximum number of templates kept
+    :type max_size: int
+    """
+
+    def __init__(self, max_size=256):
+        self.max_size = max_size
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, filepath):
+        """
+        Gets the parsed template of a file, reading it only if it changed.
+
+        :param filepath: The path of the template file
+        :type filepath: str
+
+        :return: The template
+        :rtype: dict
+
+        :raises: OSError: If the file cannot be read
+        :raises: ValueError: If the file is not valid JSON
+        """
+        return self._entry(filepath).data
+
+    def _entry(self, filepath):
+        """ Gets the entry of a file, reading it only if it changed """
+        def read():
+            with open(filepath, 'r') as file_:
+                return json.load(file_)
+        return self._lookup(filepath, _file_signature(filepath), read)
+
+    def _bundled_entry(self, bundle, bundle_entry):
+        """ Gets the entry of a template of a bundle, new when the bundle file was replaced """
+        return self._lookup((bundle.bundle_path, bundle_entry['fileName']), bundle.signature,
+                            lambda: bundle_entry['template'])
+
+    def _lookup(self, key, signature, read):
+        """ Gets the entry of key if its signature is unchanged, else makes one with read """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry.signature == signature:
+                self._entries.move_to_end(key)
+                self._hits += 1
+                return entry
+            self._misses += 1
+
+        entry = _TemplateCacheEntry(signature, read())
+
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+        return entry
+
+    def stats(self):
+        """
+        Returns the counters of the cache.
+
+        :return: hits and misses of get, and the number of templates kept as size
+        :rtype: dict
+        """
+        with self._lock:
+            return {'hits': self._hits, 'misses': self._misses, 'size': len(self._entries)}
+
+    def reset_stats(self):
+        """ Sets the counters back to zero """
+        self._hits = 0
+        self._misses = 0
+
+    def clear(self):
+        """ Drops all cached templates """
+        with self._lock:
+            self._entries.clear()
+
+
+# The cache DomainConnect reads template files through
+template_file_cache = TemplateCache()
+
+
+def _read_bundled_template(bundle_path, provider_id, service_id, template_cache):
+    """ Gets the TemplateCache entry of a template from a template bundle file """
+    try:
+        bundle = open_bundle(bundle_path)
+    except (OSError, ValueError):
+        raise InvalidTemplate('Template bundle \'{}\' not readable'.format(os.path.abspath(bundle_path)))
+    entry = bundle.get(provider_id, service_id)
+    if entry is None:
+        raise InvalidTemplate('Template {} / {} not found in bundle \'{}\''.format(
+            provider_id, service_id, os.path.abspath(bundle_path)))
+    return template_cache._bundled_entry(bundle, entry)
+
+
 class DomainConnect(object):
     """
     Two main entry points.
@@ -1269,7 +2278,8 @@ class DomainConnect(object):
                  template_path=None,  # Path to template directory
                  template=None,  # Template data (if not using a file-based template)
                  redir_template_records=None,  # Redirect template records
-                 apply_redir=None):  # Apply redirect flag
+                 apply_redir=None,  # Apply redirect flag
+                 template_cache=None):  # Cache to read the template file through
 
         """
         Initializes the DomainConnect object.
@@ -1280,7 +2290,7 @@ class DomainConnect(object):
         :param service_id: Service ID (required if not using a template)
         :type service_id: str
 
-        :param template_path: Path to template directory
+        :param template_path: Path to template directory, or to a template bundle file (see bundleutil)
         :type template_path: str
 
         :param template: Template data (if not using a file-based template)
@@ -1292,12 +2302,17 @@ class DomainConnect(object):
         :param apply_redir: Apply redirect flag
         :type apply_redir: bool
 
+        :param template_cache: Cache to read the template file through. Defaults to the process-wide template_file_cache.
+        :type template_cache: TemplateCache
+
         :raises: InvalidTemplate: If either provider_id and service_id are missing, or if the template cannot be read.
         """
         if (provider_id is None or service_id is None) and template is None:
             raise InvalidTemplate("Provide either providerId and ServiceId or template.")
         self._redir_template_records = redir_template_records
         self._apply_redir = apply_redir
+        # The TemplateCache entry of a template read from a file
+        self._template_entry = None
 
         # Read in the template
         if template is None:
@@ -1309,21 +2324,56 @@ class DomainConnect(object):
             else:
                 directory = template_path
 
-            basename = provider_id.lower() + '.' + service_id.lower() + '.json'
-            filepath = os.path.join(directory, basename)
+            if template_cache is None:
+                template_cache = template_file_cache
 
-            if not os.path.isfile(filepath) or not os.access(filepath, os.R_OK):
-                raise InvalidTemplate('Template file \'{}\' not found or unreadable'.format(os.path.abspath(filepath)))
+            if os.path.isfile(directory):
+                self._template_entry = _read_bundled_template(
+                    directory, provider_id, service_id, template_cache)
+                self.data = self._template_entry.data
+            else:
+                basename = provider_id.lower() + '.' + service_id.lower() + '.json'
+                filepath = os.path.join(directory, basename)
 
-            with open(filepath, 'r') as file_:
-                self.data = json.load(file_)
+                if not os.path.isfile(filepath) or not os.access(filepath, os.R_OK):
+                    raise InvalidTemplate('Template file \'{}\' not found or unreadable'.format(os.path.abspath(filepath)))
+
+                self._template_entry = template_cache._entry(filepath)
+                self.data = self._template_entry.data
         else:
             self.data = template
             self.provider_id = template['providerId']
             self.service_id = template['serviceId']
 
+        self._compiled_template = None
+
+    @property
+    def compiled_template(self):
+        """
+        The records of the template compiled for application.
+
+        Built once per template and reused by every apply_template call, so the
+        template data must not be modified after the template was applied.
+        For a template read from a file it is kept in the TemplateCache next
+        to the template data, so every DomainConnect reading the same version
+        of the file with the same redirect records shares one.
+
+        :return: The compiled template records
+        :rtype: CompiledTemplate
+
+        :raises: InvalidTemplate: If the template has REDIR301/REDIR302 records but no redirect template records were given.
+        """
+        if self._compiled_template is None:
+            if self._template_entry is not None:
+                self._compiled_template = self._template_entry.compiled_template(
+                    self._redir_template_records)
+            else:
+                self._compiled_template = CompiledTemplate(
+                    self.data['records'], self._redir_template_records)
+        return self._compiled_template
+
 
-    def verify_sig(self, qs, sig, key, ignore_signature=False):
+    def verify_sig(self, qs, sig, key, ignore_signature=False, key_source=None):
         """
         This method will verify a signature of a query string.
 
@@ -1336,7 +2386,9 @@ class DomainConnect(object):
         key from DNS.
 
         The public key is published in DNS in the zone specified in
-        syncPubKeyDomain from the template at the host <key>.
+        syncPubKeyDomain from the template at the host <key>. By default keys
+        are read through sigutil.publickey_cache, which keeps them for the TTL
+        of their records.
 
         This method will raise an exception if the signature fails.
         It will return if it succeeds.
@@ -1353,6 +2405,41 @@ class DomainConnect(object):
         :param ignore_signature: If set, this method will return without verifying the signature
         :type ignore_signature: bool
 
+        :param key_source: The source to read the public key from instead of sigutil.publickey_cache (optional)
+        :type key_source: sigutil.KeySource
+
+        :raises: InvalidSignature: If the signature fails verification
+        """
+
+        if ignore_signature:
+            return
+
+        if not qs or not sig or not key:
+            raise InvalidSignature('Missing data for signature verification')
+
+        syncPubKeyDomain = self.data['syncPubKeyDomain']
+        if key_source is None:
+            key_source = publickey_cache
+        pubKey = key_source.get(key + '.' + syncPubKeyDomain)
+
+        if not pubKey:
+            msg = ('Unable to get public key for template/key from ' + key +
+                   '.' + syncPubKeyDomain)
+            raise InvalidSignature(msg)
+
+        if not verify_sig(pubKey, sig, qs):
+            raise InvalidSignature('Signature not valid')
+
+    async def verify_sig_async(self, qs, sig, key, ignore_signature=False, key_source=None):
+        """
+        This method will verify a signature of a query string from a coroutine.
+
+        Works like verify_sig, but the public key is read without blocking
+        the event loop. Concurrent verifications needing the same key that
+        is not cached yet share one lookup.
+
+        All parameters are those of verify_sig.
+
         :raises: InvalidSignature: If the signature fails verification
         """
 
@@ -1363,7 +2450,9 @@ class DomainConnect(object):
             raise InvalidSignature('Missing data for signature verification')
 
         syncPubKeyDomain = self.data['syncPubKeyDomain']
-        pubKey = get_publickey(key + '.' + syncPubKeyDomain)
+        if key_source is None:
+            key_source = publickey_cache
+        pubKey = await key_source.get_async(key + '.' + syncPubKeyDomain)
 
         if not pubKey:
             msg = ('Unable to get public key for template/key from ' + key +
@@ -1376,12 +2465,12 @@ class DomainConnect(object):
     def apply_template(self, zone_records, domain, host, params,
                         group_ids=None, qs=None, sig=None, key=None,
                         ignore_signature=False, multi_aware=False,
-                        unique_id=None):
+                        unique_id=None, key_source=None, diff_only=False):
         """
         Will apply the template to the zone.
 
-        :param zone_records: A list of dictionaries containing an copy of all the records in the zone for the domain.
-        :type zone_records: list
+        :param zone_records: A list of dictionaries containing an copy of all the records in the zone for the domain, or the zone normalised once for many applications.
+        :type zone_records: list | NormalisedZone
             - elements: dict
             - keys: 'type', 'name', 'data', '_delete' (optional), 'ttl' (optional)
 
@@ -1417,14 +2506,66 @@ class DomainConnect(object):
         :param unique_id: Id of the template instance if provided and multi_aware is True (optional).
         :type unique_id: str
 
-        :return: A tuple containing three values:
+        :param key_source: The source to read the public key from for signature verification (optional). Defaults to sigutil.publickey_cache.
+        :type key_source: sigutil.KeySource
+
+        :param diff_only: Flag to return only the changes as a ChangeSet, without computing the final records (optional). Defaults to False.
+        :type diff_only: bool
+
+        :return: A tuple containing three values, or a ChangeSet of the first two with diff_only:
             - new_records: The new records to be added to the zone
             - deleted_records: The records that should be deleted from the zone
             - final_records: All records that would be in the zone
-        :rtype: tuple
+        :rtype: tuple | ChangeSet
             - elements: list, list, list
         """
 
+        domain, host = self._apply_target(domain, host)
+
+        # See if the template requires a signature
+        if ('syncPubKeyDomain' in self.data and
+            self.data['syncPubKeyDomain']):
+            self.verify_sig(qs, sig, key, ignore_signature, key_source)
+
+        return self._apply_records(zone_records, domain, host, params,
+                                   group_ids, multi_aware, unique_id, diff_only)
+
+    async def apply_template_async(self, zone_records, domain, host, params,
+                                   group_ids=None, qs=None, sig=None, key=None,
+                                   ignore_signature=False, multi_aware=False,
+                                   unique_id=None, key_source=None, executor=None,
+                                   diff_only=False):
+        """
+        Will apply the template to the zone from a coroutine.
+
+        Works like apply_template, but the public key for signature
+        verification is read without blocking the event loop.
+
+        :param executor: Executor to process the records in (optional). By default the records are processed in the event loop thread.
+        :type executor: concurrent.futures.Executor
+
+        All other parameters and the return value are those of apply_template.
+        """
+
+        domain, host = self._apply_target(domain, host)
+
+        # See if the template requires a signature
+        if ('syncPubKeyDomain' in self.data and
+            self.data['syncPubKeyDomain']):
+            await self.verify_sig_async(qs, sig, key, ignore_signature, key_source)
+
+        if executor is None:
+            return self._apply_records(zone_records, domain, host, params,
+                                       group_ids, multi_aware, unique_id, diff_only)
+
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(
+            executor, self._apply_records, zone_records, domain, host, params,
+            group_ids, multi_aware, unique_id, diff_only)
+
+    def _apply_target(self, domain, host):
+        """ Lower cases domain and host and checks a host is given if required """
+
         # Domain and host should be lower cased
         domain = domain.lower()
         if host:
@@ -1436,10 +2577,11 @@ class DomainConnect(object):
             not host):
             raise HostRequired('Template requires a host name')
 
-        # See if the template requires a signature
-        if ('syncPubKeyDomain' in self.data and
-            self.data['syncPubKeyDomain']):
-            self.verify_sig(qs, sig, key, ignore_signature)
+        return domain, host
+
+    def _apply_records(self, zone_records, domain, host, params, group_ids,
+                       multi_aware, unique_id, diff_only=False):
+        """ Applies the records of the template once the signature was checked """
 
         # If we are mulit-template aware, generate a unique id for application of this template
         # and determine if the template supports multi-instance
@@ -1452,11 +2594,53 @@ class DomainConnect(object):
                 multi_instance = self.data['multiInstance']
             
         # Process the records in the template
-        return process_records(copy.deepcopy(self.data['records']), zone_records,
-                               domain, host, params, group_ids,
-                               multi_aware, multi_instance,
-                               self.provider_id, self.service_id, unique_id,
-                               redirect_records=self._redir_template_records)
+        return self.compiled_template.apply(zone_records, domain, host, params,
+                                            group_ids, multi_aware, multi_instance,
+                                            self.provider_id, self.service_id, unique_id,
+                                            diff_only)
+
+    def apply_template_batch(self, jobs, processes=None, chunksize=16, max_pending=None):
+        """
+        Will apply the template to many zones.
+
+        The template is prepared once and shared by all jobs. Jobs are read
+        from the iterable as results are consumed, so memory stays flat for
+        any number of jobs.
+
+        :param jobs: The applications of the template. Each job is either a tuple of the positional arguments or a dict of the keyword arguments of apply_template.
+        :type jobs: iterable
+            - elements: tuple | dict
+            - e.g. (zone_records, domain, host, params)
+
+        :param processes: Number of worker processes to apply the jobs in (optional). By default the jobs are applied in this process.
+        :type processes: int
+
+        :param chunksize: Number of jobs sent to a worker process at a time (optional). Only used with processes.
+        :type chunksize: int
+
+        :param max_pending: Maximum number of chunks in flight (optional). Defaults to twice the number of worker processes. Only used with processes.
+        :type max_pending: int
+
+        :return: An iterator over the outcome of each job, in the order of the jobs. The outcome is the tuple returned by apply_template, or the exception it raised.
+        :rtype: iterator
+            - elements: tuple | Exception
+        """
+
+        if not processes:
+            for job in jobs:
+                yield apply_job(self, job)
+            return
+
+        if max_pending is None:
+            max_pending = 2 * processes
+
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_batch_worker,
+                                 initargs=(self,)) as executor:
+            for outcomes in submit_chunks(executor, _apply_batch_chunk, jobs,
+                                          chunksize, max_pending, ordered=True):
+                for outcome in outcomes:
+                    yield outcome
 
     def is_sig_required(self):
         """ Will indicate if the template requires a signature """
@@ -1477,3 +2661,39 @@ class DomainConnect(object):
             params[param] = raw_input()
         return params
 
+
+
+def apply_job(domain_connect, job):
+    """
+    Applies the template of a DomainConnect for one job of a batch.
+
+    :param domain_connect: The template to apply
+    :type domain_connect: DomainConnect
+
+    :param job: Either a tuple of the positional arguments or a dict of the keyword arguments of apply_template
+    :type job: tuple | dict
+
+    :return: The tuple returned by apply_template, or the exception it raised
+    :rtype: tuple | Exception
+    """
+    try:
+        if isinstance(job, dict):
+            return domain_connect.apply_template(**job)
+        return domain_connect.apply_template(*job)
+    except Exception as e:
+        return e
+
+
+# The DomainConnect instance of an apply_template_batch worker process
+_batch_domain_connect = None
+
+
+def _init_batch_worker(domain_connect):
+    """ Initializes a worker process of apply_template_batch """
+    global _batch_domain_connect
+    _batch_domain_connect = domain_connect
+
+
+def _apply_batch_chunk(chunk):
+    """ Applies a chunk of jobs in a worker process of apply_template_batch """
+    return [apply_job(_batch_domain_connect, job) for job in chunk]
@@ -1,35 +1,387 @@
+import contextlib
+import copy
+import io
 import json
 import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
 from re import compile, search, match as re_match
 
-from jsonschema import validate, ValidationError
+from jsonschema import FormatChecker
+from jsonschema.exceptions import best_match, relevance
+from jsonschema.validators import validator_for
 
 from domainconnectzone import InvalidTemplate, InvalidData
-from domainconnectzone.DomainConnectImpl import get_records_variables
+from domainconnectzone.bundleutil import is_bundle, open_bundle, write_bundle
+from domainconnectzone.fileutil import atomic_write, locked
+from domainconnectzone.poolutil import submit_chunks
+from domainconnectzone.DomainConnectImpl import get_records_variables, _file_signature
+
+_JSON_WHITESPACE = compile(r'[ \t\n\r]*')
+
+
+def _read_template_ids(path, chunk_size=4096):
+    """
+    Reads the providerId and serviceId of a template file, parsing the file
+    only up to where both were found.
+
+    :return: The providerId and serviceId, or None if the file is not a JSON
+        object with both
+    :rtype: tuple(str, str) or None
+    """
+    decoder = json.JSONDecoder()
+    ids = {}
+    with open(path) as f:
+        text = f.read(chunk_size)
+        eof = len(text) < chunk_size
+        pos = _JSON_WHITESPACE.match(text, 0).end()
+        if text[pos:pos + 1] != '{':
+            return None
+        pos += 1
+        while True:
+            member_start = pos
+            try:
+                pos = _JSON_WHITESPACE.match(text, pos).end()
+                if text[pos] == '}':
+                    return None
+                key, pos = decoder.raw_decode(text, pos)
+                pos = _JSON_WHITESPACE.match(text, pos).end()
+                if text[pos] != ':':
+                    raise ValueError(pos)
+                pos = _JSON_WHITESPACE.match(text, pos + 1).end()
+                value, pos = decoder.raw_decode(text, pos)
+                pos = _JSON_WHITESPACE.match(text, pos).end()
+                if text[pos] not in ',}':
+                    # e.g. a number cut short at the end of the text read
+                    raise ValueError(pos)
+            except (ValueError, IndexError):
+                # the member runs past what was read so far, or the file is broken
+                if eof:
+                    return None
+                more = f.read(len(text))
+                eof = len(more) < len(text)
+                text += more
+                pos = member_start
+                continue
+
+            if key in ('providerId', 'serviceId') and key not in ids:
+                ids[key] = value
+                if len(ids) == 2:
+                    return ids['providerId'], ids['serviceId']
+            if text[pos] == '}':
+                return None
+            pos += 1
+
+
+class TemplateCatalog(object):
+    """
+    An in-memory index of the templates in a template directory.
+
+    Templates are keyed by lowercased (providerId, serviceId). A file is only
+    read again when its modification time, size or inode changed, so
+    refreshing the catalog of an unchanged directory costs one listing and
+    one stat per file. Like DomainConnectTemplates.templates, files with
+    invalid JSON, without providerId and serviceId or named other than
+    <providerid>.<serviceid>.json are left out.
+
+    The template dicts are shared by all callers and must not be modified;
+    copy them first. The catalog can be shared between threads.
+
+    :param template_path: The path to the template directory
+    :type template_path: str
+    """
+
+    def __init__(self, template_path):
+        self._template_path = template_path
+        # fileName -> (stat signature, entry or None for files left out)
+        self._files = {}
+        # (providerid, serviceid) -> entry
+        self._index = {}
+        # fileNames in directory listing order, as dict keys
+        self._order = {}
+        # fileName -> (stat signature, metadata or None), for files not read in full
+        self._metadata = {}
+        # fileNames stored since the last refresh, reported as changed by it
+        self._stored = set()
+        self._lock = threading.Lock()
+
+    def __iter__(self):
+        """ Refreshes the catalog and iterates over its entries in directory listing order """
+        self.refresh()
+        with self._lock:
+            entries = [self._files[name][1] for name in self._order]
+        return iter([entry for entry in entries if entry is not None])
+
+    def __len__(self):
+        with self._lock:
+            return len(self._index)
+
+    def get(self, provider_id, service_id):
+        """
+        Gets the entry of a template, checking only its own file for changes.
+
+        :param provider_id: The providerId of the template, in any case
+        :type provider_id: str
+        :param service_id: The serviceId of the template, in any case
+        :type service_id: str
+
+        :return: The entry with 'providerId', 'serviceId', 'fileName' and
+            'template' keys, or None if there is no such template
+        :rtype: dict or None
+        """
+        file_name = '{}.{}.json'.format(provider_id.lower(), service_id.lower())
+        with self._lock:
+            self._load(file_name)
+            return self._files[file_name][1]
+
+    def metadata(self):
+        """
+        Lists the templates without reading their bodies.
+
+        Files read in full give their ids from the catalog. Other files are
+        parsed only up to their providerId and serviceId, and the ids are kept
+        until the file changes. A file whose JSON is broken after the ids is
+        listed until get reads it in full and returns None for it.
+
+        :return: A 'providerId', 'serviceId' and 'fileName' dict per template,
+            in directory listing order
+        :rtype: list(dict)
+        """
+        names = [r for r in os.listdir(self._template_path) if r.endswith('.json')]
+        listing = []
+        for file_name in names:
+            signature = self._stat(file_name)
+            with self._lock:
+                cached = self._files.get(file_name)
+                if cached is not None and signature is not None and cached[0] == signature:
+                    entry = cached[1]
+                    metadata = None if entry is None else {
+                        "providerId": entry["providerId"],
+                        "serviceId": entry["serviceId"],
+                        "fileName": file_name
+                    }
+                else:
+                    cached = self._metadata.get(file_name)
+                    if cached is not None and signature is not None and cached[0] == signature:
+                        metadata = cached[1]
+                    else:
+                        metadata = self._read_metadata(file_name)
+                        self._metadata[file_name] = (signature, metadata)
+            if metadata is not None:
+                listing.append(metadata)
+
+        listed = set(names)
+        with self._lock:
+            for file_name in [name for name in self._metadata if name not in listed]:
+                del self._metadata[file_name]
+        return listing
+
+    def get_file(self, file_name):
+        """
+        Gets the entry of a template file as last read, without checking the file.
+
+        :param file_name: The name of the file in the template directory
+        :type file_name: str
+
+        :return: The entry, or None if the file was not read or is left out
+        :rtype: dict or None
+        """
+        with self._lock:
+            cached = self._files.get(file_name)
+        return cached[1] if cached is not None else None
+
+    def refresh(self):
+        """
+        Brings the catalog up to date with the template directory.
+
+        :return: The names of the files added, changed or removed
+        :rtype: list(str)
+        """
+        names = [r for r in os.listdir(self._template_path) if r.endswith('.json')]
+        changed = []
+        with self._lock:
+            for file_name in names:
+                if self._load(file_name) or file_name in self._stored:
+                    changed.append(file_name)
+            self._stored.clear()
+            listed = set(names)
+            for file_name in [name for name in self._files if name not in listed]:
+                self._drop(file_name)
+                changed.append(file_name)
+            self._order = dict.fromkeys(names)
+        return changed
+
+    def update(self, file_names):
+        """
+        Brings some files of the catalog up to date, e.g. the ones a file system watch reported.
+
+        :param file_names: The names of the files in the template directory
+        :type file_names: iterable(str)
+
+        :return: The names of the files added, changed or removed
+        :rtype: list(str)
+        """
+        changed = []
+        with self._lock:
+            for file_name in file_names:
+                if not file_name.endswith('.json'):
+                    continue
+                if os.path.isfile(os.path.join(self._template_path, file_name)):
+                    if self._load(file_name) or file_name in self._stored:
+                        changed.append(file_name)
+                    self._stored.discard(file_name)
+                    self._order.setdefault(file_name)
+                elif file_name in self._files:
+                    self._drop(file_name)
+                    self._order.pop(file_name, None)
+                    changed.append(file_name)
+        return changed
+
+    def invalidate(self, file_name):
+        """ Forgets a file, so it is read again on next access """
+        with self._lock:
+            if file_name in self._files:
+                self._files[file_name] = (None, self._files[file_name][1])
+
+    def store(self, file_name, template, signature):
+        """
+        Puts a template just written to a file into the catalog, so the file
+        is not read again. The next refresh reports the file as changed.
+
+        :param file_name: The name of the file in the template directory
+        :type file_name: str
+        :param template: The template as written; the catalog keeps it, so it
+            must not be modified afterwards
+        :type template: dict
+        :param signature: The stat signature of the file written, or None to
+            read the file again on next access
+        :type signature: tuple or None
+        """
+        entry = {
+            "providerId": template["providerId"],
+            "serviceId": template["serviceId"],
+            "fileName": file_name,
+            "template": template
+        }
+        with self._lock:
+            self._drop(file_name)
+            self._files[file_name] = (signature, entry)
+            self._index[(entry['providerId'].lower(), entry['serviceId'].lower())] = entry
+            self._order.setdefault(file_name)
+            self._stored.add(file_name)
+
+    def _load(self, file_name):
+        """ Reads a file into the catalog if it changed, returning whether it did """
+        signature = self._stat(file_name)
+        cached = self._files.get(file_name)
+        if cached is not None and signature is not None and cached[0] == signature:
+            return False
+
+        self._drop(file_name)
+        entry = self._read(file_name)
+        self._files[file_name] = (signature, entry)
+        if entry is not None:
+            self._index[(entry['providerId'].lower(), entry['serviceId'].lower())] = entry
+        return True
+
+    def _drop(self, file_name):
+        cached = self._files.pop(file_name, None)
+        if cached is not None and cached[1] is not None:
+            entry = cached[1]
+            self._index.pop((entry['providerId'].lower(), entry['serviceId'].lower()), None)
+
+    def _stat(self, file_name):
+        """ Returns what identifies a version of a file, or None if it cannot be told """
+        try:
+            return _file_signature(os.path.join(self._template_path, file_name))
+        except OSError:
+            return None
+
+    def _read_metadata(self, file_name):
+        """ Reads the metadata of a template file, or None if the file is left out """
+        try:
+            ids = _read_template_ids(os.path.join(self._template_path, file_name))
+        except (FileNotFoundError, IsADirectoryError, UnicodeDecodeError):
+            return None
+        if ids is None or not isinstance(ids[0], str) or not isinstance(ids[1], str):
+            return None
+        if '{}.{}.json'.format(ids[0].lower(), ids[1].lower()) != file_name:
+            return None
+        return {"providerId": ids[0], "serviceId": ids[1], "fileName": file_name}
+
+    def _read(self, file_name):
+        """ Reads the entry of a template file, or None if the file is left out """
+        try:
+            with open(os.path.join(self._template_path, file_name)) as f:
+                try:
+                    template_json = json.load(f)
+                except ValueError:
+                    # skip invalid template files
+                    return None
+        except (FileNotFoundError, IsADirectoryError):
+            # removed since listed
+            return None
+        try:
+            expected_filename = '{}.{}.json'.format(template_json['providerId'].lower(),
+                                                    template_json['serviceId'].lower())
+        except (KeyError, TypeError, AttributeError):
+            # skip templates without required fields providerId and serviceId
+            return None
+        # if file contains other providerId/serviceId - ignore
+        if expected_filename != file_name:
+            return None
+        return {
+            "providerId": template_json['providerId'],
+            "serviceId": template_json['serviceId'],
+            "fileName": file_name,
+            "template": template_json
+        }
+
 
 class DomainConnectTemplates(object):
     """
     A class representing a collection of templates.
 
-    :param template_path: The path to the directory containing the templates.
+    :param template_path: The path to the directory containing the templates, or to a template bundle file.
     :type template_path: str or None
         If not provided, it defaults to the /templates subdirectory relative to file path.
         If 'template.schema' is available in the template directory it is loaded and assigned to self._schema.
+        Templates read from a bundle (see build_bundle) cannot be updated or created.
+    :param check_formats: Whether schema validation checks the "format" of strings.
+    :type check_formats: bool
+    :param lock_writes: Whether update_template and create_template hold an
+        advisory lock on the template directory, so concurrent writers in other
+        processes cannot both create the same template.
+    :type lock_writes: bool
     """
-    def __init__(self, template_path=None):
+    def __init__(self, template_path=None, check_formats=True, lock_writes=False):
         if not template_path:
             self._template_path = os.path.dirname(os.path.realpath(__file__)) + '/templates'
         else:
             self._template_path = template_path
-        if not os.path.isdir(self._template_path) or not os.access(self._template_path, os.R_OK):
-            raise InvalidTemplate('Template dir \'{}\' not found or unreadable'.format(os.path.abspath(self._template_path)))
-        self._schema = None
-        schema_path = os.path.join(self._template_path, 'template.schema')
-        if os.path.isfile(schema_path) and os.access(schema_path, os.R_OK):
-            with open(schema_path, 'r') as f:
-                self._schema = json.load(f)
-        else:
+        self._bundle = None
+        if os.path.isdir(self._template_path) and os.access(self._template_path, os.R_OK):
             self._schema = None
+            schema_path = os.path.join(self._template_path, 'template.schema')
+            if os.path.isfile(schema_path) and os.access(schema_path, os.R_OK):
+                with open(schema_path, 'r') as f:
+                    self._schema = json.load(f)
+            else:
+                self._schema = None
+            self._catalog = TemplateCatalog(self._template_path)
+        elif os.path.isfile(self._template_path) and is_bundle(self._template_path):
+            try:
+                self._bundle = open_bundle(self._template_path)
+            except (OSError, ValueError):
+                raise InvalidTemplate('Template bundle \'{}\' not readable'.format(os.path.abspath(self._template_path)))
+            self._schema = self._bundle.schema
+            self._catalog = self._bundle
+        else:
+            raise InvalidTemplate('Template dir \'{}\' not found or unreadable'.format(os.path.abspath(self._template_path)))
+        self._check_formats = check_formats
+        self._lock_writes = lock_writes
+        self._validator = None
 
     @property
     def schema(self):
@@ -43,41 +395,86 @@ class DomainConnectTemplates(object):
         """
         return self._schema
 
+    @property
+    def validator(self):
+        """
+        The JSON schema validator for the templates.
+        It is built from the schema on first use and reused by every validate_template call.
+
+        :return: The validator of the schema draft, with a format checker if check_formats is set.
+        :rtype: jsonschema.protocols.Validator or None
+            - If no schema is found, it returns None.
+        :raises: jsonschema.exceptions.SchemaError: If the schema itself is invalid.
+        """
+        if self._validator is None and self._schema is not None:
+            cls = validator_for(self._schema)
+            cls.check_schema(self._schema)
+            self._validator = cls(self._schema,
+                                  format_checker=FormatChecker() if self._check_formats else None)
+        return self._validator
+
     @property
     def templates(self):
         """
         A list of available templates.
 
+        The templates are read through the catalog, so only files changed since
+        the last call are read again. Every call returns copies of the
+        templates, which the caller may modify. Iterate over catalog to get
+        the templates without copying them.
+
         :return: A list of dictionaries representing the templates.
             Each template dictionary contains 'providerId', 'serviceId',
             and 'fileName' keys. "template" key contains the template itself.
         :rtype: list(dict)
 
         """
-        templates = []
-        for file_to_check in [r for r in os.listdir(self._template_path) if r.endswith('.json')]:
-            with open(os.path.join(self._template_path, file_to_check)) as f:
-                try:
-                    template_json = json.load(f)
-                except ValueError:
-                    # skip invalid template files
-                    continue
-                try:
-                    expected_filename = '{}.{}.json'.format(template_json['providerId'].lower(),
-                                                            template_json['serviceId'].lower())
-                except KeyError:
-                    # skip templates without required fields providerId and serviceId
-                    continue
-                # if file contains other providerId/serviceId - ignore
-                if expected_filename != file_to_check:
-                    continue
-                templates += [{
-                    "providerId": template_json['providerId'],
-                    "serviceId": template_json['serviceId'],
-                    "fileName": file_to_check,
-                    "template": template_json
-                }]
-        return templates
+        return [dict(entry, template=copy.deepcopy(entry['template'])) for entry in self._catalog]
+
+    def list_templates(self):
+        """
+        A list of available templates without their content.
+
+        Much cheaper than templates when only the ids are needed: template files
+        are only parsed up to their providerId and serviceId, and a bundle lists
+        them from its index. Use get_template to load a template.
+
+        :return: A list of dictionaries with 'providerId', 'serviceId' and 'fileName' keys.
+        :rtype: list(dict)
+        """
+        return self._catalog.metadata()
+
+    def get_template(self, provider_id, service_id):
+        """
+        Load a single template.
+
+        :param provider_id: The providerId of the template, in any case.
+        :type provider_id: str
+        :param service_id: The serviceId of the template, in any case.
+        :type service_id: str
+        :return: The template, shared with other callers; copy it before modifying it.
+        :rtype: dict or None
+            - If there is no such template, it returns None.
+        """
+        entry = self._catalog.get(provider_id, service_id)
+        if entry is None:
+            return None
+        return entry["template"]
+
+    @property
+    def catalog(self):
+        """
+        The index of the templates in the template directory.
+
+        Unlike templates, it reads only the files that changed since they
+        were last read, and looks up a single template in constant time. Its
+        entries are shared with other callers, not copied, and must not be
+        modified.
+
+        :return: The template catalog, or the bundle if the templates are read from one
+        :rtype: TemplateCatalog or TemplateBundle
+        """
+        return self._catalog
 
     @staticmethod
     def _validate_domain_name(label, name):
@@ -94,12 +491,16 @@ class DomainConnectTemplates(object):
         if dom_val.search(name) is None:
             raise InvalidData("{} is not a valid domain name in label {}".format(name, label))
 
-    def validate_template(self, template):
+    def validate_template(self, template, all_errors=False):
         """
         Validate a template.
 
         :param template: The template to validate.
         :type template: dict
+        :param all_errors: Whether to report all schema errors instead of only the most relevant one.
+            The message of the InvalidTemplate then has one line per error, and its errors
+            attribute lists the messages.
+        :type all_errors: bool
         :raises: InvalidData: If the ServiceId or ProviderId are invalid.
         :raises: InvalidTemplate: If the template does not match the schema. Also raises an exception if any records contain variables in forbidden fields.
         """
@@ -113,10 +514,17 @@ class DomainConnectTemplates(object):
                 if dom != "":
                     self._validate_domain_name('syncRedirectDomain', dom)
         if self._schema is not None:
-            try:
-                validate(template, self._schema)
-            except ValidationError as ve:
-                raise InvalidTemplate("{}".format(ve.message))
+            if all_errors:
+                errors = sorted(self.validator.iter_errors(template), key=relevance, reverse=True)
+                if errors:
+                    messages = [error.message for error in errors]
+                    ex = InvalidTemplate("\n".join(messages))
+                    ex.errors = messages
+                    raise ex
+            else:
+                error = best_match(self.validator.iter_errors(template))
+                if error is not None:
+                    raise InvalidTemplate("{}".format(error.message))
 
         # Fields that must never contain any variable substitution
         _NO_VAR_FIELDS = {"groupId", "type", "essential",
@@ -147,43 +555,193 @@ class DomainConnectTemplates(object):
     def update_template(self, template):
         """
         Update a template.
+        The file is replaced atomically, so concurrent readers never see a partial template.
 
         :param template: The updated template.
         :type template: dict
-        :raises: EnvironmentError: If the template directory is not writable.
+        :raises: EnvironmentError: If the template directory is not writable or the templates are read from a bundle.
         :raises: InvalidTemplate: If the template does not exist or cannot be found. Also raises an exception if any records contain variables in forbidden fields.
         """
+        if self._bundle is not None:
+            raise EnvironmentError("Cannot write to a template bundle.")
         if not os.access(self._template_path, os.W_OK):
             raise EnvironmentError("Cannot write to the configured template folder.")
         self.validate_template(template)
-        templ = self.templates
-        for t in templ:
-            if t["providerId"] == template["providerId"] and t["serviceId"] == template["serviceId"]:
-                with open(os.path.join(self._template_path, t["fileName"]), "w") as f:
-                    json.dump(template, f, indent=2)
+        with self._write_lock():
+            t = self._catalog.get(template["providerId"], template["serviceId"])
+            if t is not None and t["providerId"] == template["providerId"] \
+                    and t["serviceId"] == template["serviceId"]:
+                self._write_template(t["fileName"], template)
                 return
         raise InvalidTemplate("Cannot find template {} / {}".format(template['providerId'], template['serviceId']))
 
     def create_template(self, template):
         """
         Create a new template.
+        The file is written atomically, so concurrent readers never see a partial template.
 
         :param template: The new template to create.
         :type template: dict
-        :raises: EnvironmentError: If the template directory is not writable.
+        :raises: EnvironmentError: If the template directory is not writable or the templates are read from a bundle.
         :raises: InvalidTemplate: If the template already exists or cannot be found. Also raises an exception if any records contain variables in forbidden fields.
 
         """
+        if self._bundle is not None:
+            raise EnvironmentError("Cannot write to a template bundle.")
         if not os.access(self._template_path, os.W_OK):
             raise EnvironmentError("Cannot write to the configured template folder.")
         self.validate_template(template)
 
-        templ = self.templates
-        for t in templ:
-            if t["providerId"] == template["providerId"] and t["serviceId"] == template["serviceId"]:
+        with self._write_lock():
+            t = self._catalog.get(template["providerId"], template["serviceId"])
+            if t is not None and t["providerId"] == template["providerId"] \
+                    and t["serviceId"] == template["serviceId"]:
                 raise InvalidTemplate("Template {} / {} already exists.".format(template['providerId'], template['serviceId']))
-        with open(os.path.join(self._template_path, "{}.{}.json".format(template['providerId'].lower(), template['serviceId'].lower())), "w") as f:
-            json.dump(template, f, indent=2)
+            file_name = "{}.{}.json".format(template['providerId'].lower(), template['serviceId'].lower())
+            self._write_template(file_name, template)
+
+    def _write_lock(self):
+        """ The advisory lock on the template directory if lock_writes is set """
+        if self._lock_writes:
+            return locked(self._template_path)
+        return contextlib.nullcontext()
+
+    def _write_template(self, file_name, template):
+        """
+        Writes a template file through a temp file, so readers never see a
+        partial file, and puts the template into the catalog.
+        """
+        text = json.dumps(template, indent=2)
+        st = atomic_write(os.path.join(self._template_path, file_name), text)
+        # the catalog keeps what a reader of the file would get, not the caller's dict
+        self._catalog.store(file_name, json.loads(text), (st.st_mtime_ns, st.st_size, st.st_ino))
+
+    def validate_all(self, processes=None, chunksize=32, max_pending=None):
+        """
+        Validate every template file in the template directory.
+
+        The directory is listed as files are handed out and the files are read
+        and validated in a pool of worker processes, each with its own schema
+        validator. Unlike validate_template, nothing is raised: every file
+        gets a result, including files that are not valid JSON or are not
+        named <providerid>.<serviceid>.json.
+
+        :param processes: Number of worker processes. Defaults to the number of CPUs;
+            with 1 the files are validated in the calling process.
+        :type processes: int
+        :param chunksize: Number of files sent to a worker process at a time.
+        :type chunksize: int
+        :param max_pending: Maximum number of chunks in flight. Defaults to twice the number of worker processes.
+        :type max_pending: int
+        :return: An iterator over the results in the order the files are validated.
+            Each result has 'fileName', 'providerId', 'serviceId', 'valid', 'errors' (list of messages)
+            and 'seconds' keys.
+        :rtype: iterator
+            - elements: dict
+        """
+        if processes is None:
+            processes = os.cpu_count() or 1
+        if max_pending is None:
+            max_pending = 2 * processes
+
+        file_names = self._file_names()
+
+        if processes == 1:
+            for file_name in file_names:
+                yield self._validate_file(file_name)
+            return
+
+        with ProcessPoolExecutor(max_workers=processes,
+                                 initializer=_init_validation_worker,
+                                 initargs=(self._template_path, self._check_formats)) as executor:
+            for results in submit_chunks(executor, _validate_chunk, file_names,
+                                         chunksize, max_pending):
+                for result in results:
+                    yield result
+
+    def build_bundle(self, bundle_path, processes=None):
+        """
+        Writes all templates with their schema into a single bundle file.
+
+        Every template is validated first and the outcome is stored with it.
+        The bundle can then be passed as template_path to DomainConnectTemplates
+        and DomainConnect, which read it through mmap and parse a template only
+        when it is first used.
+
+        :param bundle_path: The path of the bundle file to write.
+        :type bundle_path: str
+        :param processes: Number of worker processes to validate the templates with,
+            see validate_all.
+        :type processes: int
+        :return: The number of templates in the bundle.
+        :rtype: int
+        """
+        results = {result["fileName"]: result for result in self.validate_all(processes)}
+        entries = (dict(entry,
+                        valid=results.get(entry["fileName"], {}).get("valid"),
+                        errors=results.get(entry["fileName"], {}).get("errors", []))
+                   for entry in self._catalog)
+        return write_bundle(bundle_path, entries, self._schema)
+
+    def _file_names(self):
+        """ Iterates over the names of the template files in the directory or bundle """
+        if self._bundle is not None:
+            for file_name in self._bundle.files():
+                yield file_name
+            return
+        with os.scandir(self._template_path) as it:
+            for entry in it:
+                if entry.name.endswith('.json') and entry.is_file():
+                    yield entry.name
+
+    def _validate_file(self, file_name):
+        """ Validates one template file, returning its validate_all result """
+        start = time.perf_counter()
+        result = {"fileName": file_name, "providerId": None, "serviceId": None}
+        errors = []
+        try:
+            if self._bundle is not None:
+                template = self._bundle.get_file(file_name)['template']
+            else:
+                with open(os.path.join(self._template_path, file_name)) as f:
+                    template = json.load(f)
+        except ValueError as e:
+            errors.append("Invalid JSON: {}".format(e))
+        except OSError as e:
+            errors.append("Cannot read file: {}".format(e))
+        else:
+            errors = self._template_file_errors(file_name, template, result)
+
+        result["valid"] = not errors
+        result["errors"] = errors
+        result["seconds"] = time.perf_counter() - start
+        return result
+
+    def _template_file_errors(self, file_name, template, result):
+        """ Returns the validation errors of a parsed template file, filling in its ids in result """
+        if not isinstance(template, dict):
+            return ["Template is not a JSON object"]
+        result["providerId"] = template.get("providerId")
+        result["serviceId"] = template.get("serviceId")
+        if not isinstance(result["providerId"], str) or not isinstance(result["serviceId"], str):
+            return ["Template has no providerId or serviceId"]
+
+        errors = []
+        expected_filename = '{}.{}.json'.format(result["providerId"].lower(), result["serviceId"].lower())
+        if expected_filename != file_name:
+            errors.append("File name does not match providerId and serviceId, expected {}".format(expected_filename))
+        try:
+            # get_variable_names prints the records with variables
+            with contextlib.redirect_stdout(io.StringIO()):
+                self.validate_template(template, all_errors=True)
+        except InvalidTemplate as e:
+            errors.extend(getattr(e, 'errors', ["{}".format(e)]))
+        except InvalidData as e:
+            errors.append("{}".format(e))
+        except Exception as e:
+            # malformed templates can fail anywhere in the record checks
+            errors.append("{}: {}".format(type(e).__name__, e))
+        return errors
 
     @staticmethod
     def get_variable_names(template, variables=None, group=None):
@@ -233,3 +791,18 @@ class DomainConnectTemplates(object):
                 if 'groupId' in record and not record['groupId'] in groups:
                     groups += [record['groupId']]
         return groups
+
+
+# The templates of a worker process of DomainConnectTemplates.validate_all
+_validation_templates = None
+
+
+def _init_validation_worker(template_path, check_formats):
+    """ Loads the schema of a worker process """
+    global _validation_templates
+    _validation_templates = DomainConnectTemplates(template_path, check_formats)
+
+
+def _validate_chunk(chunk):
+    """ Validates a chunk of template files in a worker process """
+    return [_validation_templates._validate_file(file_name) for file_name in chunk]
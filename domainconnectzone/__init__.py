@@ -1,7 +1,13 @@
-from domainconnectzone.sigutil import verify_sig, generate_sig, get_publickey
+from domainconnectzone.sigutil import verify_sig, verify_sigs, generate_sig, \
+    get_publickey, get_publickey_async, \
+    KeySource, DNSKeySource, DictKeySource, PublicKeyCache, SignatureVerifier
 from domainconnectzone.qsutil import qs2dict, qsfilter
 from domainconnectzone.DomainConnectImpl import \
-    DomainConnect, process_records, \
+    DomainConnect, CompiledTemplate, NormalisedZone, ChangeSet, TemplateCache, \
+    process_records, process_records_stream, apply_job, \
     InvalidTemplate, HostRequired, \
     InvalidSignature, MissingParameter, InvalidData, resolve_variables
-from domainconnectzone.DomainConnectTemplates import DomainConnectTemplates
+from domainconnectzone.DomainConnectTemplates import DomainConnectTemplates, TemplateCatalog
+from domainconnectzone.bulkutil import apply_templates
+from domainconnectzone.bundleutil import TemplateBundle
+from domainconnectzone.watchutil import TemplateWatcher
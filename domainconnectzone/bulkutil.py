@@ -0,0 +1,142 @@
+import os
+
+from concurrent.futures import ProcessPoolExecutor
+
+from domainconnectzone.DomainConnectImpl import DomainConnect, apply_job
+from domainconnectzone.DomainConnectTemplates import DomainConnectTemplates
+from domainconnectzone.poolutil import submit_chunks
+
+
+class _WorkerTemplates(object):
+    """
+    The templates of a worker process, keyed by lowercased (providerId, serviceId).
+
+    Only the templates given are compiled when the worker starts. Others are
+    read from the template directory on first use and kept for later jobs,
+    so a worker only compiles the templates its jobs use. A template given
+    that cannot be compiled fails only the jobs using it.
+    """
+
+    def __init__(self, template_path, templates, redir_template_records):
+        self._template_path = template_path
+        self._redir_template_records = redir_template_records
+        self._templates = {}
+
+        for (provider_id, service_id), template in (templates or {}).items():
+            try:
+                dc = DomainConnect(template=template,
+                                   redir_template_records=redir_template_records)
+                dc.compiled_template
+            except Exception as e:
+                # Raised by get for every job using the template
+                dc = e
+            self._templates[(provider_id.lower(), service_id.lower())] = dc
+
+    def get(self, provider_id, service_id):
+        key = (provider_id.lower(), service_id.lower())
+        dc = self._templates.get(key)
+        if isinstance(dc, Exception):
+            raise dc
+        if dc is None:
+            dc = DomainConnect(provider_id, service_id, self._template_path,
+                               redir_template_records=self._redir_template_records)
+            self._templates[key] = dc
+        return dc
+
+
+# The templates of a worker process of apply_templates
+_worker_templates = None
+
+
+def _init_worker(template_path, templates, redir_template_records):
+    """ Pre-loads the templates of a worker process """
+    global _worker_templates
+    _worker_templates = _WorkerTemplates(template_path, templates, redir_template_records)
+
+
+def _apply_job(job):
+    """ Applies one job in a worker process, returning any exception raised """
+    try:
+        dc = _worker_templates.get(*job[0])
+    except Exception as e:
+        return e
+    if len(job) > 5:
+        return apply_job(dc, dict(job[5], zone_records=job[1], domain=job[2],
+                                  host=job[3], params=job[4]))
+    return apply_job(dc, job[1:5])
+
+
+def _apply_chunk(chunk):
+    """ Applies a chunk of (index, job) pairs in a worker process """
+    return [(index, _apply_job(job)) for index, job in chunk]
+
+
+def apply_templates(jobs, template_path=None, templates=None,
+                    redir_template_records=None, processes=None,
+                    chunksize=64, max_pending=None):
+    """
+    Applies templates to many zones in a pool of worker processes.
+
+    Every worker compiles the templates given in templates once when it
+    starts, so only the jobs are sent to the workers. Other templates are
+    read from template_path by a worker on the first job using them and kept
+    for its later jobs. Jobs are read from the iterable as chunks
+    are handed out and at most max_pending chunks are in flight, so memory
+    stays flat for any number of jobs.
+
+    :param jobs: The applications to run. Each job is a tuple of the
+        template key, zone records, domain, host and params, optionally
+        followed by a dict of further keyword arguments of
+        DomainConnect.apply_template (e.g. multi_aware, group_ids).
+    :type jobs: iterable
+        - elements: tuple
+        - e.g. (('provider', 'service'), zone_records, domain, host, params)
+
+    :param template_path: Path to the template directory. Templates not in
+        templates are read from here.
+    :type template_path: str
+
+    :param templates: Templates to pre-load, keyed by (providerId, serviceId).
+        By default no template is pre-loaded, so a worker only reads and
+        compiles the templates of its jobs.
+    :type templates: dict((str, str), dict)
+
+    :param redir_template_records: Redirect template records for templates
+        with REDIR301/REDIR302 records.
+    :type redir_template_records: list
+
+    :param processes: Number of worker processes. Defaults to the number of CPUs.
+    :type processes: int
+
+    :param chunksize: Number of jobs sent to a worker process at a time.
+    :type chunksize: int
+
+    :param max_pending: Maximum number of chunks in flight. Defaults to
+        twice the number of worker processes.
+    :type max_pending: int
+
+    :return: An iterator over (index, outcome) in the order the jobs complete.
+        index is the position of the job in jobs, outcome is the tuple
+        returned by apply_template or the exception raised for the job.
+    :rtype: iterator
+        - elements: tuple(int, tuple | Exception)
+
+    :raises: InvalidTemplate: If templates is not given and the template directory is not readable.
+    """
+
+    if templates is None:
+        # Fail here rather than in every worker
+        DomainConnectTemplates(template_path)
+
+    if processes is None:
+        processes = os.cpu_count() or 1
+    if max_pending is None:
+        max_pending = 2 * processes
+
+    with ProcessPoolExecutor(max_workers=processes,
+                             initializer=_init_worker,
+                             initargs=(template_path, templates, redir_template_records)) as executor:
+        for outcomes in submit_chunks(executor, _apply_chunk, enumerate(jobs),
+                                      chunksize, max_pending):
+            for index, outcome in outcomes:
+                yield index, outcome
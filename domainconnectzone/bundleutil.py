@@ -0,0 +1,296 @@
+"""
+A single-file bundle of templates that is read through mmap.
+
+Layout (all integers little endian):
+
+    header   magic b'DCTB', version (uint32), then offset and length (uint64)
+             of the index and of the schema
+    bodies   the compact JSON of every template, one after the other
+    schema   the JSON of template.schema, if any
+    index    a JSON list with one [providerId, serviceId, fileName, offset,
+             length, valid, errors] entry per template
+
+Opening a bundle reads only the header and the index. A template is parsed
+when it is first asked for.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+
+from domainconnectzone.fileutil import atomic_open
+
+BUNDLE_MAGIC = b'DCTB'
+BUNDLE_VERSION = 1
+
+_HEADER = struct.Struct('<4sIQQQQ')
+
+
+def write_bundle(bundle_path, entries, schema=None):
+    """
+    Writes templates into a bundle file.
+
+    The bundle is written next to bundle_path and moved in place, so readers
+    never see a partial bundle.
+
+    :param bundle_path: The path of the bundle file
+    :type bundle_path: str
+    :param entries: The templates, as dicts with 'providerId', 'serviceId',
+        'fileName' and 'template' keys, and optionally 'valid' and 'errors'
+        for the outcome of their validation
+    :type entries: iterable(dict)
+    :param schema: The template schema to store with the templates
+    :type schema: dict or None
+
+    :return: The number of templates written
+    :rtype: int
+    """
+    index = []
+    with atomic_open(bundle_path, 'wb') as f:
+        f.write(b'\0' * _HEADER.size)
+        offset = _HEADER.size
+        for entry in entries:
+            body = json.dumps(entry['template'], separators=(',', ':')).encode('utf-8')
+            f.write(body)
+            index.append([entry['providerId'], entry['serviceId'], entry['fileName'],
+                          offset, len(body), entry.get('valid'), entry.get('errors', [])])
+            offset += len(body)
+
+        schema_offset = offset
+        schema_body = b'' if schema is None else json.dumps(schema, separators=(',', ':')).encode('utf-8')
+        f.write(schema_body)
+        offset += len(schema_body)
+
+        index_body = json.dumps(index, separators=(',', ':')).encode('utf-8')
+        f.write(index_body)
+
+        f.seek(0)
+        f.write(_HEADER.pack(BUNDLE_MAGIC, BUNDLE_VERSION, offset, len(index_body),
+                             schema_offset, len(schema_body)))
+    return len(index)
+
+
+def is_bundle(path):
+    """ Returns whether path is a template bundle file """
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(BUNDLE_MAGIC)) == BUNDLE_MAGIC
+    except OSError:
+        return False
+
+
+class _BundleState(object):
+    """ The mapped contents of one version of a bundle file """
+
+    def __init__(self, bundle_path):
+        with open(bundle_path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if st.st_size < _HEADER.size:
+                raise ValueError("'{}' is not a template bundle".format(bundle_path))
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        magic, version, index_offset, index_length, schema_offset, schema_length = \
+            _HEADER.unpack_from(data, 0)
+        if magic != BUNDLE_MAGIC or version != BUNDLE_VERSION:
+            data.close()
+            raise ValueError("'{}' is not a template bundle of version {}".format(
+                bundle_path, BUNDLE_VERSION))
+
+        self.data = data
+        self.signature = (st.st_mtime_ns, st.st_size, st.st_ino)
+        self.schema_span = (schema_offset, schema_length)
+        self.index = json.loads(data[index_offset:index_offset + index_length].decode('utf-8'))
+        self.files = {item[2]: position for position, item in enumerate(self.index)}
+        self.keys = {(item[0].lower(), item[1].lower()): position
+                     for position, item in enumerate(self.index)}
+        # position -> entry, filled on first access
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def entry(self, position):
+        entry = self.entries.get(position)
+        if entry is None:
+            with self.lock:
+                entry = self.entries.get(position)
+                if entry is None:
+                    provider_id, service_id, file_name, offset, length = self.index[position][:5]
+                    entry = {
+                        "providerId": provider_id,
+                        "serviceId": service_id,
+                        "fileName": file_name,
+                        "template": json.loads(self.data[offset:offset + length].decode('utf-8'))
+                    }
+                    self.entries[position] = entry
+        return entry
+
+
+class TemplateBundle(object):
+    """
+    The templates of a bundle file, parsed one by one on first access.
+
+    It offers the lookups of TemplateCatalog, so it can stand in for the
+    catalog of a template directory. The template dicts are shared by all
+    callers and must not be modified. A bundle can be shared between threads.
+
+    :param bundle_path: The path of the bundle file
+    :type bundle_path: str
+
+    :raises: ValueError: If the file is not a template bundle
+    :raises: OSError: If the file cannot be read
+    """
+
+    def __init__(self, bundle_path):
+        self.bundle_path = bundle_path
+        self._lock = threading.Lock()
+        self._state = _BundleState(bundle_path)
+
+    def close(self):
+        """ Unmaps the bundle file """
+        self._state.data.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def __len__(self):
+        return len(self._state.index)
+
+    def __iter__(self):
+        """ Iterates over the entries of all templates, parsing those not yet parsed """
+        state = self._state
+        return (state.entry(position) for position in range(len(state.index)))
+
+    @property
+    def schema(self):
+        """
+        The template schema stored in the bundle.
+
+        :rtype: dict or None
+        """
+        state = self._state
+        offset, length = state.schema_span
+        if not length:
+            return None
+        return json.loads(state.data[offset:offset + length].decode('utf-8'))
+
+    @property
+    def signature(self):
+        """ The mtime, size and inode of the bundle file when it was opened """
+        return self._state.signature
+
+    def get(self, provider_id, service_id):
+        """
+        Gets the entry of a template.
+
+        :param provider_id: The providerId of the template, in any case
+        :type provider_id: str
+        :param service_id: The serviceId of the template, in any case
+        :type service_id: str
+
+        :return: The entry with 'providerId', 'serviceId', 'fileName' and
+            'template' keys, or None if there is no such template
+        :rtype: dict or None
+        """
+        state = self._state
+        position = state.keys.get((provider_id.lower(), service_id.lower()))
+        if position is None:
+            return None
+        return state.entry(position)
+
+    def metadata(self):
+        """
+        Lists the templates from the index, without parsing any of them.
+
+        :return: A 'providerId', 'serviceId' and 'fileName' dict per template, in bundle order
+        :rtype: list(dict)
+        """
+        return [{"providerId": item[0], "serviceId": item[1], "fileName": item[2]}
+                for item in self._state.index]
+
+    def files(self):
+        """ Returns the file names of the templates, in bundle order """
+        return [item[2] for item in self._state.index]
+
+    def get_file(self, file_name):
+        """ Gets the entry of the template of a file name, or None """
+        state = self._state
+        position = state.files.get(file_name)
+        if position is None:
+            return None
+        return state.entry(position)
+
+    def validation(self, provider_id, service_id):
+        """
+        Gets the outcome of validating a template when the bundle was built.
+
+        :return: Whether the template was valid (None if it was not checked)
+            and its validation errors, or None if there is no such template
+        :rtype: tuple(bool or None, list(str)) or None
+        """
+        state = self._state
+        position = state.keys.get((provider_id.lower(), service_id.lower()))
+        if position is None:
+            return None
+        item = state.index[position]
+        return item[5], item[6]
+
+    def refresh(self):
+        """
+        Opens the bundle file again if it was replaced.
+
+        The old mapping stays valid for readers still using it and is closed
+        when the last of them is done.
+
+        :return: The file names of the templates of the old and new bundle if
+            it was replaced, else an empty list
+        :rtype: list(str)
+        """
+        with self._lock:
+            st = os.stat(self.bundle_path)
+            old = self._state
+            if (st.st_mtime_ns, st.st_size, st.st_ino) == old.signature:
+                return []
+            self._state = _BundleState(self.bundle_path)
+            return sorted(set(old.files) | set(self._state.files))
+
+    def update(self, file_names):
+        """ Brings files up to date; a bundle changes only as a whole, see refresh """
+        file_names = set(file_names)
+        return [file_name for file_name in self.refresh() if file_name in file_names]
+
+    def invalidate(self, file_name):
+        """ Does nothing, bundles are read-only """
+
+
+# Open bundles by path, see open_bundle
+_bundles = {}
+_bundles_lock = threading.Lock()
+
+
+def open_bundle(bundle_path):
+    """
+    Gets the bundle of a path, shared by the whole process.
+
+    The bundle is opened on first use and opened again when the file was replaced.
+
+    :param bundle_path: The path of the bundle file
+    :type bundle_path: str
+
+    :return: The bundle
+    :rtype: TemplateBundle
+
+    :raises: ValueError: If the file is not a template bundle
+    :raises: OSError: If the file cannot be read
+    """
+    bundle_path = os.path.abspath(bundle_path)
+    with _bundles_lock:
+        bundle = _bundles.get(bundle_path)
+        if bundle is None:
+            bundle = TemplateBundle(bundle_path)
+            _bundles[bundle_path] = bundle
+        else:
+            bundle.refresh()
+        return bundle
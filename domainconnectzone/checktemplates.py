@@ -0,0 +1,92 @@
+"""
+Validates every template in a template directory, e.g. as a CI gate.
+
+Usage: python -m domainconnectzone.checktemplates [-h] [--report FILE]
+       [--processes N] [--failures-only] [--no-format-check] [template_dir]
+
+Writes one JSON line per template file to the report (stdout by default) with
+fileName, providerId, serviceId, valid, errors and seconds, and a summary to
+stderr. Exits with 0 if all templates are valid, 1 if any is invalid and 2 if
+the template directory cannot be read.
+"""
+import argparse
+import json
+import sys
+import time
+
+from domainconnectzone.DomainConnectImpl import InvalidTemplate
+from domainconnectzone.DomainConnectTemplates import DomainConnectTemplates
+
+EXIT_VALID = 0
+EXIT_INVALID = 1
+EXIT_ERROR = 2
+
+
+def _positive_int(value):
+    """ Parses a command line argument that must be a positive integer """
+    try:
+        number = int(value)
+    except ValueError:
+        number = 0
+    if number < 1:
+        raise argparse.ArgumentTypeError('must be a positive integer, not {!r}'.format(value))
+    return number
+
+
+def main(argv=None):
+    """
+    Runs the template check.
+
+    :param argv: The command line arguments. Defaults to sys.argv[1:].
+    :type argv: list(str)
+
+    :return: The exit code
+    :rtype: int
+    """
+    parser = argparse.ArgumentParser(
+        prog='python -m domainconnectzone.checktemplates',
+        description='Validates all Domain Connect templates in a directory.')
+    parser.add_argument('template_dir', nargs='?', default=None,
+                        help='the template directory (default: the templates of the package)')
+    parser.add_argument('--report', default='-',
+                        help='file to write the JSON lines report to (default: stdout)')
+    parser.add_argument('--processes', type=_positive_int, default=None,
+                        help='number of worker processes (default: number of CPUs)')
+    parser.add_argument('--failures-only', action='store_true',
+                        help='report only invalid templates')
+    parser.add_argument('--no-format-check', action='store_false', dest='check_formats',
+                        help='do not check the format of strings against the schema')
+    args = parser.parse_args(argv)
+
+    try:
+        templates = DomainConnectTemplates(args.template_dir, check_formats=args.check_formats)
+    except InvalidTemplate as e:
+        sys.stderr.write('{}\n'.format(e))
+        return EXIT_ERROR
+
+    if args.report == '-':
+        report = sys.stdout
+    else:
+        report = open(args.report, 'w')
+
+    start = time.perf_counter()
+    checked = 0
+    failed = 0
+    try:
+        for result in templates.validate_all(processes=args.processes):
+            checked += 1
+            if not result['valid']:
+                failed += 1
+            if not result['valid'] or not args.failures_only:
+                report.write(json.dumps(result) + '\n')
+    finally:
+        if report is not sys.stdout:
+            report.close()
+
+    sys.stderr.write('{} templates checked, {} invalid, in {:.2f}s\n'.format(
+        checked, failed, time.perf_counter() - start))
+    return EXIT_INVALID if failed else EXIT_VALID
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,110 @@
+import contextlib
+import os
+import tempfile
+
+try:
+    import fcntl
+except ImportError:
+    # not on POSIX: advisory locks are not available
+    fcntl = None
+
+
+def _umask():
+    """ Returns the umask of the process """
+    # os.umask can only be read by setting it, which other threads would see
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Umask:'):
+                    return int(line.split()[1], 8)
+    except (OSError, ValueError, IndexError):
+        pass
+    mask = os.umask(0o022)
+    os.umask(mask)
+    return mask
+
+
+@contextlib.contextmanager
+def atomic_open(path, mode='w', file_mode=None):
+    """
+    Opens a temp file next to path that is moved in place when the block ends.
+
+    Readers of path see either the old or the new file, never a partial one.
+    The data is flushed to disk before the move, so after a crash path holds
+    either the old or the complete new content. If the block raises, the temp
+    file is removed and path is left as it was. The new file keeps the
+    permission bits of the file it replaces.
+
+    :param path: The path of the file to write
+    :type path: str
+    :param mode: 'w' or 'wb'
+    :type mode: str
+    :param file_mode: The permission bits if path does not exist yet. Defaults
+        to what open would give a new file under the umask of the process.
+    :type file_mode: int
+
+    :return: The temp file, open for writing
+    :rtype: file
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.', suffix='.tmp')
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            file_mode = os.stat(path).st_mode & 0o7777
+        except FileNotFoundError:
+            if file_mode is None:
+                file_mode = 0o666 & ~_umask()
+        # mkstemp creates the file readable by its owner only
+        os.chmod(tmp_path, file_mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+
+def atomic_write(path, data):
+    """
+    Writes a file through atomic_open.
+
+    :param path: The path of the file to write
+    :type path: str
+    :param data: The new content of the file
+    :type data: str or bytes
+
+    :return: The stat of the file written
+    :rtype: os.stat_result
+    """
+    with atomic_open(path, 'wb' if isinstance(data, bytes) else 'w') as f:
+        f.write(data)
+        f.flush()
+        # a rename keeps mtime, size and inode, so this is the stat of path
+        st = os.fstat(f.fileno())
+    return st
+
+
+@contextlib.contextmanager
+def locked(path):
+    """
+    Holds an exclusive advisory lock on a file or directory for the block.
+
+    The lock is taken with flock, so it excludes other processes and other
+    threads that lock the same path. Where flock is not available the block
+    runs without a lock.
+
+    :param path: The path of an existing file or directory
+    :type path: str
+    """
+    if fcntl is None:
+        yield
+        return
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        yield
+    finally:
+        # closing the descriptor releases the lock
+        os.close(fd)
@@ -0,0 +1,59 @@
+import collections
+import itertools
+
+from concurrent.futures import wait, FIRST_COMPLETED
+
+
+def submit_chunks(executor, fn, items, chunksize, max_pending, ordered=False):
+    """
+    Calls fn on chunks of items in an executor and yields what each call returns.
+
+    Items are read from the iterable as chunks are handed out and at most
+    max_pending chunks are in flight, so memory stays flat for any number of
+    items and a slow consumer holds back the workers.
+
+    :param executor: The executor to submit the chunks to
+    :type executor: concurrent.futures.Executor
+    :param fn: The function called with each chunk, a list of items
+    :type fn: callable
+    :param items: The items to hand out
+    :type items: iterable
+    :param chunksize: Number of items in a chunk
+    :type chunksize: int
+    :param max_pending: Maximum number of chunks in flight
+    :type max_pending: int
+    :param ordered: Whether the results come in the order of the chunks
+        rather than in the order the chunks complete
+    :type ordered: bool
+
+    :return: An iterator over the return values of fn
+    :rtype: iterator
+
+    :raises: ValueError: If chunksize or max_pending is less than 1
+    """
+    if chunksize < 1:
+        raise ValueError('chunksize must be at least 1, not {}'.format(chunksize))
+    if max_pending < 1:
+        raise ValueError('max_pending must be at least 1, not {}'.format(max_pending))
+    items = iter(items)
+    pending = collections.deque()
+    exhausted = False
+    while True:
+        while not exhausted and len(pending) < max_pending:
+            chunk = list(itertools.islice(items, chunksize))
+            if not chunk:
+                exhausted = True
+                break
+            pending.append(executor.submit(fn, chunk))
+
+        if not pending:
+            return
+
+        if ordered:
+            yield pending.popleft().result()
+            continue
+
+        done, not_done = wait(pending, return_when=FIRST_COMPLETED)
+        pending = collections.deque(future for future in pending if future in not_done)
+        for future in done:
+            yield future.result()
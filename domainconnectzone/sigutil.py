@@ -1,5 +1,16 @@
+import asyncio
+import collections
+import hashlib
+import os
+import threading
+import time
+
+from concurrent.futures import ProcessPoolExecutor
+
+import dns.asyncresolver
 import dns.resolver
 
+from cryptography.exceptions import InvalidSignature, UnsupportedAlgorithm
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.asymmetric import padding
 from cryptography.hazmat.primitives import serialization
@@ -10,20 +21,264 @@ from base64 import b64decode, b64encode
 from dns.exception import (
     DNSException
 )
+class SignatureVerifier(object):
+    """
+    Verifies RS256 signatures, keeping the public keys it parsed.
+
+    Parsed keys are kept keyed by the SHA-256 digest of their PEM, so a PEM
+    that was seen before is not parsed again. When max_keys keys are kept the
+    least recently used one is dropped. The time spent parsing keys and
+    verifying signatures is counted separately, see stats. A verifier can be
+    shared between threads.
+
+    :param max_keys: Maximum number of parsed keys kept
+    :type max_keys: int
+    """
+
+    def __init__(self, max_keys=256):
+        self.max_keys = max_keys
+        self._keys = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self.reset_stats()
+
+    def load_key(self, pem):
+        """
+        Gets the parsed public key of a PEM, parsing it only if it was not seen before.
+
+        :param pem: The PEM public key
+        :type pem: str | bytes
+
+        :return: The public key
+        :rtype: cryptography public key object
+
+        :raises: ValueError: If the PEM is not a valid public key
+        :raises: UnsupportedAlgorithm: If the key type is not supported
+        """
+        if isinstance(pem, str):
+            pem = pem.encode()
+        digest = hashlib.sha256(pem).digest()
+
+        with self._lock:
+            public_key = self._keys.get(digest)
+            if public_key is not None:
+                self._keys.move_to_end(digest)
+                self._key_hits += 1
+                return public_key
+
+        start = time.perf_counter()
+        try:
+            public_key = serialization.load_pem_public_key(pem, backend=default_backend())
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self._parses += 1
+                self._parse_seconds += elapsed
+
+        with self._lock:
+            self._keys[digest] = public_key
+            while len(self._keys) > self.max_keys:
+                self._keys.popitem(last=False)
+        return public_key
+
+    def verify(self, public_key, signature, data):
+        """
+        Verifies a raw signature on raw data with a parsed public key.
+
+        This is the fast path for callers that already hold the key object and
+        the decoded signature and data.
+
+        :param public_key: The public key, e.g. from load_key
+        :type public_key: cryptography RSA public key object
+        :param signature: The signature, not base64 encoded
+        :type signature: bytes
+        :param data: The signed data
+        :type data: bytes
+
+        :return: True if the signature is valid
+        :rtype: bool
+        """
+        start = time.perf_counter()
+        try:
+            public_key.verify(signature, data, padding.PKCS1v15(), hashes.SHA256())
+            valid = True
+        except (InvalidSignature, TypeError, AttributeError):
+            # TypeError and AttributeError: not an RSA key
+            valid = False
+        elapsed = time.perf_counter() - start
+
+        with self._lock:
+            self._verifies += 1
+            self._verify_seconds += elapsed
+            if not valid:
+                self._failures += 1
+        return valid
+
+    def verify_sig(self, public_key, signature, data):
+        """
+        Verifies a base64 signature with a PEM public key or a loaded public key object.
+
+        :param public_key: The PEM public key, or the public key object
+        :type public_key: str | cryptography public key object
+        :param signature: The base64 encoded signature
+        :type signature: str | bytes
+        :param data: The signed data
+        :type data: str | bytes
+
+        :return: True if the signature is valid, False if it is not or any
+            of the inputs is malformed
+        :rtype: bool
+        """
+        try:
+            if isinstance(public_key, (str, bytes)):
+                public_key = self.load_key(public_key)
+            signature = b64decode(signature)
+            if isinstance(data, str):
+                data = data.encode()
+        except (ValueError, TypeError, UnsupportedAlgorithm):
+            # ValueError covers malformed PEMs and base64 (binascii.Error)
+            with self._lock:
+                self._failures += 1
+            return False
+
+        return self.verify(public_key, signature, data)
+
+    def stats(self):
+        """
+        Returns the counters of the verifier.
+
+        :return: parses and parse_seconds for keys parsed, key_hits for keys
+            found already parsed, verifies and verify_seconds for signature
+            checks, and failures for signatures found invalid or malformed
+        :rtype: dict
+        """
+        with self._lock:
+            return {'parses': self._parses,
+                    'parse_seconds': self._parse_seconds,
+                    'key_hits': self._key_hits,
+                    'verifies': self._verifies,
+                    'verify_seconds': self._verify_seconds,
+                    'failures': self._failures}
+
+    def reset_stats(self):
+        """ Sets all counters back to zero """
+        self._parses = 0
+        self._parse_seconds = 0.0
+        self._key_hits = 0
+        self._verifies = 0
+        self._verify_seconds = 0.0
+        self._failures = 0
+
+    def clear(self):
+        """ Drops all parsed keys """
+        with self._lock:
+            self._keys.clear()
+
+
+# The verifier used by verify_sig
+signature_verifier = SignatureVerifier()
+
+
 def verify_sig(public_key, signature, data):
-    """ Verifies a signature """
-    try:
-        pk = serialization.load_pem_public_key(
-            public_key.encode(),
-            backend=default_backend()
-        )
+    """ Verifies a signature with a PEM public key or a loaded public key object """
+    return signature_verifier.verify_sig(public_key, signature, data)
+
+# The outcome of one item of verify_sigs. reason is None for a valid signature
+VerifyResult = collections.namedtuple('VerifyResult', ['valid', 'reason'])
+
+
+def verify_sigs(items, key_source=None, processes=None, chunksize=256):
+    """
+    Verifies many signatures, reading each public key once.
+
+    The items are grouped by key host and the key of every host is read once
+    from key_source. The signatures are then verified in chunks of one key
+    host each, in a pool of worker processes if processes is more than one.
+
+    :param items: The signatures to verify, as (qs, sig, key host) where qs is
+        the signed query string, sig the base64 signature and the key host is
+        <key>.<syncPubKeyDomain>
+    :type items: iterable
+        - elements: tuple(str, str, str)
+    :param key_source: The source to read the public keys from. Defaults to
+        sigutil.publickey_cache.
+    :type key_source: KeySource
+    :param processes: Number of worker processes. Defaults to the number of
+        CPUs; with 1 the signatures are verified in the calling process.
+    :type processes: int
+    :param chunksize: Number of signatures sent to a worker process at a time
+    :type chunksize: int
+
+    :return: The outcome of every item, in the order of the items
+    :rtype: list(VerifyResult)
+    """
+    items = list(items)
+    results = [None] * len(items)
+
+    groups = collections.OrderedDict()
+    for index, (qs, sig, domain) in enumerate(items):
+        if not qs or not sig or not domain:
+            results[index] = VerifyResult(False, 'Missing data for signature verification')
+        else:
+            groups.setdefault(domain, []).append((index, qs, sig))
+
+    if key_source is None:
+        key_source = publickey_cache
+    if processes is None:
+        processes = os.cpu_count() or 1
+
+    chunks = []
+    for domain, group in groups.items():
+        public_key = key_source.get(domain)
+        if public_key is None:
+            result = VerifyResult(False, 'Unable to get public key from ' + domain)
+            for index, _, _ in group:
+                results[index] = result
+            continue
+
+        if processes > 1:
+            # Key objects do not pickle, the workers parse the PEM once each
+            public_key = public_key.public_bytes(
+                serialization.Encoding.PEM,
+                serialization.PublicFormat.SubjectPublicKeyInfo)
+        for start in range(0, len(group), chunksize):
+            chunks.append((public_key, group[start:start + chunksize]))
+
+    if processes > 1 and len(chunks) > 1:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            outcomes = list(executor.map(_verify_chunk, chunks))
+    else:
+        outcomes = map(_verify_chunk, chunks)
+
+    for outcome in outcomes:
+        for index, result in outcome:
+            results[index] = result
+
+    return results
+
 
-        pk.verify(b64decode(signature), data.encode(), padding.PKCS1v15(), hashes.SHA256())
+def _verify_chunk(chunk):
+    """ Verifies a chunk of (index, qs, sig) signed with one key, returning (index, VerifyResult) """
+    public_key, group = chunk
+    if isinstance(public_key, bytes):
+        public_key = signature_verifier.load_key(public_key)
 
-    except:
-        return False
+    outcome = []
+    for index, qs, sig in group:
+        try:
+            signature = b64decode(sig)
+        except (ValueError, TypeError):
+            outcome.append((index, VerifyResult(False, 'Malformed signature')))
+            continue
+
+        if isinstance(qs, str):
+            qs = qs.encode()
+        if signature_verifier.verify(public_key, signature, qs):
+            outcome.append((index, VerifyResult(True, None)))
+        else:
+            outcome.append((index, VerifyResult(False, 'Signature not valid')))
+
+    return outcome
 
-    return True
 
 def generate_sig(private_key, data):
     """ Generates a signature on the passed in data """
@@ -43,41 +298,344 @@ def generate_sig(private_key, data):
     return b64encode(sig)
 
 
-def get_publickey(domain):
-        """ Gets a publickey from a zone """
-        segments = {}
+def get_publickey(domain, key_source=None):
+        """ Gets a publickey from a zone, or from key_source if given """
+        if key_source is not None:
+            return key_source.fetch(domain)[0]
+        return _read_publickey(domain)[0]
 
-        pembits = ''
 
+def _read_publickey(domain, resolver=None):
+        """ Gets a publickey from a zone together with the TTL of its TXT records """
+        try:
+            if resolver is None:
+                records = dns.resolver.resolve(domain, 'TXT') # Get all text records
+            else:
+                records = resolver.resolve(domain, 'TXT')
+            return _publickey_from_txt(records)
+        except DNSException:
+            return None, None
+
+
+async def _read_publickey_async(domain, resolver=None):
+        """ Gets a publickey from a zone without blocking the event loop """
         try:
-            records = dns.resolver.resolve(domain, 'TXT') # Get all text records
-            record_strings = []
-            for record in records:
-                text = record.strings[0].decode('utf-8')
-                record_strings.append(text)
-                split_text = text.split(',')
-                index = -1
-                indexData = None
-                for kv in split_text:
-                    if kv.startswith('p='):
-                        index = int(kv[2:])
-                    elif kv.startswith('d='):
-                        indexData = kv[2:]
-                    elif kv.startswith('a=') and kv != 'a=RS256':
-                        return None
-                    elif kv.startswith('t=') and kv != 't=x509':
-                        return None
-
-                if index != -1 and indexData is not None:
-                    segments[index] = indexData
-
-            keys = segments.keys()
-            keys = sorted(keys)
-
-            # Concatenate all of the key segments
-            for key in keys:
-                pembits = pembits + segments[key].strip('\n').strip('\\n').strip()
-
-            return '-----BEGIN PUBLIC KEY-----\n' + pembits + '\n-----END PUBLIC KEY-----\n'
+            if resolver is None:
+                records = await dns.asyncresolver.resolve(domain, 'TXT') # Get all text records
+            else:
+                records = await resolver.resolve(domain, 'TXT')
+            return _publickey_from_txt(records)
         except DNSException:
-            return None
+            return None, None
+
+
+def _publickey_from_txt(records):
+        """ Assembles the publickey from the p=/d= segments of the TXT records """
+        segments = {}
+
+        pembits = ''
+
+        ttl = records.rrset.ttl
+        record_strings = []
+        for record in records:
+            text = record.strings[0].decode('utf-8')
+            record_strings.append(text)
+            split_text = text.split(',')
+            index = -1
+            indexData = None
+            for kv in split_text:
+                if kv.startswith('p='):
+                    index = int(kv[2:])
+                elif kv.startswith('d='):
+                    indexData = kv[2:]
+                elif kv.startswith('a=') and kv != 'a=RS256':
+                    return None, ttl
+                elif kv.startswith('t=') and kv != 't=x509':
+                    return None, ttl
+
+            if index != -1 and indexData is not None:
+                segments[index] = indexData
+
+        keys = segments.keys()
+        keys = sorted(keys)
+
+        # Concatenate all of the key segments
+        for key in keys:
+            pembits = pembits + segments[key].strip('\n').strip('\\n').strip()
+
+        return '-----BEGIN PUBLIC KEY-----\n' + pembits + '\n-----END PUBLIC KEY-----\n', ttl
+
+
+async def get_publickey_async(domain, key_source=None):
+    """ Gets a publickey from a zone, or from key_source if given, without blocking the event loop """
+    if key_source is not None:
+        return (await key_source.fetch_async(domain))[0]
+    return (await _read_publickey_async(domain))[0]
+
+
+def _load_publickey(pem):
+    """ Parses a PEM public key, returning None if it is not valid """
+    if not pem:
+        return None
+    try:
+        return signature_verifier.load_key(pem)
+    except (ValueError, UnsupportedAlgorithm):
+        return None
+
+
+class KeySource(object):
+    """
+    A source of the public keys used to verify signatures.
+
+    Subclasses implement fetch. Instances can be passed as key_source to
+    get_publickey, PublicKeyCache and DomainConnect.verify_sig.
+    """
+
+    def fetch(self, domain):
+        """
+        Reads the public key published at a host.
+
+        :param domain: The key host, e.g. <key>.<syncPubKeyDomain>
+        :type domain: str
+
+        :return: The PEM public key or None, and the seconds it may be cached for or None
+        :rtype: tuple(str | None, int | None)
+        """
+        raise NotImplementedError()
+
+    async def fetch_async(self, domain):
+        """
+        Reads the public key published at a host without blocking the event loop.
+
+        By default this calls fetch, which suits sources that do no I/O.
+        """
+        return self.fetch(domain)
+
+    def get(self, domain):
+        """
+        Gets the parsed public key published at a host.
+
+        :param domain: The key host, e.g. <key>.<syncPubKeyDomain>
+        :type domain: str
+
+        :return: The public key, or None if there is no usable key
+        :rtype: cryptography public key object or None
+        """
+        return _load_publickey(self.fetch(domain)[0])
+
+    async def get_async(self, domain):
+        """ Gets the parsed public key published at a host without blocking the event loop """
+        return _load_publickey((await self.fetch_async(domain))[0])
+
+
+class DNSKeySource(KeySource):
+    """
+    Reads public keys from DNS with one configured dnspython Resolver.
+
+    Reusing the resolver keeps its nameserver configuration and its cache
+    across lookups. Asynchronous lookups use a dns.asyncresolver.Resolver
+    that shares the cache of the resolver.
+
+    :param resolver: The resolver to use. By default a Resolver for the
+        system configuration with a dnspython LRUCache of cache_size entries.
+    :type resolver: dns.resolver.Resolver
+    :param cache_size: Size of the LRUCache of the default resolver
+    :type cache_size: int
+    :param async_resolver: The resolver to use for asynchronous lookups. By
+        default a Resolver for the system configuration.
+    :type async_resolver: dns.asyncresolver.Resolver
+    """
+
+    def __init__(self, resolver=None, cache_size=1024, async_resolver=None):
+        if resolver is None:
+            resolver = dns.resolver.Resolver()
+            resolver.cache = dns.resolver.LRUCache(cache_size)
+        self.resolver = resolver
+        self._async_resolver = async_resolver
+
+    @property
+    def async_resolver(self):
+        """ The resolver of asynchronous lookups, created on first use """
+        if self._async_resolver is None:
+            self._async_resolver = dns.asyncresolver.Resolver()
+            self._async_resolver.cache = self.resolver.cache
+        return self._async_resolver
+
+    def fetch(self, domain):
+        return _read_publickey(domain, self.resolver)
+
+    async def fetch_async(self, domain):
+        return await _read_publickey_async(domain, self.async_resolver)
+
+
+class DictKeySource(KeySource):
+    """
+    Serves public keys from a mapping, e.g. for tests and benchmarks.
+
+    :param keys: PEM public keys keyed by key host
+    :type keys: dict(str, str)
+    :param ttl: Seconds a key from the mapping may be cached for
+    :type ttl: int
+    """
+
+    def __init__(self, keys, ttl=3600):
+        self.keys = keys
+        self.ttl = ttl
+
+    def fetch(self, domain):
+        pem = self.keys.get(domain)
+        if pem is None:
+            return None, None
+        return pem, self.ttl
+
+
+class _ResolveKeySource(KeySource):
+    """ Reads public keys from DNS with dns.resolver.resolve, like get_publickey """
+
+    def fetch(self, domain):
+        return _read_publickey(domain)
+
+    async def fetch_async(self, domain):
+        return await _read_publickey_async(domain)
+
+
+class PublicKeyCache(KeySource):
+    """
+    A cache of the public keys read from a key source, keyed by the key host.
+
+    Keys are stored parsed, so a cache hit skips both the DNS lookup and the
+    PEM parse. An entry lives for the TTL of the TXT records it was read from,
+    capped at max_ttl. Hosts without a usable key are cached as misses for
+    negative_ttl. When the cache holds max_size entries the least recently
+    used one is dropped. The cache can be shared between threads.
+
+    :param max_size: Maximum number of key hosts kept
+    :type max_size: int
+    :param negative_ttl: Seconds a host without a usable key is remembered
+    :type negative_ttl: int
+    :param max_ttl: Maximum seconds a key is kept, whatever the TTL of its records
+    :type max_ttl: int
+    :param key_source: The source keys are read from. By default they are
+        read from DNS with dns.resolver.resolve.
+    :type key_source: KeySource
+    """
+
+    def __init__(self, max_size=1024, negative_ttl=60, max_ttl=86400, key_source=None):
+        if key_source is None:
+            key_source = _ResolveKeySource()
+        self.key_source = key_source
+        self.max_size = max_size
+        self.negative_ttl = negative_ttl
+        self.max_ttl = max_ttl
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._inflight = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, domain):
+        """
+        Gets the public key published at a host, from the cache or from the key source.
+
+        :param domain: The key host, e.g. <key>.<syncPubKeyDomain>
+        :type domain: str
+
+        :return: The public key, or None if there is no usable key
+        :rtype: cryptography public key object or None
+        """
+        now = time.monotonic()
+        hit, public_key = self._lookup(domain, now)
+        if hit:
+            return public_key
+
+        pem, ttl = self.key_source.fetch(domain)
+        return self._store(domain, pem, ttl, now)
+
+    async def get_async(self, domain):
+        """
+        Gets the public key published at a host without blocking the event loop.
+
+        Concurrent calls for a host that is not cached share one lookup.
+
+        :param domain: The key host, e.g. <key>.<syncPubKeyDomain>
+        :type domain: str
+
+        :return: The public key, or None if there is no usable key
+        :rtype: cryptography public key object or None
+        """
+        now = time.monotonic()
+        hit, public_key = self._lookup(domain, now)
+        if hit:
+            return public_key
+
+        loop = asyncio.get_running_loop()
+        inflight_key = (loop, domain)
+        lookup = self._inflight.get(inflight_key)
+        if lookup is None:
+            lookup = loop.create_task(self._load_async(domain, now))
+            self._inflight[inflight_key] = lookup
+            lookup.add_done_callback(lambda _: self._inflight.pop(inflight_key, None))
+
+        # A cancelled caller must not cancel the lookup other callers wait for
+        return await asyncio.shield(lookup)
+
+    async def _load_async(self, domain, now):
+        pem, ttl = await self.key_source.fetch_async(domain)
+        return self._store(domain, pem, ttl, now)
+
+    def _lookup(self, domain, now):
+        """ Returns (True, key) for a live cache entry, else (False, None) """
+        with self._lock:
+            entry = self._entries.get(domain)
+            if entry is not None:
+                if entry[0] > now:
+                    self._entries.move_to_end(domain)
+                    return True, entry[1]
+                del self._entries[domain]
+        return False, None
+
+    def _store(self, domain, pem, ttl, now):
+        """ Parses and caches a key read from the key source """
+        public_key = _load_publickey(pem)
+
+        if public_key is None:
+            lifetime = self.negative_ttl
+        elif ttl is None:
+            lifetime = self.max_ttl
+        else:
+            lifetime = min(ttl, self.max_ttl)
+
+        self.put(domain, public_key, lifetime, now)
+        return public_key
+
+    def fetch(self, domain):
+        """ Reads the public key published at a host from the key source, bypassing the cache """
+        return self.key_source.fetch(domain)
+
+    async def fetch_async(self, domain):
+        """ Reads the public key published at a host from the key source, bypassing the cache """
+        return await self.key_source.fetch_async(domain)
+
+    def put(self, domain, public_key, lifetime, now=None):
+        """
+        Stores a public key, or a miss if public_key is None, for lifetime seconds.
+        """
+        if lifetime <= 0:
+            return
+        if now is None:
+            now = time.monotonic()
+        with self._lock:
+            self._entries[domain] = (now + lifetime, public_key)
+            self._entries.move_to_end(domain)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """ Drops all cached keys """
+        with self._lock:
+            self._entries.clear()
+
+
+# The cache used by DomainConnect.verify_sig
+publickey_cache = PublicKeyCache()
@@ -0,0 +1,303 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import select
+import struct
+import sys
+import threading
+
+from domainconnectzone.DomainConnectImpl import DomainConnect
+from domainconnectzone.DomainConnectTemplates import DomainConnectTemplates
+
+logger = logging.getLogger(__name__)
+
+# inotify event masks, see inotify(7)
+_IN_ATTRIB = 0x00000004
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM = 0x00000040
+_IN_MOVED_TO = 0x00000080
+_IN_CREATE = 0x00000100
+_IN_DELETE = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF = 0x00000800
+_IN_Q_OVERFLOW = 0x00004000
+_IN_IGNORED = 0x00008000
+_IN_CLOEXEC = 0o2000000
+
+_WATCH_MASK = (_IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO |
+               _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF)
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class _Inotify(object):
+    """ A minimal inotify watch of one directory through libc """
+
+    def __init__(self, path):
+        libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self._fd = libc.inotify_init1(_IN_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        if libc.inotify_add_watch(self._fd, os.fsencode(path), _WATCH_MASK) < 0:
+            errno = ctypes.get_errno()
+            os.close(self._fd)
+            raise OSError(errno, 'inotify_add_watch failed')
+
+    def read(self, timeout):
+        """
+        Waits up to timeout seconds for events.
+
+        :return: The names of the files changed, or None if the events were
+            lost or the directory is gone and it must be rescanned
+        :rtype: set(str) or None
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return set()
+
+        data = os.read(self._fd, 64 * 1024)
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = _EVENT_HEADER.unpack_from(data, offset)
+            offset += _EVENT_HEADER.size
+            if mask & (_IN_Q_OVERFLOW | _IN_IGNORED | _IN_DELETE_SELF | _IN_MOVE_SELF):
+                return None
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if name:
+                names.add(os.fsdecode(name))
+        return names
+
+    def close(self):
+        os.close(self._fd)
+
+
+class TemplateWatcher(object):
+    """
+    Keeps the templates of a template directory current while it changes.
+
+    Every template is held as a DomainConnect with its records compiled. When
+    files change, only those files are read and compiled again, and the
+    templates are swapped in as a whole: get never sees a half updated set.
+    Subscribers are then called with the keys of the templates changed.
+
+    The directory is watched with inotify on Linux, else it is polled every
+    interval seconds. If inotify events are lost, the watcher rescans the
+    directory and polls from then on. Call start to watch in a background
+    thread, or refresh to check for changes yourself.
+
+    The directory is read when the watcher is created. With start, it is
+    read by the watch thread once the watch is in place, so no change is
+    missed between the two and the directory is read once.
+
+    :param template_path: Path to the template directory.
+    :type template_path: str
+    :param redir_template_records: Redirect template records for templates
+        with REDIR301/REDIR302 records.
+    :type redir_template_records: list
+    :param interval: Seconds between two polls, and the longest time stop
+        waits for the watch thread.
+    :type interval: float
+    :param use_inotify: Whether to use inotify where available.
+    :type use_inotify: bool
+    :param start: Whether to start watching right away.
+    :type start: bool
+
+    :raises: InvalidTemplate: If the template directory is not readable.
+    """
+
+    def __init__(self, template_path=None, redir_template_records=None,
+                 interval=1.0, use_inotify=True, start=False):
+        self.templates = DomainConnectTemplates(template_path)
+        self._template_path = self.templates._template_path
+        self._redir_template_records = redir_template_records
+        self.interval = interval
+        self.use_inotify = use_inotify and sys.platform.startswith('linux')
+
+        # (providerid, serviceid) -> DomainConnect, replaced as a whole
+        self._domain_connects = {}
+        # fileName -> (providerid, serviceid) of the template in it
+        self._file_keys = {}
+        # whether the directory was read in full once
+        self._loaded = False
+        self._subscribers = []
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+
+        if start:
+            self.start()
+        # a no-op if the watch thread read the directory
+        self._load()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def get(self, provider_id, service_id):
+        """
+        Gets the current version of a template.
+
+        :param provider_id: The providerId of the template, in any case
+        :type provider_id: str
+        :param service_id: The serviceId of the template, in any case
+        :type service_id: str
+
+        :return: The template, or None if there is no such template
+        :rtype: DomainConnect or None
+        """
+        return self._domain_connects.get((provider_id.lower(), service_id.lower()))
+
+    def subscribe(self, callback):
+        """
+        Calls callback with the list of (providerid, serviceid) keys of the
+        templates added, changed or removed, after they were swapped in.
+        """
+        with self._lock:
+            self._subscribers = self._subscribers + [callback]
+
+    def unsubscribe(self, callback):
+        """ Stops calling callback """
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s != callback]
+
+    def refresh(self, file_names=None):
+        """
+        Reads the files changed and swaps in their templates.
+
+        :param file_names: The names of the files to check. By default the
+            whole directory is checked.
+        :type file_names: iterable(str)
+
+        :return: The (providerid, serviceid) keys of the templates added, changed or removed
+        :rtype: list(tuple(str, str))
+        """
+        with self._lock:
+            changed = self._swap(file_names)
+            if not changed:
+                return []
+            subscribers = self._subscribers
+
+        for callback in subscribers:
+            try:
+                callback(changed)
+            except Exception:
+                # one failing subscriber must not stop the others or the watch
+                logger.exception('Template watcher subscriber failed')
+        return changed
+
+    def _load(self):
+        """ Reads the whole directory the first time, without calling the subscribers """
+        with self._lock:
+            if not self._loaded:
+                self._swap(None)
+                self._loaded = True
+
+    def _swap(self, file_names):
+        """ Swaps in the templates of the files changed; called with the lock held """
+        catalog = self.templates.catalog
+        if file_names is None:
+            changed_files = catalog.refresh()
+        else:
+            changed_files = catalog.update(file_names)
+        if not changed_files:
+            return []
+
+        domain_connects = dict(self._domain_connects)
+        changed = []
+        for file_name in changed_files:
+            key = self._file_keys.pop(file_name, None)
+            if key is not None:
+                domain_connects.pop(key, None)
+                changed.append(key)
+
+            entry = catalog.get_file(file_name)
+            if entry is None:
+                continue
+            key = (entry['providerId'].lower(), entry['serviceId'].lower())
+            domain_connects[key] = self._compile(entry['template'])
+            self._file_keys[file_name] = key
+            if key not in changed:
+                changed.append(key)
+
+        self._domain_connects = domain_connects
+        return changed
+
+    def _compile(self, template):
+        dc = DomainConnect(template=template,
+                           redir_template_records=self._redir_template_records)
+        try:
+            dc.compiled_template
+        except Exception:
+            # Raised again when the template is applied
+            logger.exception('Template watcher cannot compile template %s / %s',
+                             template.get('providerId'), template.get('serviceId'))
+        return dc
+
+    def start(self):
+        """ Starts watching the directory in a background thread """
+        if self._thread is not None:
+            return
+        self._stopping.clear()
+        ready = threading.Event()
+        self._thread = threading.Thread(target=self._run, args=(ready,), name='TemplateWatcher', daemon=True)
+        self._thread.start()
+        # changes made once start returns reach the subscribers
+        ready.wait()
+
+    def stop(self):
+        """ Stops watching the directory """
+        if self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self, ready):
+        inotify = None
+        if self.use_inotify:
+            try:
+                inotify = _Inotify(self._template_path)
+            except (OSError, AttributeError):
+                # no inotify in this libc or no watches left: poll instead
+                inotify = None
+
+        try:
+            try:
+                if not self._loaded:
+                    # the watch is in place, so no change after this read goes unseen
+                    self._load()
+                elif inotify is not None:
+                    # the templates were read before the watch: pick up what changed
+                    # since. Polling needs no such refresh, its first poll does the same.
+                    self.refresh()
+            except Exception:
+                # __init__ reads the directory again if this failed, changes are still watched
+                logger.exception('Template watcher cannot read %s', self._template_path)
+            ready.set()
+            while not self._stopping.is_set():
+                try:
+                    if inotify is not None:
+                        file_names = inotify.read(self.interval)
+                        if file_names is None:
+                            inotify.close()
+                            inotify = None
+                            self.refresh()
+                        elif file_names:
+                            self.refresh(file_names)
+                    elif not self._stopping.wait(self.interval):
+                        # the catalog stats every file and reads only those changed
+                        self.refresh()
+                except Exception:
+                    # e.g. the directory is gone for now: keep the templates we have
+                    logger.exception('Template watcher cannot read %s', self._template_path)
+                    self._stopping.wait(self.interval)
+        finally:
+            ready.set()
+            if inotify is not None:
+                inotify.close()
@@ -57,6 +57,11 @@ setup(
     url='https://github.com/Domain-Connect/domainconnectzone',
     long_description=LONG_DESCRIPTION,
     packages=find_packages(exclude=["test", "test.*"]),
+    entry_points={
+        'console_scripts': [
+            'domainconnect-check-templates=domainconnectzone.checktemplates:main',
+        ],
+    },
     install_requires=[
         'ipy>=1.1',
     ],
@@ -11,6 +11,7 @@ tightly coupled to the Python API surface:
   - prompt() (deprecated helper)
   - is_custom_record_type() and get_records_variables() (validator helpers)
 """
+import json
 import os
 import sys
 import unittest
@@ -109,6 +110,96 @@ class DomainConnectTests(unittest.TestCase):
             dc.verify_sig(query_string + "&blah=blah", signature, key)
         self.assertEqual("Signature not valid", str(ex.exception))
 
+    @patch('dns.resolver.resolve')
+    def test_DomainConnectClass_verify_sig_cached_key(self, mock_resolve):
+        from domainconnectzone.sigutil import generate_sig, publickey_cache
+        try:
+            from .test_sigutil import _make_keypair, _txt_answer
+        except ImportError:
+            from test_sigutil import _make_keypair, _txt_answer
+
+        private_pem, public_pem = _make_keypair()
+        mock_resolve.return_value = _txt_answer(public_pem)
+        publickey_cache.clear()
+        dc = DomainConnect(template={"providerId": "foo", 'serviceId': "ser",
+                                     "syncPubKeyDomain": "cached.example.com"})
+        query_string = "a=1&domain=foobar.com"
+        signature = generate_sig(private_pem, query_string).decode()
+
+        dc.verify_sig(query_string, signature, "_dck1")
+        dc.verify_sig(query_string, signature, "_dck1")
+        with self.assertRaises(InvalidSignature):
+            dc.verify_sig(query_string + "&b=2", signature, "_dck1")
+        mock_resolve.assert_called_once_with("_dck1.cached.example.com", 'TXT')
+        publickey_cache.clear()
+
+    def test_DomainConnectClass_verify_sig_key_source(self):
+        from domainconnectzone.sigutil import generate_sig
+        try:
+            from .test_sigutil import _make_keypair
+        except ImportError:
+            from test_sigutil import _make_keypair
+
+        private_pem, public_pem = _make_keypair()
+        key_source = DictKeySource({"_dck1.example.com": public_pem})
+        dc = DomainConnect(template={"providerId": "foo", 'serviceId': "ser",
+                                     "syncPubKeyDomain": "example.com", "records": []})
+        query_string = "a=1&domain=foobar.com"
+        signature = generate_sig(private_pem, query_string).decode()
+
+        dc.verify_sig(query_string, signature, "_dck1", key_source=key_source)
+        dc.apply_template([], "foobar.com", None, {}, qs=query_string, sig=signature,
+                          key="_dck1", key_source=key_source)
+        with self.assertRaises(InvalidSignature) as ex:
+            dc.verify_sig(query_string, signature, "_dck2", key_source=key_source)
+        self.assertEqual("Unable to get public key for template/key from _dck2.example.com",
+                         str(ex.exception))
+
+    def test_DomainConnectClass_apply_template_async(self):
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+        from domainconnectzone.sigutil import generate_sig
+        try:
+            from .test_sigutil import _make_keypair
+        except ImportError:
+            from test_sigutil import _make_keypair
+
+        private_pem, public_pem = _make_keypair()
+        key_source = DictKeySource({"_dck1.example.com": public_pem})
+        dc = DomainConnect(template={"providerId": "foo", 'serviceId': "ser",
+                                     "syncPubKeyDomain": "example.com",
+                                     "records": [{"type": "A", "host": "@",
+                                                  "pointsTo": "%ip%", "ttl": 600}]})
+        query_string = "ip=1.1.1.1&domain=foobar.com"
+        signature = generate_sig(private_pem, query_string).decode()
+        expected = dc.apply_template([], "FooBar.com", None, {"ip": "1.1.1.1"},
+                                     qs=query_string, sig=signature, key="_dck1",
+                                     key_source=key_source)
+
+        async def apply(executor=None):
+            return await dc.apply_template_async([], "FooBar.com", None, {"ip": "1.1.1.1"},
+                                                 qs=query_string, sig=signature, key="_dck1",
+                                                 key_source=key_source, executor=executor)
+
+        self.assertEqual(asyncio.run(apply()), expected)
+        with ThreadPoolExecutor(1) as executor:
+            self.assertEqual(asyncio.run(apply(executor)), expected)
+
+        with self.assertRaises(InvalidSignature) as ex:
+            asyncio.run(dc.verify_sig_async(query_string + "&b=2", signature, "_dck1",
+                                            key_source=key_source))
+        self.assertEqual("Signature not valid", str(ex.exception))
+        with self.assertRaises(InvalidSignature) as ex:
+            asyncio.run(dc.verify_sig_async(query_string, signature, "_dck2",
+                                            key_source=key_source))
+        self.assertEqual("Unable to get public key for template/key from _dck2.example.com",
+                         str(ex.exception))
+
+        dc = DomainConnect(template={"providerId": "foo", 'serviceId': "ser",
+                                     "hostRequired": True, "records": []})
+        with self.assertRaises(HostRequired):
+            asyncio.run(dc.apply_template_async([], "foobar.com", None, {}))
+
     def test_is_sig_required(self):
         dc = DomainConnect(template={'providerId': "foo.com", 'serviceId': "bar",
                                      'syncPubKeyDomain': 'example.com'})
@@ -147,6 +238,80 @@ class DomainConnectTests(unittest.TestCase):
         self.assertEqual(dc.provider_id, "foo.com")
         self.assertEqual(dc.service_id, "bar")
 
+    def test_domain_connect_template_cache(self):
+        import shutil
+        import tempfile
+
+        template_dir = tempfile.mkdtemp()
+        try:
+            def write(template):
+                with open(os.path.join(template_dir, 'foo.bar.json'), 'w') as f:
+                    json.dump(template, f)
+
+            write({"providerId": "foo", "serviceId": "bar", "records": []})
+            shutil.copy(os.path.join(self.template_dir, 'exampleservice.domainconnect.org.template1.json'),
+                        template_dir)
+            cache = TemplateCache(max_size=1)
+
+            dc = DomainConnect('Foo', 'Bar', template_dir, template_cache=cache)
+            self.assertIs(DomainConnect('foo', 'bar', template_dir, template_cache=cache).data, dc.data)
+            self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+            write({"providerId": "foo", "serviceId": "bar", "version": 2, "records": []})
+            self.assertEqual(DomainConnect('foo', 'bar', template_dir, template_cache=cache).data['version'], 2)
+            self.assertEqual(cache.stats()['misses'], 2)
+
+            DomainConnect('exampleservice.domainconnect.org', 'template1', template_dir, template_cache=cache)
+            DomainConnect('foo', 'bar', template_dir, template_cache=cache)
+            self.assertEqual(cache.stats(), {'hits': 1, 'misses': 4, 'size': 1})
+
+            os.remove(os.path.join(template_dir, 'foo.bar.json'))
+            with self.assertRaises(InvalidTemplate):
+                DomainConnect('foo', 'bar', template_dir, template_cache=cache)
+        finally:
+            shutil.rmtree(template_dir)
+
+    def test_domain_connect_template_cache_compiled_template(self):
+        import shutil
+        import tempfile
+
+        template_dir = tempfile.mkdtemp()
+        try:
+            def write(ip):
+                with open(os.path.join(template_dir, 'foo.bar.json'), 'w') as f:
+                    json.dump({"providerId": "foo", "serviceId": "bar", "records": [
+                        {"type": "A", "host": "@", "pointsTo": ip, "ttl": 300},
+                        {"type": "REDIR301", "host": "www", "target": "http://example.com"},
+                    ]}, f)
+
+            write('1.1.1.1')
+            cache = TemplateCache()
+            redir = [{"type": "A", "host": "@", "pointsTo": "127.0.0.1", "ttl": 600}]
+
+            dc = DomainConnect('foo', 'bar', template_dir, redir_template_records=redir,
+                               template_cache=cache)
+            other = DomainConnect('foo', 'bar', template_dir, redir_template_records=list(redir),
+                                  template_cache=cache)
+            self.assertIs(other.compiled_template, dc.compiled_template)
+            self.assertEqual(other.apply_template([], 'example.com', None, {})[0][0]['data'], '1.1.1.1')
+
+            # other redirect records are compiled apart
+            other_redir = [{"type": "A", "host": "@", "pointsTo": "127.0.0.2", "ttl": 600}]
+            self.assertIsNot(DomainConnect('foo', 'bar', template_dir, redir_template_records=other_redir,
+                                           template_cache=cache).compiled_template,
+                             dc.compiled_template)
+            with self.assertRaises(InvalidTemplate):
+                DomainConnect('foo', 'bar', template_dir, template_cache=cache).compiled_template
+
+            # a changed file is compiled again
+            write('22.2.2.2')
+            changed = DomainConnect('foo', 'bar', template_dir, redir_template_records=redir,
+                                    template_cache=cache)
+            self.assertIsNot(changed.compiled_template, dc.compiled_template)
+            self.assertEqual(changed.apply_template([], 'example.com', None, {})[0][0]['data'], '22.2.2.2')
+        finally:
+            shutil.rmtree(template_dir)
+
     # ------------------------------------------------------------------
     # Deprecated prompt() helper
     # ------------------------------------------------------------------
@@ -185,6 +350,387 @@ class DomainConnectTests(unittest.TestCase):
         self.assertIsNone(params['issuer'])
         self.assertIsNone(params['subdomain'])
 
+    # ------------------------------------------------------------------
+    # Compiled templates
+    # ------------------------------------------------------------------
+    def test_compiled_template_reused(self):
+        template_records = [
+            {'type': 'A', 'host': '%sub%', 'pointsTo': '%ip%', 'ttl': '%ttl%', 'groupId': 'a'},
+            {'type': 'TXT', 'host': '@', 'data': 'x=%fqdn%', 'ttl': 300, 'groupId': 'b'},
+        ]
+        original = json.loads(json.dumps(template_records))
+        compiled = CompiledTemplate(template_records)
+        self.assertEqual(compiled.group_ids, ['a', 'b'])
+
+        new_records, _, _ = compiled.apply(
+            [], 'foo.com', 'bar', {'sub': 'www', 'ip': '127.0.0.1', 'ttl': '600'})
+        self.assertEqual(new_records, [
+            {'type': 'A', 'name': 'www.bar', 'data': '127.0.0.1', 'ttl': 600},
+            {'type': 'TXT', 'name': 'bar', 'data': 'x=bar.foo.com', 'ttl': 300},
+        ])
+
+        new_records, _, _ = compiled.apply(
+            [], 'example.com', None, {'sub': 'abc', 'ip': '127.0.0.2', 'ttl': '900'},
+            group_ids=['a'])
+        self.assertEqual(new_records, [
+            {'type': 'A', 'name': 'abc', 'data': '127.0.0.2', 'ttl': 900},
+        ])
+
+        with self.assertRaises(MissingParameter):
+            compiled.apply([], 'foo.com', 'bar', {'sub': 'www', 'ttl': '600'})
+        self.assertEqual(template_records, original)
+
+    def test_compiled_template_errors_deferred_to_apply(self):
+        compiled = CompiledTemplate([
+            {'type': 'A', 'host': '@', 'pointsTo': '127.0.0.1', 'ttl': 300, 'groupId': '1'},
+            {'type': 'BAD_TYPE!', 'host': '@', 'data': 'x', 'ttl': 300, 'groupId': '2'},
+        ])
+        new_records, _, _ = compiled.apply([], 'foo.com', None, {}, group_ids=['1'])
+        self.assertEqual(len(new_records), 1)
+        with self.assertRaises(TypeError):
+            compiled.apply([], 'foo.com', None, {})
+
+    def test_resolve_variables_tokens_cached(self):
+        from domainconnectzone.DomainConnectImpl import _tokenise_variables
+        self.assertEqual(_tokenise_variables('a%x%b%fqdn%'), (('a', 'x', 'b', 'fqdn', ''), False))
+        self.assertEqual(_tokenise_variables('a%x'), (('a%x',), True))
+
+        hits = _tokenise_variables.cache_info().hits
+        for value in ('1', '2'):
+            self.assertEqual(
+                resolve_variables('%v%.%fqdn%', 'foo.com', 'bar', {'v': value}, 'data'),
+                value + '.bar.foo.com')
+        self.assertEqual(_tokenise_variables.cache_info().hits, hits + 1)
+
+        # Each delimiter pair is consumed once, left to right
+        self.assertEqual(
+            resolve_variables('%a%%fqdn%a%domain%', 'foo.com', None, {'a': 'x'}, 'data'),
+            'xfoo.comafoo.com')
+
+    def test_DomainConnectClass_compiled_template_built_once(self):
+        import domainconnectzone.DomainConnectImpl as impl
+
+        cache = TemplateCache()
+        with patch.object(impl, 'CompiledTemplate', wraps=impl.CompiledTemplate) as compiled:
+            new_records = [
+                DomainConnect('exampleservice.domainconnect.org', 'template1', self.template_dir,
+                              template_cache=cache).apply_template(
+                    [], 'foo.com', host, {'IP': ip, 'RANDOMTEXT': 'shm:1:x'})[0]
+                for host, ip in (('bar', '127.0.0.1'), (None, '127.0.0.2'), ('bar', '127.0.0.1'))
+            ]
+        compiled.assert_called_once()
+        self.assertEqual(new_records[0], new_records[2])
+        self.assertEqual(new_records[1], [
+            {'type': 'A', 'name': '@', 'data': '127.0.0.2', 'ttl': 1800},
+            {'type': 'TXT', 'name': '@', 'data': 'shm:1:x', 'ttl': 1800},
+        ])
+
+    # ------------------------------------------------------------------
+    # Batch application
+    # ------------------------------------------------------------------
+    def _batch_jobs(self):
+        return [
+            ([], 'foo.com', 'bar', {'IP': '127.0.0.1', 'RANDOMTEXT': 'a'}),
+            {'zone_records': [{'type': 'A', 'name': 'bar', 'data': '127.0.0.2', 'ttl': 300}],
+             'domain': 'example.com', 'host': 'bar',
+             'params': {'IP': '127.0.0.3', 'RANDOMTEXT': 'b'}},
+            ([], 'foo.com', 'bar', {'RANDOMTEXT': 'c'}),
+        ]
+
+    def test_apply_template_batch(self):
+        dc = DomainConnect('exampleservice.domainconnect.org', 'template1', self.template_dir)
+        jobs = self._batch_jobs()
+        outcomes = list(dc.apply_template_batch(iter(jobs)))
+
+        self.assertEqual(len(outcomes), 3)
+        self.assertEqual(outcomes[0], dc.apply_template(*jobs[0]))
+        self.assertEqual(outcomes[1], dc.apply_template(**jobs[1]))
+        self.assertEqual(len(outcomes[1][1]), 1)
+        self.assertIsInstance(outcomes[2], MissingParameter)
+        self.assertEqual([apply_job(dc, job) for job in jobs[:2]], outcomes[:2])
+        self.assertIsInstance(apply_job(dc, jobs[2]), MissingParameter)
+
+    def test_apply_template_batch_processes(self):
+        dc = DomainConnect('exampleservice.domainconnect.org', 'template1', self.template_dir)
+        jobs = self._batch_jobs() * 5
+        outcomes = list(dc.apply_template_batch(jobs, processes=2, chunksize=2, max_pending=1))
+        expected = list(dc.apply_template_batch(jobs))
+
+        self.assertEqual(len(outcomes), len(jobs))
+        for outcome, expect in zip(outcomes, expected):
+            if isinstance(expect, Exception):
+                self.assertIsInstance(outcome, type(expect))
+                self.assertEqual(str(outcome), str(expect))
+            else:
+                self.assertEqual(outcome, expect)
+
+    # ------------------------------------------------------------------
+    # Zone index used by the record processors
+    # ------------------------------------------------------------------
+    def test_zone_index_find(self):
+        from domainconnectzone.DomainConnectImpl import _ZoneIndex
+        zone_records = [
+            {'type': 'a', 'name': 'WWW', 'data': '127.0.0.1', 'ttl': 300},
+            {'type': 'CNAME', 'name': 'www', 'data': 'foo.com', 'ttl': 300},
+            {'type': 'A', 'name': 'www', 'data': '127.0.0.2', 'ttl': 300},
+            {'type': 'A', 'name': 'xwww', 'data': '127.0.0.3', 'ttl': 300},
+        ]
+        index = _ZoneIndex(zone_records)
+        self.assertEqual(list(index), zone_records)
+        self.assertEqual(index.find('www', ['A']), [zone_records[0], zone_records[2]])
+        self.assertEqual(index.find('www', ['A', 'CNAME']),
+                         [zone_records[0], zone_records[2], zone_records[1]])
+        self.assertEqual(index.find('www', ['MX']), [])
+
+    def test_zone_index_subtree_and_ancestors(self):
+        from domainconnectzone.DomainConnectImpl import _ZoneIndex
+        zone_records = [
+            {'type': 'NS', 'name': 'bar', 'data': 'ns1.foo.com', 'ttl': 300},
+            {'type': 'A', 'name': 'foo.bar', 'data': '127.0.0.1', 'ttl': 300},
+            {'type': 'NS', 'name': 'www.foo.bar', 'data': 'ns2.foo.com', 'ttl': 300},
+            {'type': 'NS', 'name': 'xbar', 'data': 'ns3.foo.com', 'ttl': 300},
+            {'type': 'A', 'name': '@', 'data': '127.0.0.2', 'ttl': 300},
+        ]
+        index = _ZoneIndex(zone_records)
+
+        def names(records):
+            return sorted(r['name'] for r in records)
+
+        self.assertEqual(names(index.subtree('bar')), ['bar', 'foo.bar', 'www.foo.bar'])
+        self.assertEqual(names(index.subtree('www.foo.bar')), ['www.foo.bar'])
+        self.assertEqual(index.subtree('nope.bar'), [])
+        self.assertEqual(names(index.ancestors('www.foo.bar', ['NS'])), ['bar', 'www.foo.bar'])
+        self.assertEqual(names(index.ancestors('abc.foo.bar', ['NS'])), ['bar'])
+        self.assertEqual(index.ancestors('abc.xbar.com', ['NS']), [])
+
+    def test_process_other_record_plain_list(self):
+        from domainconnectzone.DomainConnectImpl import process_other_record
+        zone_records = [
+            {'type': 'CNAME', 'name': 'Bar', 'data': 'foo.com', 'ttl': 300},
+            {'type': 'A', 'name': 'bar', 'data': '127.0.0.2', 'ttl': 300, '_replace': True},
+            {'type': 'TXT', 'name': 'bar', 'data': 'abc', 'ttl': 300},
+        ]
+        new_record = process_other_record(
+            {'type': 'A', 'host': 'bar', 'pointsTo': '127.0.0.1', 'ttl': 600}, zone_records)
+        self.assertEqual(new_record, {'type': 'A', 'name': 'bar', 'data': '127.0.0.1', 'ttl': 600})
+        self.assertIn('_delete', zone_records[0])
+        self.assertNotIn('_delete', zone_records[1])
+        self.assertNotIn('_delete', zone_records[2])
+
+    def test_provenance_index(self):
+        from domainconnectzone.DomainConnectImpl import _ProvenanceIndex
+
+        def dc(provider_id, host, essential='Always'):
+            return {'id': '1', 'providerId': provider_id, 'serviceId': 's', 'host': host, 'essential': essential}
+
+        zone_records = [
+            {'type': 'A', 'name': 'a', '_dc': dc('p', 'bar', 'OnApply')},
+            {'type': 'A', 'name': 'b', '_dc': dc('p', 'bar')},
+            {'type': 'A', 'name': 'c', '_dc': dc('p', 'baz')},
+            {'type': 'A', 'name': 'd', '_dc': dc('q', 'bar')},
+            {'type': 'A', 'name': 'e'},
+        ]
+        index = _ProvenanceIndex(zone_records)
+        self.assertFalse(index.irregular)
+        index.mark_replaced('p', 's', 'bar')
+        self.assertEqual([r['name'] for r in zone_records if '_replace' in r], ['a', 'b'])
+        index.mark_replaced('p', 's', None)
+        self.assertEqual([r['name'] for r in zone_records if '_replace' in r], ['a', 'b'])
+
+        zone_records[0]['_delete'] = 1
+        zone_records[3]['_delete'] = 1
+        index.cascade_deletes()
+        self.assertEqual([r['name'] for r in zone_records if '_delete' in r], ['a', 'd'])
+        zone_records[1]['_delete'] = 1
+        index.cascade_deletes()
+        self.assertEqual([r['name'] for r in zone_records if '_delete' in r], ['a', 'b', 'd'])
+
+        # a _dc without host is only compared by the full scans, as before the index
+        zone_records.append({'type': 'A', 'name': 'f', '_dc': {'providerId': 'p', 'serviceId': 's'}})
+        index = _ProvenanceIndex(zone_records)
+        self.assertTrue(index.irregular)
+        with self.assertRaises(KeyError):
+            index.cascade_deletes()
+
+    def test_find_identical_zone_record(self):
+        from domainconnectzone.DomainConnectImpl import _ZoneIndex, _find_identical_zone_record
+        zone_records = [
+            {'type': 'TXT', 'name': 'bar', 'data': 'abc', 'ttl': 300, '_dc': {'id': '1'}},
+            {'type': 'TXT', 'name': 'bar', 'data': 'abc', 'ttl': 600, 'priority': ''},
+            {'type': 'MX', 'name': 'bar', 'data': 'mx.foo.com', 'ttl': 600, 'priority': 10},
+        ]
+        index = _ZoneIndex(zone_records)
+        new_record = {'type': 'TXT', 'name': 'bar', 'data': 'abc', 'ttl': 3600}
+        for zone in (zone_records, index):
+            self.assertIs(_find_identical_zone_record(new_record, zone), zone_records[0])
+            self.assertIs(_find_identical_zone_record(
+                {'type': 'MX', 'name': 'bar', 'data': 'mx.foo.com', 'priority': '10'}, zone), zone_records[2])
+            self.assertIsNone(_find_identical_zone_record(
+                {'type': 'MX', 'name': 'bar', 'data': 'mx.foo.com', 'priority': 20}, zone))
+
+        zone_records[0]['_delete'] = 1
+        self.assertIs(_find_identical_zone_record(new_record, index), zone_records[1])
+        zone_records[1]['_replace'] = True
+        self.assertIsNone(_find_identical_zone_record(new_record, index))
+
+    def test_check_conflict_with_self_index(self):
+        from domainconnectzone.DomainConnectImpl import _SelfConflictIndex, check_conflict_with_self
+        records = [
+            {'type': 'TXT', 'name': 'www'},
+            {'type': 'A', 'name': 'c.b.a'},
+            {'type': 'NS', 'name': 'x.a'},
+            {'type': 'CNAME', 'name': 'foo'},
+        ]
+        index = _SelfConflictIndex()
+        for record in records:
+            check_conflict_with_self(record, index)
+            index.add(record)
+
+        for new_record, message in [
+                ({'type': 'CNAME', 'name': 'www'}, 'CNAME www conflicts with other tempate record TXT www'),
+                ({'type': 'A', 'name': 'foo'}, 'A foo conflicts with other tempate record CNAME foo'),
+                ({'type': 'NS', 'name': 'a'}, 'NS a conflicts with other tempate record A c.b.a'),
+                ({'type': 'NS', 'name': 'b.a'}, 'NS b.a conflicts with other tempate record A c.b.a'),
+                ({'type': 'TXT', 'name': 'y.x.a'}, 'TXT y.x.a conflicts with other tempate record NS x.a'),
+                ({'type': 'TXT', 'name': 'x.a'}, 'TXT x.a conflicts with other tempate record NS x.a')]:
+            for new_records in (records, index):
+                with self.assertRaises(InvalidData) as context:
+                    check_conflict_with_self(new_record, new_records)
+                self.assertEqual(str(context.exception), 'Template record ' + message)
+
+        for new_record in ({'type': 'NS', 'name': 'y.x.a'}, {'type': 'NS', 'name': 'd.c.b.a'},
+                           {'type': 'TXT', 'name': 'xx.a'}, {'type': 'A', 'name': 'b.a'}):
+            check_conflict_with_self(new_record, records)
+            check_conflict_with_self(new_record, index)
+
+    def test_multi_aware_cascade(self):
+        zone_records = [
+            {'type': 'A', 'name': 'h%d' % i, 'data': '127.0.0.1', 'ttl': 300,
+             '_dc': {'id': '1', 'providerId': 'p%d' % (i % 3), 'serviceId': 's', 'host': 'h',
+                     'essential': 'Always' if i % 2 else 'OnApply'}}
+            for i in range(12)]
+        template_records = [{'type': 'CNAME', 'host': 'h1', 'pointsTo': 'foo.com', 'ttl': 300}]
+        new_records, deleted_records, final_records = process_records(
+            template_records, zone_records, 'foo.com', None, {}, None,
+            multi_aware=True, provider_id='p0', service_id='s', unique_id='u')
+        self.assertEqual(len(new_records), 1)
+        # h1 belongs to p1, so every record of p1 / s / h goes with it
+        self.assertEqual(sorted(r['name'] for r in deleted_records), ['h1', 'h10', 'h4', 'h7'])
+        self.assertEqual(len(final_records), 9)
+
+    def test_diff_only(self):
+        zone_records = [
+            {'type': 'A', 'name': 'bar', 'data': '127.0.0.2', 'ttl': 300},
+            {'type': 'TXT', 'name': 'bar', 'data': 'abc', 'ttl': 300},
+            {'type': 'MX', 'name': '@', 'data': 'mx.foo.com', 'ttl': 300, 'priority': 10},
+        ]
+        template_records = [{'type': 'A', 'host': '@', 'pointsTo': '127.0.0.1', 'ttl': 600}]
+        new_records, deleted_records, _ = process_records(
+            template_records, json.loads(json.dumps(zone_records)), 'foo.com', 'bar', {}, None)
+
+        changes = process_records(template_records, json.loads(json.dumps(zone_records)),
+                                  'foo.com', 'bar', {}, None, diff_only=True)
+        self.assertIsInstance(changes, ChangeSet)
+        self.assertEqual(changes, (new_records, deleted_records))
+        self.assertEqual((changes.new_count, changes.deleted_count), (1, 1))
+
+        zone = NormalisedZone(zone_records)
+        self.assertEqual(CompiledTemplate(template_records).apply(zone, 'foo.com', 'bar', {}, diff_only=True),
+                         changes)
+
+        dc = DomainConnect('exampleservice.domainconnect.org', 'template1', self.template_dir)
+        params = {'IP': '127.0.0.1', 'RANDOMTEXT': 'shm:1:a'}
+        new_records, deleted_records, _ = dc.apply_template(zone_records, 'foo.com', 'bar', params)
+        changes = dc.apply_template(zone_records, 'foo.com', 'bar', params, diff_only=True)
+        self.assertEqual(changes.new_records, new_records)
+        self.assertEqual(changes.deleted_records, deleted_records)
+
+    def test_process_records_stream(self):
+        zone_records = [
+            {'type': 'A', 'name': 'www', 'data': '127.0.0.2', 'ttl': 300},
+            {'type': 'NS', 'name': 'bar', 'data': 'ns.foo.com', 'ttl': 300},
+            {'type': 'A', 'name': 'sub.ns', 'data': '127.0.0.3', 'ttl': 300},
+            {'type': 'TXT', 'name': 'Other', 'data': 'Abc', 'ttl': 300},
+            {'type': 'CNAME', 'name': 'gone', 'data': 'foo.com', 'ttl': 300, '_delete': 1},
+        ] + [{'type': 'TXT', 'name': 'h%d' % i, 'data': 'x', 'ttl': 300} for i in range(20)]
+        template_records = [
+            {'type': 'A', 'host': 'WWW', 'pointsTo': '127.0.0.1', 'ttl': 600},
+            {'type': 'TXT', 'host': 'x.foo.bar', 'data': 'abc', 'ttl': 600},
+            {'type': 'NS', 'host': 'ns', 'pointsTo': 'ns1.foo.com', 'ttl': 600},
+        ]
+        expected = process_records(template_records, json.loads(json.dumps(zone_records)),
+                                   'foo.com', None, {}, None)
+        self.assertEqual(len(expected[1]), 4)
+
+        seen = []
+
+        def stream():
+            for zone_record in zone_records:
+                seen.append(zone_record['name'])
+                yield dict(zone_record)
+
+        new_records, deleted_records, final_records = process_records_stream(
+            template_records, stream(), 'foo.com', None, {}, None, final_records=False)
+        self.assertEqual((new_records, deleted_records), expected[:2])
+        self.assertIsNone(final_records)
+        self.assertEqual(len(seen), len(zone_records))
+
+        compiled = CompiledTemplate(template_records)
+        new_records, deleted_records, final_records = compiled.apply_stream(
+            json.loads(json.dumps(zone_records)), 'foo.com', None, {})
+        self.assertEqual((new_records, deleted_records), expected[:2])
+        self.assertEqual(list(final_records), expected[2])
+
+        with self.assertRaises(ValueError):
+            compiled.apply_stream(iter(zone_records), 'foo.com', None, {})
+        # errors are raised as by process_records, after the records before them
+        with self.assertRaises(MissingParameter):
+            process_records_stream(template_records + [{'type': 'A', 'host': '%x%', 'pointsTo': '127.0.0.1', 'ttl': 1}],
+                                   iter(zone_records), 'foo.com', None, {}, None, final_records=False)
+
+    # ------------------------------------------------------------------
+    # Normalised zones
+    # ------------------------------------------------------------------
+    def test_normalise_record_preserve_fields(self):
+        from domainconnectzone.DomainConnectImpl import _normalise_record
+        self.assertEqual(_normalise_record({'type': 'txt', 'name': 'WWW', 'data': 'Abc'}),
+                         {'type': 'TXT', 'name': 'www', 'data': 'Abc'})
+        self.assertEqual(_normalise_record({'type': 'Caa', 'name': 'WWW', 'data': 'Abc'}),
+                         {'type': 'CAA', 'name': 'www', 'data': 'Abc'})
+        self.assertEqual(_normalise_record({'type': 'cname', 'name': 'WWW', 'data': 'Foo.COM',
+                                            '_dc': {'providerId': 'P'}}),
+                         {'type': 'CNAME', 'name': 'www', 'data': 'foo.com', '_dc': {'providerId': 'P'}})
+
+    def test_normalised_zone_reused(self):
+        zone_records = [
+            {'type': 'A', 'name': 'Bar', 'data': '127.0.0.2', 'ttl': 300},
+            {'type': 'TXT', 'name': 'bar', 'data': 'Abc', 'ttl': 300},
+            {'type': 'CNAME', 'name': 'www', 'data': 'foo.com', 'ttl': 300, '_delete': 1},
+            {'type': 'MX', 'name': '@', 'data': 'mx.foo.com', 'ttl': 300, 'priority': 10},
+        ]
+        original = json.loads(json.dumps(zone_records))
+        zone = NormalisedZone(zone_records)
+        self.assertEqual(len(zone), 4)
+        template_records = [
+            {'type': 'A', 'host': '@', 'pointsTo': '%ip%', 'ttl': 600},
+            {'type': 'TXT', 'host': '@', 'data': 'Abc', 'ttl': 600, 'txtConflictMatchingMode': 'All'},
+        ]
+        for params in ({'ip': '127.0.0.1'}, {'ip': '127.0.0.3'}, {'ip': '127.0.0.1'}):
+            expected = process_records(template_records, json.loads(json.dumps(original)),
+                                       'foo.com', 'bar', params, None)
+            self.assertEqual(process_records(template_records, zone, 'foo.com', 'bar', params, None),
+                             expected)
+            self.assertEqual(len(expected[1]), 3)
+
+        dc = DomainConnect('exampleservice.domainconnect.org', 'template1', self.template_dir)
+        params = {'IP': '127.0.0.1', 'RANDOMTEXT': 'shm:1:a'}
+        self.assertEqual(dc.apply_template(zone, 'foo.com', 'bar', params),
+                         dc.apply_template(json.loads(json.dumps(original)), 'foo.com', 'bar', params))
+        self.assertEqual(zone.records[2], {'type': 'CNAME', 'name': 'www', 'data': 'foo.com',
+                                           'ttl': 300, '_delete': 1})
+        self.assertEqual([r for r in zone if '_delete' in r or '_replace' in r], [zone.records[2]])
+        self.assertEqual(zone_records, original)
+
 
 if __name__ == '__main__':
     unittest.main()
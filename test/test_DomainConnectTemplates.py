@@ -1,6 +1,11 @@
 import json
+import os
+import shutil
+import tempfile
 import unittest
-from domainconnectzone import DomainConnectTemplates, InvalidData, InvalidTemplate
+from domainconnectzone import DomainConnectTemplates, TemplateCatalog, InvalidData, InvalidTemplate
+from domainconnectzone.checktemplates import main as check_templates
+from domainconnectzone.DomainConnectTemplates import _read_template_ids
 
 import sys
 if sys.version_info >= (3, 3):
@@ -8,6 +13,9 @@ if sys.version_info >= (3, 3):
 else:
     from mock import patch, mock_open, call
 
+# what atomic_write returns for the file written
+_WRITTEN_STAT = os.stat_result((0o100644, 1, 0, 1, 0, 0, 10, 0, 0, 0))
+
 class TestDomainConnectTemplates(unittest.TestCase):
     @patch('os.path.isfile', return_value=True)
     @patch('os.path.isdir', return_value=True)
@@ -238,6 +246,43 @@ class TestDomainConnectTemplates(unittest.TestCase):
         with self.assertRaises(InvalidTemplate):
             self._dct.validate_template(invalid_template)
 
+    def test_validator_built_once(self):
+        from jsonschema.validators import validator_for
+        with patch('domainconnectzone.DomainConnectTemplates.validator_for',
+                   wraps=validator_for) as mock_validator_for:
+            self._dct.validate_template(self.template_base)
+            self._dct.validate_template(self.template_base)
+            self.assertIs(self._dct.validator, self._dct.validator)
+            self.assertEqual(mock_validator_for.call_count, 1)
+
+    def test_schema_validation_all_errors(self):
+        invalid_template = self.template_base.copy()
+        del invalid_template["providerName"]
+        del invalid_template["serviceName"]
+        with self.assertRaises(InvalidTemplate) as context:
+            self._dct.validate_template(invalid_template)
+        self.assertEqual(str(context.exception), "'providerName' is a required property")
+
+        with self.assertRaises(InvalidTemplate) as context:
+            self._dct.validate_template(invalid_template, all_errors=True)
+        self.assertEqual(sorted(context.exception.errors),
+                         ["'providerName' is a required property",
+                          "'serviceName' is a required property"])
+        self.assertEqual(str(context.exception), "\n".join(context.exception.errors))
+
+    @patch('os.path.isfile', return_value=True)
+    @patch('os.path.isdir', return_value=True)
+    @patch('os.access', return_value=True)
+    def test_schema_format_checker(self, mock_access, mock_isdir, mock_isfile):
+        schema = {"properties": {"logoUrl": {"type": "string", "format": "ipv4"}}}
+        template = dict(self.template_base, logoUrl="not an address")
+        with patch('builtins.open', mock_open(read_data=json.dumps(schema))):
+            checking = DomainConnectTemplates('./test/templatesh')
+            not_checking = DomainConnectTemplates('./test/templatesh', check_formats=False)
+        with self.assertRaises(InvalidTemplate):
+            checking.validate_template(template)
+        not_checking.validate_template(template)
+
     def test_validate_template_apexcname_record(self):
         # validate_template must succeed for a template containing an APEXCNAME record.
         # Regression: APEXCNAME was falling into the custom-type branch which accessed
@@ -400,16 +445,15 @@ class TestDomainConnectTemplatesUpdate(unittest.TestCase):
         dct = DomainConnectTemplates('/valid/path')
         template = {"providerId": "provider1", "serviceId": "service1", "description": "foo", "records": []}
 
-        with patch.object(dct, 'validate_template') as mock_validate:
+        with patch.object(dct, 'validate_template') as mock_validate, \
+                patch('domainconnectzone.DomainConnectTemplates.atomic_write',
+                      return_value=_WRITTEN_STAT) as mock_write:
             dct.update_template(template)
             mock_validate.assert_called_once_with(template)
-            mock_open.assert_called_with('/valid/path/provider1.service1.json', "w")
+            mock_write.assert_called_once()
+            self.assertEqual(mock_write.call_args[0][0], '/valid/path/provider1.service1.json')
 
-            output = "";
-            for _, args, _ in mock_open().write.mock_calls:
-                if len(args) == 1:
-                    output = output + args[0]
-            out_template = json.loads(output)
+            out_template = json.loads(mock_write.call_args[0][1])
             self.assertEqual(template, out_template)
 
     @patch('os.path.isdir', return_value=True)
@@ -455,16 +499,15 @@ class TestDomainConnectTemplatesCreate(unittest.TestCase):
     def test_create_new_template(self, mock_open, mock_access, mock_listdir):
         template = {"providerId": "provider2", "serviceId": "service2", "records": []}
 
-        with patch.object(self._dct, 'validate_template') as mock_validate:
+        with patch.object(self._dct, 'validate_template') as mock_validate, \
+                patch('domainconnectzone.DomainConnectTemplates.atomic_write',
+                      return_value=_WRITTEN_STAT) as mock_write:
             self._dct.create_template(template)
             mock_validate.assert_called_once_with(template)
-            mock_open.assert_has_calls([call('/valid/path/provider2.service2.json', "w")])
+            mock_write.assert_called_once()
+            self.assertEqual(mock_write.call_args[0][0], '/valid/path/provider2.service2.json')
 
-            output = "";
-            for _, args, _ in mock_open().write.mock_calls:
-                if len(args) == 1:
-                    output = output + args[0]
-            out_template = json.loads(output)
+            out_template = json.loads(mock_write.call_args[0][1])
             self.assertEqual(template, out_template)
 
     @patch('os.listdir', return_value=[])
@@ -490,5 +533,226 @@ class TestDomainConnectTemplatesCreate(unittest.TestCase):
         self.assertEqual(str(context.exception), "Template provider1 / service1 already exists.")
 
 
+
+class TestTemplateCatalog(unittest.TestCase):
+
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        for provider_id, service_id in [('Provider1', 'Service1'), ('provider2', 'service2')]:
+            self._write('{}.{}.json'.format(provider_id.lower(), service_id.lower()),
+                        {"providerId": provider_id, "serviceId": service_id, "records": []})
+        self._write('other.json', {"providerId": "provider3", "serviceId": "service3"})
+        with open(os.path.join(self.template_dir, 'broken.json'), 'w') as f:
+            f.write('{')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def _write(self, file_name, template):
+        with open(os.path.join(self.template_dir, file_name), 'w') as f:
+            json.dump(template, f)
+
+    def test_unchanged_files_not_read_again(self):
+        catalog = TemplateCatalog(self.template_dir)
+        with patch.object(catalog, '_read', wraps=catalog._read) as read:
+            self.assertEqual(sorted(e['fileName'] for e in catalog),
+                             ['provider1.service1.json', 'provider2.service2.json'])
+            self.assertEqual(read.call_count, 4)
+            self.assertEqual(len(list(catalog)), 2)
+            self.assertEqual(catalog.refresh(), [])
+            self.assertEqual(read.call_count, 4)
+
+            self._write('provider2.service2.json',
+                        {"providerId": "provider2", "serviceId": "service2", "records": [{}]})
+            os.remove(os.path.join(self.template_dir, 'provider1.service1.json'))
+            self.assertEqual(sorted(catalog.refresh()),
+                             ['provider1.service1.json', 'provider2.service2.json'])
+            self.assertEqual(read.call_count, 5)
+            self.assertEqual(len(catalog), 1)
+            self.assertEqual(catalog.get('Provider2', 'Service2')['template']['records'], [{}])
+
+    def test_get(self):
+        catalog = TemplateCatalog(self.template_dir)
+        entry = catalog.get('provider1', 'SERVICE1')
+        self.assertEqual(entry['providerId'], 'Provider1')
+        self.assertEqual(entry['fileName'], 'provider1.service1.json')
+        self.assertIs(catalog.get('Provider1', 'Service1'), entry)
+        self.assertIsNone(catalog.get('provider3', 'service3'))
+        self.assertIsNone(catalog.get('provider4', 'service4'))
+
+        self._write('provider4.service4.json', {"providerId": "provider4", "serviceId": "service4"})
+        self.assertEqual(catalog.get('provider4', 'service4')['serviceId'], 'service4')
+
+    def test_templates_are_copies(self):
+        dct = DomainConnectTemplates(self.template_dir)
+        template = dct.templates[0]['template']
+        template['records'].append({})
+        template['serviceId'] = 'changed'
+
+        self.assertNotEqual(dct.templates[0]['template'], template)
+        entry = next(iter(dct.catalog))
+        self.assertEqual(entry['template'], dct.templates[0]['template'])
+        self.assertIs(next(iter(dct.catalog))['template'], entry['template'])
+
+    def test_templates_and_writes(self):
+        dct = DomainConnectTemplates(self.template_dir)
+        self.assertEqual(len(dct.templates), 2)
+        template = {"providerId": "provider5", "serviceId": "service5", "records": []}
+        dct.create_template(template)
+        self.assertEqual(dct.catalog.get('provider5', 'service5')['template'], template)
+
+        template = dict(template, description="changed")
+        dct.update_template(template)
+        self.assertEqual(dct.catalog.get('provider5', 'service5')['template'], template)
+        self.assertEqual(len(dct.templates), 3)
+
+    def test_writes_are_atomic(self):
+        path = os.path.join(self.template_dir, 'provider1.service1.json')
+        os.chmod(path, 0o640)
+        dct = DomainConnectTemplates(self.template_dir, lock_writes=True)
+        self.assertEqual(len(dct.catalog.refresh()), 4)
+        template = {"providerId": "Provider1", "serviceId": "Service1", "records": [], "description": "new"}
+
+        with patch('os.replace', side_effect=OSError('disk full')):
+            with self.assertRaises(OSError):
+                dct.update_template(template)
+        with open(path) as f:
+            self.assertNotIn('description', json.load(f))
+
+        with patch.object(dct.catalog, '_read', wraps=dct.catalog._read) as read:
+            dct.update_template(template)
+            dct.create_template({"providerId": "provider7", "serviceId": "service7", "records": []})
+            self.assertEqual(dct.get_template('provider1', 'service1')['description'], 'new')
+            self.assertEqual(dct.get_template('provider7', 'service7')['records'], [])
+            # only create_template looking for provider7.service7.json before writing it
+            self.assertEqual(read.call_count, 1)
+            self.assertEqual(sorted(dct.catalog.refresh()), ['provider1.service1.json', 'provider7.service7.json'])
+            self.assertEqual(dct.catalog.refresh(), [])
+            self.assertEqual(read.call_count, 1)
+
+        with open(path) as f:
+            self.assertEqual(json.load(f), template)
+        self.assertEqual(os.stat(path).st_mode & 0o777, 0o640)
+        self.assertEqual(sorted(os.listdir(self.template_dir)),
+                         ['broken.json', 'other.json', 'provider1.service1.json',
+                          'provider2.service2.json', 'provider7.service7.json'])
+
+    def test_list_templates(self):
+        # ids after a large member, and JSON broken after the ids
+        with open(os.path.join(self.template_dir, 'provider6.service6.json'), 'w') as f:
+            f.write('{"records": [' + ', '.join(['{"type": "TXT", "ttl": 3600}'] * 2000) +
+                    '], "serviceId": "service6", "providerId": "Provider6", "logoUrl": ')
+        dct = DomainConnectTemplates(self.template_dir)
+        catalog = dct.catalog
+        with patch.object(catalog, '_read', wraps=catalog._read) as read, \
+                patch('domainconnectzone.DomainConnectTemplates._read_template_ids',
+                      wraps=_read_template_ids) as read_ids:
+            listing = dct.list_templates()
+            self.assertEqual(sorted((t['providerId'], t['serviceId'], t['fileName']) for t in listing),
+                             [('Provider1', 'Service1', 'provider1.service1.json'),
+                              ('Provider6', 'service6', 'provider6.service6.json'),
+                              ('provider2', 'service2', 'provider2.service2.json')])
+            self.assertEqual(read.call_count, 0)
+            self.assertEqual(read_ids.call_count, 5)
+
+            dct.list_templates()
+            self.assertEqual(read_ids.call_count, 5)
+
+            self.assertEqual(dct.get_template('PROVIDER1', 'service1')['serviceId'], 'Service1')
+            self.assertIsNone(dct.get_template('provider6', 'service6'))
+            self.assertIsNone(dct.get_template('provider3', 'service3'))
+            self.assertEqual(read.call_count, 3)
+            self.assertEqual(len(dct.list_templates()), 2)
+            self.assertEqual(read_ids.call_count, 5)
+
+            self._write('provider2.service2.json', {"providerId": "Provider2", "serviceId": "service2"})
+            self.assertIn('Provider2', [t['providerId'] for t in dct.list_templates()])
+            self.assertEqual(read_ids.call_count, 6)
+
+    def test_read_template_ids(self):
+        path = os.path.join(self.template_dir, 'ids.json')
+        for text, ids in [('{"providerId": "p", "serviceId": "s"}', ('p', 's')),
+                          ('{"a": [1, {"providerId": "x"}], "serviceId": "s", "providerId": "p", "b": }', ('p', 's')),
+                          ('{"ttl": 1200, "providerId": "p", "serviceId": "s\\"\u00e9"}', ('p', 's"\u00e9')),
+                          ('{"providerId": "p"}', None),
+                          ('{"providerId": "p", "serviceId"', None),
+                          ('["providerId", "serviceId"]', None),
+                          ('', None)]:
+            with open(path, 'w') as f:
+                f.write(text)
+            for chunk_size in (1, 3, 4096):
+                self.assertEqual(_read_template_ids(path, chunk_size), ids, (text, chunk_size))
+
+
+
+class TestValidateAll(unittest.TestCase):
+
+    def setUp(self):
+        definitions = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_definitions', 'templates')
+        self.template_dir = tempfile.mkdtemp()
+        for file_name in ['template.schema', 'exampleservice.domainconnect.org.template1.json',
+                          'exampleservice.domainconnect.org.template2.json']:
+            shutil.copy(os.path.join(definitions, file_name), self.template_dir)
+        with open(os.path.join(definitions, 'exampleservice.domainconnect.org.template1.json')) as f:
+            template = json.load(f)
+        self._write('renamed.json', template)
+        del template['providerName']
+        template['serviceId'] = 'noname'
+        self._write('exampleservice.domainconnect.org.noname.json', template)
+        with open(os.path.join(self.template_dir, 'broken.json'), 'w') as f:
+            f.write('{')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def _write(self, file_name, template):
+        with open(os.path.join(self.template_dir, file_name), 'w') as f:
+            json.dump(template, f)
+
+    def _check(self, results):
+        results = {result['fileName']: result for result in results}
+        self.assertEqual(len(results), 5)
+        self.assertTrue(results['exampleservice.domainconnect.org.template1.json']['valid'])
+        self.assertTrue(results['exampleservice.domainconnect.org.template2.json']['valid'])
+        self.assertEqual(results['exampleservice.domainconnect.org.noname.json']['errors'],
+                         ["'providerName' is a required property"])
+        self.assertEqual(results['exampleservice.domainconnect.org.noname.json']['serviceId'], 'noname')
+        self.assertEqual(results['renamed.json']['errors'],
+                         ['File name does not match providerId and serviceId, '
+                          'expected exampleservice.domainconnect.org.template1.json'])
+        self.assertFalse(results['broken.json']['valid'])
+        self.assertTrue(results['broken.json']['errors'][0].startswith('Invalid JSON: '))
+        self.assertTrue(all(result['seconds'] >= 0 for result in results.values()))
+
+    def test_validate_all_inline(self):
+        self._check(DomainConnectTemplates(self.template_dir).validate_all(processes=1))
+
+    def test_validate_all_pool(self):
+        self._check(DomainConnectTemplates(self.template_dir).validate_all(processes=2, chunksize=2))
+
+    def test_check_templates_cli(self):
+        report = os.path.join(self.template_dir, 'report.jsonl')
+        with patch('sys.stderr'):
+            self.assertEqual(check_templates([self.template_dir, '--report', report, '--processes', '1']), 1)
+        with open(report) as f:
+            self._check(json.loads(line) for line in f)
+
+        with patch('sys.stderr'):
+            self.assertEqual(check_templates([self.template_dir, '--report', report, '--processes', '1',
+                                              '--failures-only']), 1)
+        with open(report) as f:
+            self.assertEqual(len(f.readlines()), 3)
+
+        for file_name in ['renamed.json', 'broken.json', 'exampleservice.domainconnect.org.noname.json']:
+            os.remove(os.path.join(self.template_dir, file_name))
+        with patch('sys.stderr'):
+            self.assertEqual(check_templates([self.template_dir, '--report', report]), 0)
+            self.assertEqual(check_templates(['/not/existing/dir']), 2)
+            for processes in ('0', '-2', 'x'):
+                with self.assertRaises(SystemExit) as cm:
+                    check_templates([self.template_dir, '--processes', processes])
+                self.assertEqual(cm.exception.code, 2)
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,84 @@
+import os
+import unittest
+
+from domainconnectzone import DomainConnect, InvalidTemplate, MissingParameter, apply_templates
+
+
+class TestApplyTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.template_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_definitions', 'templates')
+        self.template1 = ('exampleservice.domainconnect.org', 'template1')
+        self.template2 = ('exampleservice.domainconnect.org', 'template2')
+
+    def _jobs(self):
+        return [
+            (self.template1, [], 'foo.com', 'bar', {'IP': '127.0.0.1', 'RANDOMTEXT': 'a'}),
+            (self.template2, [{'type': 'A', 'name': 'bar', 'data': '127.0.0.2', 'ttl': 300}],
+             'example.com', 'bar', {'IP': '127.0.0.3', 'RANDOMTEXT': 'b'}, {'ignore_signature': True}),
+            (self.template1, [], 'foo.com', 'bar', {'RANDOMTEXT': 'c'}),
+            (('exampleservice.domainconnect.org', 'missing'), [], 'foo.com', 'bar', {}),
+        ]
+
+    def _expected(self, job):
+        try:
+            dc = DomainConnect(job[0][0], job[0][1], self.template_dir)
+            kwargs = job[5] if len(job) > 5 else {}
+            return dc.apply_template(*job[1:5], **kwargs)
+        except Exception as e:
+            return e
+
+    def test_apply_templates(self):
+        jobs = self._jobs() * 3
+        outcomes = dict(apply_templates(iter(jobs), template_path=self.template_dir,
+                                        processes=2, chunksize=2, max_pending=2))
+
+        self.assertEqual(sorted(outcomes), list(range(len(jobs))))
+        for index, job in enumerate(jobs):
+            expected = self._expected(job)
+            if isinstance(expected, Exception):
+                self.assertIsInstance(outcomes[index], type(expected))
+            else:
+                self.assertEqual(outcomes[index], expected)
+        self.assertIsInstance(outcomes[2], MissingParameter)
+        self.assertIsInstance(outcomes[3], InvalidTemplate)
+
+    def test_apply_templates_preloaded(self):
+        template = {'providerId': 'Foo', 'serviceId': 'Bar',
+                    'records': [{'type': 'TXT', 'host': '@', 'data': '%v%', 'ttl': 300}]}
+        jobs = [(('foo', 'bar'), [], 'foo.com', None, {'v': str(i)}) for i in range(10)]
+        outcomes = dict(apply_templates(jobs, templates={('Foo', 'Bar'): template}, processes=2))
+
+        self.assertEqual(len(outcomes), 10)
+        for index in range(10):
+            self.assertEqual(outcomes[index][0][0]['data'], str(index))
+
+    def test_apply_templates_bad_preloaded_template(self):
+        good = {'providerId': 'Foo', 'serviceId': 'Bar',
+                'records': [{'type': 'TXT', 'host': '@', 'data': 'x', 'ttl': 300}]}
+        bad = {'providerId': 'Foo', 'serviceId': 'Bad', 'records': [{'host': '@', 'ttl': 300}]}
+        jobs = [(('foo', service_id), [], 'foo.com', None, {}) for service_id in ('bar', 'bad') * 3]
+        outcomes = dict(apply_templates(jobs, templates={('Foo', 'Bar'): good, ('Foo', 'Bad'): bad},
+                                        processes=2, chunksize=1))
+
+        self.assertEqual(len(outcomes), 6)
+        for index in range(0, 6, 2):
+            self.assertEqual(outcomes[index][0][0]['data'], 'x')
+            self.assertIsInstance(outcomes[index + 1], KeyError)
+
+    def test_worker_templates_loaded_on_first_use(self):
+        from domainconnectzone.bulkutil import _WorkerTemplates
+
+        worker_templates = _WorkerTemplates(self.template_dir, None, None)
+        self.assertEqual(worker_templates._templates, {})
+        dc = worker_templates.get('ExampleService.DomainConnect.org', 'Template1')
+        self.assertIs(worker_templates.get(*self.template1), dc)
+        self.assertEqual(list(worker_templates._templates), [self.template1])
+
+    def test_apply_templates_invalid_chunksize(self):
+        with self.assertRaises(ValueError):
+            list(apply_templates(self._jobs(), template_path=self.template_dir, processes=1, chunksize=0))
+
+    def test_apply_templates_invalid_dir(self):
+        with self.assertRaises(InvalidTemplate):
+            list(apply_templates([], template_path='/not/existing/dir'))
@@ -0,0 +1,124 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from domainconnectzone import DomainConnect, DomainConnectTemplates, InvalidTemplate, TemplateBundle, \
+    TemplateCache
+from domainconnectzone.bundleutil import is_bundle, open_bundle, write_bundle
+
+
+class TestTemplateBundle(unittest.TestCase):
+
+    def setUp(self):
+        self.definitions = os.path.join(os.path.dirname(os.path.realpath(__file__)), 'test_definitions', 'templates')
+        self.tmp_dir = tempfile.mkdtemp()
+        self.template_dir = os.path.join(self.tmp_dir, 'templates')
+        shutil.copytree(self.definitions, self.template_dir)
+        with open(os.path.join(self.template_dir, 'exampleservice.domainconnect.org.template1.json')) as f:
+            template = json.load(f)
+        del template['providerName']
+        template['serviceId'] = 'noname'
+        with open(os.path.join(self.template_dir, 'exampleservice.domainconnect.org.noname.json'), 'w') as f:
+            json.dump(template, f)
+        self.bundle_path = os.path.join(self.tmp_dir, 'templates.bundle')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_build_and_read(self):
+        templates = DomainConnectTemplates(self.template_dir)
+        count = templates.build_bundle(self.bundle_path, processes=1)
+        self.assertEqual(count, len(templates.templates))
+        self.assertTrue(is_bundle(self.bundle_path))
+        self.assertFalse(is_bundle(os.path.join(self.template_dir, 'template.schema')))
+
+        with TemplateBundle(self.bundle_path) as bundle:
+            self.assertEqual(len(bundle), count)
+            self.assertEqual(bundle.schema, templates.schema)
+            self.assertEqual(bundle._state.entries, {})
+
+            entry = bundle.get('ExampleService.DomainConnect.org', 'Template1')
+            self.assertEqual(entry, templates.catalog.get('exampleservice.domainconnect.org', 'template1'))
+            self.assertIs(bundle.get_file('exampleservice.domainconnect.org.template1.json'), entry)
+            self.assertEqual(len(bundle._state.entries), 1)
+            self.assertIsNone(bundle.get('exampleservice.domainconnect.org', 'missing'))
+
+            self.assertEqual(bundle.validation('exampleservice.domainconnect.org', 'template1'), (True, []))
+            self.assertEqual(bundle.validation('exampleservice.domainconnect.org', 'noname'),
+                             (False, ["'providerName' is a required property"]))
+            self.assertEqual(sorted(e['fileName'] for e in bundle), sorted(bundle.files()))
+
+        with TemplateBundle(self.bundle_path) as bundle:
+            self.assertEqual(bundle.metadata(),
+                             [{"providerId": e["providerId"], "serviceId": e["serviceId"],
+                               "fileName": e["fileName"]} for e in bundle])
+            self.assertEqual(sorted(t['fileName'] for t in DomainConnectTemplates(self.bundle_path).list_templates()),
+                             sorted(bundle.files()))
+
+    def test_template_source(self):
+        DomainConnectTemplates(self.template_dir).build_bundle(self.bundle_path, processes=1)
+
+        from_dir = DomainConnect('exampleservice.domainconnect.org', 'template1', self.template_dir)
+        from_bundle = DomainConnect('exampleservice.domainconnect.org', 'template1', self.bundle_path)
+        self.assertEqual(from_bundle.data, from_dir.data)
+        params = {'IP': '127.0.0.1', 'RANDOMTEXT': 'shm:1:a'}
+        self.assertEqual(from_bundle.apply_template([], 'example.com', None, params),
+                         from_dir.apply_template([], 'example.com', None, params))
+        with self.assertRaises(InvalidTemplate):
+            DomainConnect('exampleservice.domainconnect.org', 'missing', self.bundle_path)
+
+        templates = DomainConnectTemplates(self.bundle_path)
+        self.assertIsInstance(templates.catalog, TemplateBundle)
+        self.assertEqual(sorted(t['fileName'] for t in templates.templates),
+                         sorted(t['fileName'] for t in DomainConnectTemplates(self.template_dir).templates))
+        results = {r['fileName']: r for r in templates.validate_all(processes=1)}
+        self.assertFalse(results['exampleservice.domainconnect.org.noname.json']['valid'])
+        self.assertTrue(results['exampleservice.domainconnect.org.template1.json']['valid'])
+        with self.assertRaises(EnvironmentError):
+            templates.create_template({"providerId": "foo", "serviceId": "bar", "records": []})
+
+    def test_bundled_template_compiled_once(self):
+        write_bundle(self.bundle_path, [{"providerId": "Foo", "serviceId": "Bar", "fileName": "foo.bar.json",
+                                         "template": {"providerId": "Foo", "serviceId": "Bar", "records": [
+                                             {"type": "A", "host": "@", "pointsTo": "1.1.1.1", "ttl": 300}]}}])
+        cache = TemplateCache()
+        dc = DomainConnect('foo', 'bar', self.bundle_path, template_cache=cache)
+        self.assertIs(DomainConnect('Foo', 'Bar', self.bundle_path, template_cache=cache).compiled_template,
+                      dc.compiled_template)
+        self.assertEqual(cache.stats(), {'hits': 1, 'misses': 1, 'size': 1})
+
+        write_bundle(self.bundle_path, [{"providerId": "Foo", "serviceId": "Bar", "fileName": "foo.bar.json",
+                                         "template": {"providerId": "Foo", "serviceId": "Bar", "records": [
+                                             {"type": "A", "host": "@", "pointsTo": "22.2.2.2", "ttl": 300}]}}])
+        replaced = DomainConnect('foo', 'bar', self.bundle_path, template_cache=cache)
+        self.assertIsNot(replaced.compiled_template, dc.compiled_template)
+        self.assertEqual(replaced.apply_template([], 'example.com', None, {})[0][0]['data'], '22.2.2.2')
+
+    def test_replaced_bundle(self):
+        write_bundle(self.bundle_path, [{"providerId": "Foo", "serviceId": "Bar", "fileName": "foo.bar.json",
+                                         "template": {"providerId": "Foo", "serviceId": "Bar", "version": 1}}])
+        bundle = open_bundle(self.bundle_path)
+        self.assertIs(open_bundle(self.bundle_path), bundle)
+        self.assertEqual(bundle.get('foo', 'bar')['template']['version'], 1)
+        self.assertIsNone(bundle.schema)
+
+        write_bundle(self.bundle_path, [{"providerId": "Foo", "serviceId": "Bar", "fileName": "foo.bar.json",
+                                         "template": {"providerId": "Foo", "serviceId": "Bar", "version": 2}},
+                                        {"providerId": "Foo", "serviceId": "Baz", "fileName": "foo.baz.json",
+                                         "template": {"providerId": "Foo", "serviceId": "Baz"}}])
+        self.assertIs(open_bundle(self.bundle_path), bundle)
+        self.assertEqual(bundle.get('foo', 'bar')['template']['version'], 2)
+        self.assertEqual(bundle.refresh(), [])
+        self.assertEqual(len(bundle), 2)
+
+    def test_not_a_bundle(self):
+        with self.assertRaises(ValueError):
+            TemplateBundle(os.path.join(self.template_dir, 'template.schema'))
+        with self.assertRaises(InvalidTemplate):
+            DomainConnect('foo', 'bar', os.path.join(self.template_dir, 'template.schema'))
+
+
+if __name__ == '__main__':
+    unittest.main()
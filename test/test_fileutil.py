@@ -0,0 +1,104 @@
+import json
+import os
+import shutil
+import tempfile
+import sys
+import threading
+import unittest
+
+from domainconnectzone.fileutil import atomic_open, atomic_write, locked
+
+if sys.version_info >= (3, 3):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+
+class TestFileUtil(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'file.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_atomic_write(self):
+        umask = os.umask(0o027)
+        try:
+            st = atomic_write(self.path, '{"a": 1}')
+        finally:
+            os.umask(umask)
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o640)
+        self.assertEqual((st.st_mtime_ns, st.st_size, st.st_ino),
+                         (os.stat(self.path).st_mtime_ns, os.stat(self.path).st_size, os.stat(self.path).st_ino))
+
+        os.chmod(self.path, 0o600)
+        atomic_write(self.path, b'{"a": 2}')
+        self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o600)
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {"a": 2})
+
+        with self.assertRaises(ValueError):
+            with atomic_open(self.path) as f:
+                f.write('{"a": ')
+                raise ValueError()
+        with open(self.path) as f:
+            self.assertEqual(json.load(f), {"a": 2})
+        self.assertEqual(os.listdir(self.tmp_dir), ['file.json'])
+
+    def test_atomic_open_syncs_before_replace(self):
+        calls = []
+        with patch('os.fsync', side_effect=lambda fd: calls.append('fsync')), \
+                patch('os.replace', side_effect=lambda *args: calls.append('replace')):
+            with atomic_open(self.path) as f:
+                f.write('{}')
+        self.assertEqual(calls, ['fsync', 'replace'])
+
+    def test_readers_never_see_partial_files(self):
+        atomic_write(self.path, json.dumps({"n": 0, "records": []}))
+        stop = threading.Event()
+        failures = []
+
+        def read():
+            while not stop.is_set():
+                try:
+                    with open(self.path) as f:
+                        json.load(f)
+                except ValueError as e:
+                    failures.append(e)
+
+        readers = [threading.Thread(target=read) for _ in range(2)]
+        for reader in readers:
+            reader.start()
+        try:
+            for n in range(200):
+                atomic_write(self.path, json.dumps({"n": n, "records": [{"data": "x" * 1000}] * n}))
+        finally:
+            stop.set()
+            for reader in readers:
+                reader.join()
+        self.assertEqual(failures, [])
+
+    def test_locked(self):
+        counter = os.path.join(self.tmp_dir, 'counter')
+        atomic_write(counter, '0')
+
+        def increment():
+            for _ in range(50):
+                with locked(self.tmp_dir):
+                    with open(counter) as f:
+                        value = int(f.read())
+                    atomic_write(counter, str(value + 1))
+
+        threads = [threading.Thread(target=increment) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        with open(counter) as f:
+            self.assertEqual(f.read(), '200')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+import threading
+import unittest
+
+from concurrent.futures import ThreadPoolExecutor
+
+from domainconnectzone.poolutil import submit_chunks
+
+
+class TestPoolUtil(unittest.TestCase):
+
+    def test_submit_chunks_ordered(self):
+        with ThreadPoolExecutor(max_workers=3) as executor:
+            results = list(submit_chunks(executor, sum, iter(range(10)), 3, 2, ordered=True))
+        self.assertEqual(results, [3, 12, 21, 9])
+
+    def test_submit_chunks_completion_order(self):
+        release = threading.Event()
+
+        def first_blocks(chunk):
+            if chunk[0] == 0:
+                release.wait(5)
+            return chunk
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = submit_chunks(executor, first_blocks, range(4), 2, 2)
+            self.assertEqual(next(results), [2, 3])
+            release.set()
+            self.assertEqual(list(results), [[0, 1]])
+
+    def test_submit_chunks_max_pending(self):
+        read = []
+
+        def items():
+            for i in range(10):
+                read.append(i)
+                yield i
+
+        with ThreadPoolExecutor(max_workers=2) as executor:
+            results = submit_chunks(executor, list, items(), 2, 2, ordered=True)
+            self.assertEqual(next(results), [0, 1])
+            # two chunks were handed out before the first result
+            self.assertEqual(read, [0, 1, 2, 3])
+            self.assertEqual(sum(len(chunk) for chunk in results), 8)
+
+    def test_submit_chunks_invalid_sizes(self):
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            for chunksize, max_pending in ((0, 1), (1, 0), (-1, 2)):
+                with self.assertRaises(ValueError):
+                    next(submit_chunks(executor, list, range(4), chunksize, max_pending))
+
+
+if __name__ == '__main__':
+    unittest.main()
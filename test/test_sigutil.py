@@ -1,4 +1,6 @@
+import asyncio
 import unittest
+from base64 import b64decode
 
 import sys
 if sys.version_info >= (3, 3):
@@ -6,7 +8,40 @@ if sys.version_info >= (3, 3):
 else:
     from mock import patch, MagicMock
 
-from domainconnectzone.sigutil import verify_sig, generate_sig, get_publickey
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+import dns.resolver
+from dns.resolver import NXDOMAIN
+
+from domainconnectzone.sigutil import verify_sig, verify_sigs, generate_sig, get_publickey, \
+    get_publickey_async, KeySource, PublicKeyCache, SignatureVerifier, DNSKeySource, DictKeySource
+
+
+def _make_keypair():
+    """ Returns a new private key PEM and its public key PEM """
+    private_key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+    private_pem = private_key.private_bytes(
+        serialization.Encoding.PEM,
+        serialization.PrivateFormat.TraditionalOpenSSL,
+        serialization.NoEncryption()).decode()
+    public_pem = private_key.public_key().public_bytes(
+        serialization.Encoding.PEM,
+        serialization.PublicFormat.SubjectPublicKeyInfo).decode()
+    return private_pem, public_pem
+
+
+def _txt_answer(public_pem, ttl=300):
+    """ Returns a mocked TXT answer publishing public_pem in p=/d= segments """
+    bits = ''.join(public_pem.strip().splitlines()[1:-1])
+    answer = MagicMock()
+    records = []
+    for i in range(0, len(bits), 200):
+        record = MagicMock()
+        record.strings = ['p={},a=RS256,d={}'.format(i // 200, bits[i:i + 200]).encode()]
+        records.append(record)
+    answer.__iter__.return_value = records
+    answer.rrset.ttl = ttl
+    return answer
 
 
 class TestVerifySig(unittest.TestCase):
@@ -45,6 +80,100 @@ gSa29l1u3eUoM++bw+OLbhOqYyzpa2QGRS53RY5xxw7fikcNLWLjAgMBwAE=
         self.assertFalse(verify_sig("invalid public key", self.valid_signature, self.data))
 
 
+class TestSignatureVerifier(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_pem = _make_keypair()
+
+    def test_keys_parsed_once(self):
+        verifier = SignatureVerifier()
+        signature = generate_sig(self.private_pem, 'a=1')
+
+        self.assertTrue(verifier.verify_sig(self.public_pem, signature, 'a=1'))
+        self.assertTrue(verifier.verify_sig(self.public_pem, signature.decode(), 'a=1'))
+        self.assertFalse(verifier.verify_sig(self.public_pem, signature, 'a=2'))
+        self.assertIs(verifier.load_key(self.public_pem.encode()),
+                      verifier.load_key(self.public_pem))
+
+        stats = verifier.stats()
+        self.assertEqual(stats['parses'], 1)
+        self.assertEqual(stats['key_hits'], 4)
+        self.assertEqual(stats['verifies'], 3)
+        self.assertEqual(stats['failures'], 1)
+        self.assertGreater(stats['parse_seconds'], 0)
+        self.assertGreater(stats['verify_seconds'], 0)
+
+        verifier.reset_stats()
+        self.assertEqual(verifier.stats()['verifies'], 0)
+
+    def test_fast_path(self):
+        verifier = SignatureVerifier()
+        public_key = verifier.load_key(self.public_pem)
+        signature = b64decode(generate_sig(self.private_pem, 'a=1'))
+
+        self.assertTrue(verifier.verify(public_key, signature, b'a=1'))
+        self.assertFalse(verifier.verify(public_key, signature, b'a=2'))
+        self.assertFalse(verifier.verify(None, signature, b'a=1'))
+
+    def test_malformed_input(self):
+        verifier = SignatureVerifier()
+        signature = generate_sig(self.private_pem, 'a=1')
+
+        self.assertFalse(verifier.verify_sig('invalid public key', signature, 'a=1'))
+        self.assertFalse(verifier.verify_sig(self.public_pem, 'not base64!', 'a=1'))
+        self.assertFalse(verifier.verify_sig(self.public_pem, None, 'a=1'))
+        self.assertEqual(verifier.stats()['failures'], 3)
+        with self.assertRaises(ValueError):
+            verifier.load_key('invalid public key')
+
+    def test_size_bound(self):
+        verifier = SignatureVerifier(max_keys=1)
+        other_pem = _make_keypair()[1]
+        verifier.load_key(self.public_pem)
+        verifier.load_key(other_pem)
+        verifier.load_key(self.public_pem)
+        self.assertEqual(verifier.stats()['parses'], 3)
+
+
+class TestVerifySigs(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_pem = _make_keypair()
+        cls.other_private_pem, cls.other_public_pem = _make_keypair()
+        cls.key_source = DictKeySource({'_dck1.example.com': cls.public_pem,
+                                        '_dck2.example.com': cls.other_public_pem})
+
+    def _items(self):
+        items = []
+        for i in range(10):
+            qs = 'a={}'.format(i)
+            items.append((qs, generate_sig(self.private_pem, qs).decode(), '_dck1.example.com'))
+            items.append((qs, generate_sig(self.other_private_pem, qs).decode(), '_dck2.example.com'))
+        items.append(('a=1', items[0][1], '_dck2.example.com'))
+        items.append(('a=1', items[0][1], '_dck3.example.com'))
+        items.append(('a=1', 'not base64!', '_dck1.example.com'))
+        items.append(('a=1', None, '_dck1.example.com'))
+        return items
+
+    def _check(self, results):
+        self.assertEqual(len(results), 24)
+        self.assertTrue(all(result.valid and result.reason is None for result in results[:20]))
+        self.assertEqual(results[20], (False, 'Signature not valid'))
+        self.assertEqual(results[21], (False, 'Unable to get public key from _dck3.example.com'))
+        self.assertEqual(results[22], (False, 'Malformed signature'))
+        self.assertEqual(results[23], (False, 'Missing data for signature verification'))
+
+    def test_verify_sigs_inline(self):
+        with patch.object(self.key_source, 'get', wraps=self.key_source.get) as get:
+            self._check(verify_sigs(iter(self._items()), self.key_source, processes=1))
+            self.assertEqual(get.call_count, 3)
+
+    def test_verify_sigs_pool(self):
+        self._check(verify_sigs(self._items(), self.key_source, processes=2, chunksize=3))
+
+
 class TestGenerateSig(unittest.TestCase):
 
     @classmethod
@@ -159,4 +288,167 @@ class TestGetPublicKey(unittest.TestCase):
 
         # Test get_publickey function with invalid type
         domain = 'example.com'
-        self.assertIsNone(get_publickey(domain))
\ No newline at end of file
+        self.assertIsNone(get_publickey(domain))
+
+
+class TestPublicKeyCache(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_pem = _make_keypair()
+
+    @patch('domainconnectzone.sigutil.time.monotonic')
+    @patch('dns.resolver.resolve')
+    def test_cache_hit_and_ttl(self, mock_resolve, mock_monotonic):
+        mock_resolve.return_value = _txt_answer(self.public_pem, ttl=300)
+        mock_monotonic.return_value = 1000.0
+        cache = PublicKeyCache()
+
+        key = cache.get('_dck1.example.com')
+        self.assertIsNotNone(key)
+        signature = generate_sig(self.private_pem, 'a=1')
+        self.assertTrue(verify_sig(key, signature, 'a=1'))
+        self.assertFalse(verify_sig(key, signature, 'a=2'))
+
+        mock_monotonic.return_value = 1299.0
+        self.assertIs(cache.get('_dck1.example.com'), key)
+        self.assertEqual(mock_resolve.call_count, 1)
+
+        mock_monotonic.return_value = 1301.0
+        self.assertIsNotNone(cache.get('_dck1.example.com'))
+        self.assertEqual(mock_resolve.call_count, 2)
+
+    @patch('domainconnectzone.sigutil.time.monotonic')
+    @patch('dns.resolver.resolve')
+    def test_negative_cache(self, mock_resolve, mock_monotonic):
+        mock_resolve.side_effect = NXDOMAIN()
+        mock_monotonic.return_value = 1000.0
+        cache = PublicKeyCache(negative_ttl=30)
+
+        self.assertIsNone(cache.get('_missing.example.com'))
+        self.assertIsNone(cache.get('_missing.example.com'))
+        self.assertEqual(mock_resolve.call_count, 1)
+
+        mock_monotonic.return_value = 1031.0
+        self.assertIsNone(cache.get('_missing.example.com'))
+        self.assertEqual(mock_resolve.call_count, 2)
+
+    @patch('dns.resolver.resolve')
+    def test_size_bound(self, mock_resolve):
+        mock_resolve.return_value = _txt_answer(self.public_pem)
+        cache = PublicKeyCache(max_size=2)
+
+        cache.get('a.example.com')
+        cache.get('b.example.com')
+        cache.get('a.example.com')
+        cache.get('c.example.com')
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(mock_resolve.call_count, 3)
+
+        # b was the least recently used entry
+        cache.get('a.example.com')
+        self.assertEqual(mock_resolve.call_count, 3)
+        cache.get('b.example.com')
+        self.assertEqual(mock_resolve.call_count, 4)
+
+
+class TestKeySources(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_pem = _make_keypair()
+
+    def test_dict_key_source(self):
+        source = DictKeySource({'_dck1.example.com': self.public_pem}, ttl=60)
+        self.assertEqual(source.fetch('_dck1.example.com'), (self.public_pem, 60))
+        self.assertEqual(source.fetch('_dck2.example.com'), (None, None))
+        self.assertEqual(get_publickey('_dck1.example.com', source), self.public_pem)
+        self.assertIsNone(source.get('_dck2.example.com'))
+
+        signature = generate_sig(self.private_pem, 'a=1')
+        self.assertTrue(verify_sig(source.get('_dck1.example.com'), signature, 'a=1'))
+
+    def test_dns_key_source(self):
+        resolver = MagicMock()
+        resolver.resolve.return_value = _txt_answer(self.public_pem, ttl=120)
+        source = DNSKeySource(resolver)
+
+        pem, ttl = source.fetch('_dck1.example.com')
+        resolver.resolve.assert_called_once_with('_dck1.example.com', 'TXT')
+        self.assertEqual(ttl, 120)
+        self.assertEqual(''.join(pem.split()), ''.join(self.public_pem.split()))
+        self.assertIsNotNone(source.get('_dck1.example.com'))
+
+    def test_dns_key_source_default_resolver(self):
+        source = DNSKeySource(cache_size=10)
+        self.assertIsInstance(source.resolver.cache, dns.resolver.LRUCache)
+
+    def test_cache_over_key_source(self):
+        source = DictKeySource({'_dck1.example.com': self.public_pem})
+        cache = PublicKeyCache(key_source=source)
+        with patch.object(source, 'fetch', wraps=source.fetch) as fetch:
+            key = cache.get('_dck1.example.com')
+            self.assertIs(cache.get('_dck1.example.com'), key)
+            self.assertIsNone(cache.get('_dck2.example.com'))
+            self.assertIsNone(cache.get('_dck2.example.com'))
+            self.assertEqual(fetch.call_count, 2)
+
+
+class _SlowKeySource(KeySource):
+    """ A key source answering after a delay, counting its lookups """
+
+    def __init__(self, keys):
+        self.keys = keys
+        self.calls = 0
+
+    def fetch(self, domain):
+        self.calls += 1
+        return self.keys.get(domain), 60
+
+    async def fetch_async(self, domain):
+        self.calls += 1
+        await asyncio.sleep(0.01)
+        return self.keys.get(domain), 60
+
+
+class TestGetPublicKeyAsync(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.private_pem, cls.public_pem = _make_keypair()
+
+    def test_get_publickey_async(self):
+        source = DictKeySource({'_dck1.example.com': self.public_pem})
+        self.assertEqual(asyncio.run(get_publickey_async('_dck1.example.com', source)),
+                         self.public_pem)
+        self.assertIsNone(asyncio.run(get_publickey_async('_dck2.example.com', source)))
+
+    def test_dns_key_source_async(self):
+        resolver = MagicMock()
+
+        async def resolve(domain, rdtype):
+            return _txt_answer(self.public_pem, ttl=120)
+        resolver.resolve.side_effect = resolve
+        source = DNSKeySource(async_resolver=resolver)
+
+        pem, ttl = asyncio.run(source.fetch_async('_dck1.example.com'))
+        resolver.resolve.assert_called_once_with('_dck1.example.com', 'TXT')
+        self.assertEqual(ttl, 120)
+        self.assertEqual(''.join(pem.split()), ''.join(self.public_pem.split()))
+
+    def test_cache_coalesces_lookups(self):
+        source = _SlowKeySource({'_dck1.example.com': self.public_pem})
+        cache = PublicKeyCache(key_source=source)
+
+        async def lookup():
+            return await asyncio.gather(*[cache.get_async(domain) for domain in
+                                          ['_dck1.example.com'] * 5 + ['_dck2.example.com'] * 3])
+
+        keys = asyncio.run(lookup())
+        self.assertEqual(source.calls, 2)
+        self.assertTrue(all(key is keys[0] for key in keys[:5]))
+        self.assertEqual(keys[5:], [None] * 3)
+
+        self.assertIs(asyncio.run(cache.get_async('_dck1.example.com')), keys[0])
+        self.assertIs(cache.get('_dck1.example.com'), keys[0])
+        self.assertEqual(source.calls, 2)
@@ -0,0 +1,143 @@
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+import unittest
+
+from domainconnectzone import InvalidTemplate, TemplateCatalog, TemplateWatcher
+
+if sys.version_info >= (3, 3):
+    from unittest.mock import patch
+else:
+    from mock import patch
+
+
+class TestTemplateWatcher(unittest.TestCase):
+
+    def setUp(self):
+        self.template_dir = tempfile.mkdtemp()
+        self._write('Foo', 'Bar', '1.1.1.1')
+
+    def tearDown(self):
+        shutil.rmtree(self.template_dir)
+
+    def _write(self, provider_id, service_id, ip):
+        template = {"providerId": provider_id, "serviceId": service_id,
+                    "records": [{"type": "A", "host": "@", "pointsTo": ip, "ttl": 600}]}
+        file_name = '{}.{}.json'.format(provider_id.lower(), service_id.lower())
+        # written aside and moved in, like a deployment would
+        path = os.path.join(self.template_dir, file_name)
+        with open(path + '.tmp', 'w') as f:
+            json.dump(template, f)
+        os.replace(path + '.tmp', path)
+
+    def _ip(self, watcher, provider_id, service_id):
+        new_records = watcher.get(provider_id, service_id).apply_template([], 'example.com', None, {})[0]
+        return new_records[0]['data']
+
+    def test_refresh(self):
+        watcher = TemplateWatcher(self.template_dir)
+        changes = []
+        watcher.subscribe(changes.append)
+
+        dc = watcher.get('FOO', 'bar')
+        self.assertIsNotNone(dc._compiled_template)
+        self.assertEqual(self._ip(watcher, 'foo', 'bar'), '1.1.1.1')
+        self.assertEqual(watcher.refresh(), [])
+
+        self._write('Foo', 'Bar', '2.2.2.2')
+        self._write('Foo', 'Baz', '3.3.3.3')
+        self.assertEqual(sorted(watcher.refresh()), [('foo', 'bar'), ('foo', 'baz')])
+        self.assertEqual(self._ip(watcher, 'foo', 'bar'), '2.2.2.2')
+        self.assertEqual(self._ip(watcher, 'foo', 'baz'), '3.3.3.3')
+        # a template taken before the swap keeps its version
+        self.assertEqual(dc.apply_template([], 'example.com', None, {})[0][0]['data'], '1.1.1.1')
+
+        os.remove(os.path.join(self.template_dir, 'foo.baz.json'))
+        self.assertEqual(watcher.refresh(['foo.baz.json']), [('foo', 'baz')])
+        self.assertIsNone(watcher.get('foo', 'baz'))
+        self.assertEqual(len(changes), 2)
+
+        watcher.unsubscribe(changes.append)
+        self._write('Foo', 'Bar', '4.4.4.4')
+        watcher.refresh()
+        self.assertEqual(len(changes), 2)
+
+    def test_failing_subscriber(self):
+        watcher = TemplateWatcher(self.template_dir)
+        changes = []
+
+        def fail(changed):
+            raise ValueError()
+        watcher.subscribe(fail)
+        watcher.subscribe(changes.append)
+        self._write('Foo', 'Bar', '2.2.2.2')
+        with self.assertLogs('domainconnectzone.watchutil'):
+            watcher.refresh()
+        self.assertEqual(changes, [[('foo', 'bar')]])
+
+    def test_malformed_template(self):
+        with open(os.path.join(self.template_dir, 'c.d.json'), 'w') as f:
+            json.dump({"providerId": "c", "serviceId": "d"}, f)
+        with self.assertLogs('domainconnectzone.watchutil'):
+            watcher = TemplateWatcher(self.template_dir, interval=0.05, use_inotify=False)
+        with self.assertRaises(KeyError):
+            watcher.get('c', 'd').apply_template([], 'example.com', None, {})
+
+        changed = threading.Event()
+        watcher.subscribe(lambda keys: changed.set() if ('foo', 'baz') in keys else None)
+        with self.assertLogs('domainconnectzone.watchutil'):
+            with watcher:
+                with open(os.path.join(self.template_dir, 'e.f.json'), 'w') as f:
+                    json.dump({"providerId": "e", "serviceId": "f", "records": [{"host": "@"}]}, f)
+                self._write('Foo', 'Baz', '3.3.3.3')
+                self.assertTrue(changed.wait(5))
+                self.assertEqual(self._ip(watcher, 'foo', 'baz'), '3.3.3.3')
+                self.assertIsNotNone(watcher.get('e', 'f'))
+
+    def test_invalid_template_dir(self):
+        with self.assertRaises(InvalidTemplate):
+            TemplateWatcher('/not/existing/dir')
+
+    def _check_watch(self, use_inotify):
+        watcher = TemplateWatcher(self.template_dir, interval=0.05, use_inotify=use_inotify)
+        changed = threading.Event()
+        watcher.subscribe(lambda keys: changed.set() if ('foo', 'baz') in keys else None)
+        with watcher:
+            self._write('Foo', 'Baz', '3.3.3.3')
+            self.assertTrue(changed.wait(5))
+            self.assertEqual(self._ip(watcher, 'foo', 'baz'), '3.3.3.3')
+
+            changed.clear()
+            os.remove(os.path.join(self.template_dir, 'foo.baz.json'))
+            self.assertTrue(changed.wait(5))
+            self.assertIsNone(watcher.get('foo', 'baz'))
+        self.assertIsNone(watcher._thread)
+
+    def test_start_reads_once(self):
+        for use_inotify, start in ((False, False), (True, True)):
+            with patch('domainconnectzone.DomainConnectTemplates.TemplateCatalog.refresh',
+                       autospec=True, side_effect=TemplateCatalog.refresh) as refresh:
+                watcher = TemplateWatcher(self.template_dir, interval=0.05 if use_inotify else 10,
+                                          use_inotify=use_inotify, start=start)
+                changes = []
+                watcher.subscribe(changes.append)
+                with watcher:
+                    self.assertEqual(self._ip(watcher, 'foo', 'bar'), '1.1.1.1')
+                    time.sleep(0.1)
+                self.assertEqual(refresh.call_count, 1)
+            self.assertEqual(changes, [])
+
+    def test_watch_polling(self):
+        self._check_watch(use_inotify=False)
+
+    @unittest.skipUnless(sys.platform.startswith('linux'), 'inotify is Linux only')
+    def test_watch_inotify(self):
+        self._check_watch(use_inotify=True)
+
+
+if __name__ == '__main__':
+    unittest.main()